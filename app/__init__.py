@@ -19,11 +19,14 @@ This module contains the microservice code for
     models
 """
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from app.database import SQLAlchemy
+from app import metrics, compression
 
 app = Flask(__name__)
 app.config.from_object('config')
 
 db = SQLAlchemy(app)
+metrics.init_app(app)
+compression.init_app(app)
 
 from app import server, models
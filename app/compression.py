@@ -0,0 +1,145 @@
+# Copyright NYU-DevOps-Alpha team-customer. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Response compression
+
+Compresses responses with brotli or gzip, whichever the client prefers
+in its Accept-Encoding. Responses smaller than COMPRESSION_MIN_SIZE are
+sent as they are since they would cost more CPU than they save on the
+wire. Streamed responses are compressed chunk by chunk as they are sent.
+"""
+import time
+import zlib
+from flask import request, current_app
+from app.metrics import COMPRESSION_TIME, COMPRESSION_BYTES
+
+try:
+    import brotli
+except ImportError:     # brotli is optional, gzip is always offered
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/msgpack', 'application/x-ndjson',
+                      'text/csv', 'text/plain', 'text/html')
+
+######################################################################
+#  C O M P R E S S O R S
+######################################################################
+class GzipCompressor(object):
+    """ Incremental gzip compressor """
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor(object):
+    """ Incremental brotli compressor """
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def make_compressor(encoding, config):
+    """ Returns a new compressor for a content coding """
+    if encoding == 'br':
+        return BrotliCompressor(config['COMPRESSION_BROTLI_QUALITY'])
+    return GzipCompressor(config['COMPRESSION_GZIP_LEVEL'])
+
+
+def choose_encoding(accept_encodings):
+    """ Returns the content coding preferred by the client or None
+
+    Brotli wins a tie with gzip since it compresses JSON better
+    """
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return accept_encodings.best_match(encodings)
+
+
+######################################################################
+#  R E S P O N S E   H O O K
+######################################################################
+def compress_response(response):
+    """ Compresses a response for a client that accepts it """
+    if response.status_code < 200 or response.status_code in (204, 304) \
+            or response.direct_passthrough or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    config = current_app.config
+    if response.is_streamed:
+        response.response = compress_stream(response.response,
+                                            make_compressor(encoding, config), encoding)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESSION_MIN_SIZE']:
+            return response
+        compressor = make_compressor(encoding, config)
+        start = time.time()
+        compressed = compressor.compress(data) + compressor.finish()
+        record(encoding, time.time() - start, len(data), len(compressed))
+        response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the identity ones, so the entity
+    # tag only stays valid as a weak one
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def compress_stream(chunks, compressor, encoding):
+    """ Generator that compresses a streamed body as it is sent """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            start = time.time()
+            compressed = compressor.compress(chunk)
+            record(encoding, time.time() - start, len(chunk), len(compressed))
+            if compressed:
+                yield compressed
+        start = time.time()
+        compressed = compressor.finish()
+        record(encoding, time.time() - start, 0, len(compressed))
+        yield compressed
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def record(encoding, duration, size_in, size_out):
+    """ Counts the time and bytes of a compression """
+    COMPRESSION_TIME.inc(duration, encoding=encoding)
+    COMPRESSION_BYTES.inc(size_in, encoding=encoding, stage='in')
+    COMPRESSION_BYTES.inc(size_out, encoding=encoding, stage='out')
+
+
+def init_app(app):
+    """ Installs the compression hook on the app """
+    app.after_request(compress_response)
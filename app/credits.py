@@ -0,0 +1,298 @@
+# Copyright NYU-DevOps-Alpha team-customer. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write-behind queue of credit adjustments
+
+With CREDIT_QUEUE set to memory or redis the credit actions only queue
+their amount and are answered with 202 Accepted. A background thread of
+every process drains the queue every CREDIT_QUEUE_FLUSH_SECONDS, adds up
+the amounts queued for each Customer and applies them with one UPDATE
+per Customer, all in one transaction. A flush that fails puts its amounts
+back in the queue, and the queue is flushed once more when the process
+exits. When the database rejects the transaction, the Customers are
+retried one by one and the adjustments it still rejects are dropped, so
+that one bad row cannot hold up the whole queue. The memory queue only survives clean shutdowns of its process; the
+redis queue is shared by all the processes and survives them.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from sqlalchemy.exc import IntegrityError, DataError
+from app import app
+from app.models import Customer
+
+logger = logging.getLogger(__name__)
+
+######################################################################
+#  Q U E U E   B A C K E N D S
+######################################################################
+class MemoryQueue(object):
+    """ Pending credit amounts of this process """
+    backend = 'memory'
+
+    def __init__(self):
+        self._amounts = {}
+        self._events = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def push(self, customer_id, amount):
+        """ Queues an amount, returns the number of pending adjustments """
+        with self._lock:
+            self._amounts[customer_id] = self._amounts.get(customer_id, 0) + amount
+            self._events += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            return self._events
+
+    def drain(self):
+        """ Takes the pending amounts per Customer
+
+        Returns them with the number of adjustments they add up and the
+        time the oldest one was queued
+        """
+        with self._lock:
+            pending = (self._amounts, self._events, self._oldest)
+            self._amounts = {}
+            self._events = 0
+            self._oldest = None
+        return pending
+
+    def restore(self, amounts, events, oldest):
+        """ Puts drained amounts back in the queue """
+        with self._lock:
+            for customer_id, amount in amounts.items():
+                self._amounts[customer_id] = self._amounts.get(customer_id, 0) + amount
+            self._events += events
+            if self._oldest is None or oldest < self._oldest:
+                self._oldest = oldest
+
+    def depth(self):
+        """ Returns the pending adjustments, Customers and oldest time """
+        with self._lock:
+            return self._events, len(self._amounts), self._oldest
+
+
+class RedisQueue(object):
+    """ Pending credit amounts shared by all processes through Redis
+
+    The amounts are summed per Customer in a hash by HINCRBY, and drained
+    in a MULTI transaction so that every amount is taken by one flush.
+    """
+    backend = 'redis'
+
+    def __init__(self, client, prefix='credit:'):
+        self.client = client
+        self.amounts_key = prefix + 'amounts'
+        self.events_key = prefix + 'events'
+        self.oldest_key = prefix + 'oldest'
+
+    def push(self, customer_id, amount):
+        """ Queues an amount, returns the number of pending adjustments """
+        pipe = self.client.pipeline()
+        pipe.hincrby(self.amounts_key, customer_id, amount)
+        pipe.incr(self.events_key)
+        pipe.set(self.oldest_key, repr(time.time()), nx=True)
+        return pipe.execute()[1]
+
+    def drain(self):
+        """ Takes the pending amounts per Customer
+
+        Returns them with the number of adjustments they add up and the
+        time the oldest one was queued
+        """
+        pipe = self.client.pipeline()
+        pipe.hgetall(self.amounts_key)
+        pipe.get(self.events_key)
+        pipe.get(self.oldest_key)
+        pipe.delete(self.amounts_key, self.events_key, self.oldest_key)
+        amounts, events, oldest, _ = pipe.execute()
+        return (dict((int(key), int(value)) for key, value in amounts.items()),
+                int(events or 0), float(oldest) if oldest else None)
+
+    def restore(self, amounts, events, oldest):
+        """ Puts drained amounts back in the queue """
+        pipe = self.client.pipeline()
+        for customer_id, amount in amounts.items():
+            pipe.hincrby(self.amounts_key, customer_id, amount)
+        pipe.incrby(self.events_key, events)
+        if oldest:
+            pipe.set(self.oldest_key, repr(oldest), nx=True)
+        pipe.execute()
+
+    def depth(self):
+        """ Returns the pending adjustments, Customers and oldest time """
+        pipe = self.client.pipeline()
+        pipe.get(self.events_key)
+        pipe.hlen(self.amounts_key)
+        pipe.get(self.oldest_key)
+        events, customers, oldest = pipe.execute()
+        return int(events or 0), customers, float(oldest) if oldest else None
+
+
+######################################################################
+#  C R E D I T   Q U E U E
+######################################################################
+class CreditQueue(object):
+    """ Queues credit adjustments and applies them from a background thread """
+
+    def __init__(self, backend, flush_seconds=0.5, max_pending=10000):
+        self.backend = backend
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.flushes = 0
+        self.failures = 0
+        self.applied = 0
+        self.updates = 0
+        self.missing = 0
+        self.last_flush = None
+        self.last_lag = 0.0
+        self._pid = None
+        self._thread = None
+        self._stopping = False
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def push(self, customer_id, amount):
+        """ Queues a credit adjustment, returns the number pending """
+        self.start()
+        pending = self.backend.push(customer_id, amount)
+        if self.max_pending and pending >= self.max_pending:
+            self._wake.set()
+        return pending
+
+    def start(self):
+        """ Starts the flush thread of this process, again after a fork """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._wake = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='credit-queue')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the flush thread and applies what is still queued """
+        if self._pid == os.getpid() and self._thread:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join(timeout)
+            self._pid = self._thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Credit adjustments could not be applied on shutdown')
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Credit adjustments could not be applied, they stay queued')
+
+    def flush(self):
+        """ Applies the queued adjustments, returns the number applied """
+        amounts, events, oldest = self.backend.drain()
+        if not events:
+            return 0
+        # adjustments that cancel each other out need no UPDATE
+        deltas = dict((customer_id, amount) for customer_id, amount in amounts.items() if amount)
+        rejected = []
+        try:
+            with app.app_context():
+                missing = Customer.apply_credit_deltas(deltas) if deltas else []
+        except (IntegrityError, DataError):
+            missing, rejected = self._apply_one_by_one(deltas, oldest)
+        except Exception:
+            self.failures += 1
+            self.backend.restore(amounts, events, oldest)
+            raise
+        if missing:
+            logger.warning('Dropped credit adjustments of missing Customers %s', missing)
+        self.flushes += 1
+        self.applied += events
+        self.updates += len(deltas) - len(missing) - len(rejected)
+        self.missing += len(missing)
+        self.last_flush = time.time()
+        self.last_lag = self.last_flush - oldest if oldest else 0.0
+        return events
+
+    def _apply_one_by_one(self, deltas, oldest):
+        """ Applies the amount of each Customer in its own transaction
+
+        An amount the database rejects is dropped and counted in failures.
+        If the database fails otherwise, the amounts not applied yet are put
+        back in the queue. Returns the ids of the missing Customers and of
+        those whose amount was rejected.
+        """
+        missing = []
+        rejected = []
+        customer_ids = sorted(deltas)
+        for index, customer_id in enumerate(customer_ids):
+            try:
+                with app.app_context():
+                    missing.extend(Customer.apply_credit_deltas({customer_id: deltas[customer_id]}))
+            except (IntegrityError, DataError):
+                self.failures += 1
+                rejected.append(customer_id)
+                logger.exception('Dropped the credit adjustment of %s to Customer %s',
+                                 deltas[customer_id], customer_id)
+            except Exception:
+                self.failures += 1
+                pending = customer_ids[index:]
+                self.backend.restore(dict((key, deltas[key]) for key in pending),
+                                     len(pending), oldest)
+                raise
+        return missing, rejected
+
+    def stats(self):
+        """ Returns the depth, lag and flush counters of the queue """
+        events, customers, oldest = self.backend.depth()
+        return {'backend': self.backend.backend,
+                'depth': events,
+                'customers': customers,
+                'lag_seconds': time.time() - oldest if oldest else 0.0,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'applied': self.applied,
+                'updates': self.updates,
+                'missing': self.missing,
+                'last_flush': self.last_flush,
+                'last_flush_lag_seconds': self.last_lag}
+
+
+def make_queue(config):
+    """ Creates the credit queue selected by CREDIT_QUEUE, None if disabled """
+    backend = config['CREDIT_QUEUE']
+    if backend == 'redis':
+        import redis
+        backend = RedisQueue(redis.StrictRedis.from_url(config['REDIS_URL']))
+    elif backend == 'memory':
+        backend = MemoryQueue()
+    else:
+        return None
+    return CreditQueue(backend, config['CREDIT_QUEUE_FLUSH_SECONDS'],
+                       config['CREDIT_QUEUE_MAX_PENDING'])
+
+queue = make_queue(app.config)
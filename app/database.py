@@ -0,0 +1,365 @@
+# Copyright NYU-DevOps-Alpha team-customer. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Database engine configuration
+
+Applies the connection pool settings from the config to the engine,
+pings pooled connections before they are used, keeps counters of
+the pool activity and routes reads to the read replicas
+"""
+import time
+import threading
+import sqlalchemy
+from sqlalchemy import event, exc, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool, QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession
+
+
+######################################################################
+#  P O O L   S T A T I S T I C S
+######################################################################
+class PoolStats(object):
+    """ Counters of the connection pool activity of this process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Sets all the counters back to zero """
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.wait_count = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def incr(self, name):
+        """ Increments one of the counters """
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_wait(self, seconds):
+        """ Records how long a checkout waited for a connection """
+        with self._lock:
+            self.wait_count += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def as_dict(self, pool=None):
+        """ Returns the counters and the current state of the pool """
+        data = {'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'invalidations': self.invalidations,
+                'wait_avg': self.wait_total / self.wait_count if self.wait_count else 0.0,
+                'wait_max': self.wait_max}
+        if isinstance(pool, QueuePool):
+            data.update({'size': pool.size(),
+                         'checked_out': pool.checkedout(),
+                         'overflow': pool.overflow()})
+        return data
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that records how long checkouts wait for a connection """
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        finally:
+            pool_stats.record_wait(time.time() - start)
+
+
+@event.listens_for(Pool, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    pool_stats.incr('connects')
+
+@event.listens_for(Pool, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats.incr('checkouts')
+
+@event.listens_for(Pool, 'checkin')
+def on_checkin(dbapi_connection, connection_record):
+    pool_stats.incr('checkins')
+
+@event.listens_for(Pool, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    pool_stats.incr('invalidations')
+
+
+######################################################################
+#  P R E - P I N G
+######################################################################
+def ping_connection(connection, branch):
+    """ Tests a pooled connection with SELECT 1 before it is used
+
+    A connection that was dropped while idle in the pool is invalidated
+    by the failed ping and transparently replaced by a new one
+    """
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as error:
+        if not error.connection_invalidated:
+            raise
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+######################################################################
+#  R E A D   R E P L I C A S
+######################################################################
+class ReplicaSet(object):
+    """ The engines of the read replicas and the strategy to pick one """
+
+    def __init__(self, uris, engines, strategy='round_robin'):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError('Unknown replica strategy ' + strategy)
+        self.uris = uris
+        self.engines = engines
+        self.strategy = strategy
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """ Returns the engine of the replica to read from """
+        if self.strategy == 'least_connections':
+            return min(self.engines, key=lambda engine: checked_out(engine.pool))
+        with self._lock:
+            engine = self.engines[self._next % len(self.engines)]
+            self._next += 1
+        return engine
+
+    def dispose(self):
+        """ Closes the connections of all the replicas """
+        for engine in self.engines:
+            engine.dispose()
+
+
+def checked_out(pool):
+    """ Returns the number of connections in use from a pool """
+    return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+
+def pool_saturation(pool):
+    """ Returns the fraction of the pool capacity in use or None if unbounded """
+    if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+        return None
+    capacity = pool.size() + pool._max_overflow
+    return float(pool.checkedout()) / capacity if capacity else None
+
+
+def replica_lag(engine):
+    """ Returns how many seconds a replica is behind its primary, if known """
+    if engine.dialect.name == 'mysql':
+        row = engine.execute('SHOW SLAVE STATUS').first()
+        return row['Seconds_Behind_Master'] if row is not None else None
+    if engine.dialect.name == 'postgresql':
+        return engine.scalar('SELECT EXTRACT(EPOCH FROM now() - '
+                             'pg_last_xact_replay_timestamp())')
+    return None
+
+
+######################################################################
+#  R E A D I N E S S
+######################################################################
+class ReadinessProbe(object):
+    """ Probes the databases with SELECT 1 and caches the result
+
+    The probe runs at most once per ``ttl`` seconds however often the
+    load balancer asks, so probe storms don't add load to the database.
+    It opens connections of its own, which give up after ``timeout``
+    seconds, so it is not held up by a saturated pool.
+    """
+
+    def __init__(self, ttl=5.0, timeout=2.0):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._result = None
+        self._checked_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def check(self, db):
+        """ Returns the cached probe result, probing again when it expired
+
+        One thread probes at a time and without holding the lock, the
+        others answer with the previous result meanwhile
+        """
+        with self._lock:
+            result = self._result
+            expired = time.time() - self._checked_at >= self.ttl
+            if result is not None and (self._probing or not expired):
+                return dict(result, cached=True)
+            self._probing = True
+        result = None
+        try:
+            result = self.probe(db, self.timeout)
+        finally:
+            with self._lock:
+                self._probing = False
+                if result is not None:
+                    self._result = result
+                    self._checked_at = time.time()
+        return dict(result, cached=False)
+
+    def reset(self):
+        """ Forgets the cached result """
+        with self._lock:
+            self._result = None
+
+    @staticmethod
+    def probe(db, timeout=None):
+        """ Runs SELECT 1 against the primary and every replica """
+        result = {'database': probe_engine(db.engine, timeout), 'replicas': []}
+        for engine in db.replica_engines():
+            replica = probe_engine(engine, timeout)
+            if replica['ok']:
+                try:
+                    replica['lag_seconds'] = replica_lag(engine)
+                except exc.SQLAlchemyError:
+                    replica['lag_seconds'] = None
+            result['replicas'].append(replica)
+        return result
+
+
+def probe_engine(engine, timeout=None):
+    """ Runs SELECT 1 on a new connection to the database of an engine
+
+    The connection bypasses the pool, so the probe neither waits for nor
+    takes a connection the requests need. Returns the latency or the error.
+    """
+    start = time.time()
+    dialect = engine.dialect
+    cargs, cparams = dialect.create_connect_args(engine.url)
+    if timeout and dialect.name in ('mysql', 'postgresql'):
+        cparams['connect_timeout'] = max(int(timeout), 1)
+    try:
+        connection = dialect.connect(*cargs, **cparams)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        finally:
+            connection.close()
+    except (dialect.dbapi.Error, exc.SQLAlchemyError) as error:
+        return {'ok': False, 'error': str(getattr(error, 'orig', None) or error)}
+    return {'ok': True, 'latency_ms': (time.time() - start) * 1000}
+
+
+class RoutingSession(SignallingSession):
+    """ Session that sends reads to a replica when asked to
+
+    Reads are routed only while ``info['read_replica']`` is set and only
+    until the session has written anything, after which every statement
+    goes to the primary so the request sees its own writes
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+        event.listen(self, 'after_flush', mark_written)
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            self.info['written'] = True
+        if self.info.get('read_replica') and not self.info.get('written'):
+            engine = self.db.get_replica_engine()
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def mark_written(session, flush_context):
+    """ Pins a session that has flushed changes to the primary """
+    session.info['written'] = True
+
+
+######################################################################
+#  F L A S K - S Q L A L C H E M Y
+######################################################################
+class SQLAlchemy(BaseSQLAlchemy):
+    """ Flask-SQLAlchemy with the pool configuration of this service """
+
+    def __init__(self, *args, **kwargs):
+        self._replicas = None
+        self._replica_lock = threading.Lock()
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def get_replica_engine(self):
+        """ Returns a read replica engine or None when there are no replicas """
+        app = self.get_app()
+        uris = app.config.get('DB_READ_REPLICA_URIS')
+        if not uris:
+            return None
+        with self._replica_lock:
+            if self._replicas is None or self._replicas.uris != uris:
+                if self._replicas is not None:
+                    self._replicas.dispose()
+                engines = [self.create_replica_engine(app, uri) for uri in uris]
+                self._replicas = ReplicaSet(uris, engines,
+                                            app.config['DB_READ_REPLICA_STRATEGY'])
+        return self._replicas.choose()
+
+    def create_replica_engine(self, app, uri):
+        """ Creates the engine of a replica with the same pool options """
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        return sqlalchemy.create_engine(info, **options)
+
+    def replica_engines(self):
+        """ Returns the engines of all the read replicas """
+        if self.get_replica_engine() is None:
+            return []
+        return list(self._replicas.engines)
+
+    def dispose_replicas(self):
+        """ Closes the connections of the read replicas """
+        with self._replica_lock:
+            if self._replicas is not None:
+                self._replicas.dispose()
+
+    def init_app(self, app):
+        super(SQLAlchemy, self).init_app(app)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING') and \
+                not event.contains(Engine, 'engine_connect', ping_connection):
+            event.listen(Engine, 'engine_connect', ping_connection)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('sqlite'):
+            # SQLite uses a NullPool or StaticPool that has no queue to size
+            for key in ('pool_size', 'pool_timeout', 'max_overflow'):
+                options.pop(key, None)
+        else:
+            options.setdefault('poolclass', InstrumentedQueuePool)
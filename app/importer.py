@@ -0,0 +1,338 @@
+# Copyright NYU-DevOps-Alpha team-customer. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bulk import of Customers
+
+Reads Customers from a CSV or newline delimited JSON file as a stream,
+validates them with the Customer deserialize rules and writes them in
+batches, bypassing the HTTP layer and the ORM. Batches are written with
+multi-row INSERTs, or with COPY on PostgreSQL and LOAD DATA LOCAL INFILE
+on MySQL, and can be spread over a pool of processes. Records that do
+not validate or cannot be written go to a reject file with their line
+number and error.
+"""
+import csv
+import json
+import time
+import logging
+import tempfile
+from collections import deque
+from cStringIO import StringIO
+from datetime import datetime
+from multiprocessing import Pool
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+from app.models import Customer, DataValidationError
+
+logger = logging.getLogger(__name__)
+
+# Columns written by the import, in the order of the COPY and LOAD DATA files
+COLUMNS = ('id', 'firstname', 'lastname', 'valid', 'credit_level', 'version', 'updated_at')
+
+BOOLEANS = {'true': True, '1': True, 'yes': True, 'false': False, '0': False, 'no': False}
+
+######################################################################
+#  R E A D I N G
+######################################################################
+def guess_format(path):
+    """ Returns the format of a file from its extension """
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+def read_records(path, file_format=None):
+    """ Generator that yields the (line number, raw record) of a file
+
+    CSV rows are yielded as dicts of strings and NDJSON lines as they
+    are; they are parsed along with the validation, in the workers
+    """
+    file_format = file_format or guess_format(path)
+    with open(path, 'rb') as stream:
+        if file_format == 'csv':
+            reader = csv.DictReader(stream)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for number, line in enumerate(stream, 1):
+                if line.strip():
+                    yield number, line
+
+def batches(records, batch_size):
+    """ Generator that groups records in lists of batch_size """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def parse_record(raw):
+    """ Turns a CSV row or an NDJSON line into a Customer record """
+    if isinstance(raw, basestring):
+        try:
+            record = json.loads(raw)
+        except ValueError:
+            raise DataValidationError('Invalid Customer: line is not JSON')
+        if not isinstance(record, dict):
+            raise DataValidationError('Invalid Customer: record must be a JSON object')
+        return record
+    record = {}
+    for key, value in raw.items():
+        # None keys hold the values of extra columns
+        if key is None or value in (None, ''):
+            continue
+        value = value.decode('utf-8')
+        if key in ('id', 'credit_level'):
+            value = to_int(key, value)
+        elif key == 'valid':
+            if value.lower() not in BOOLEANS:
+                raise DataValidationError('Invalid Customer: valid must be true or false')
+            value = BOOLEANS[value.lower()]
+        record[key] = value
+    return record
+
+def to_int(name, value):
+    """ Converts a field of a record to an integer """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise DataValidationError('Invalid Customer: {} must be an integer'.format(name))
+
+def to_mapping(record, now):
+    """ Validates a record and returns the column values to insert """
+    customer = Customer().deserialize(record)
+    mapping = {'firstname': customer.firstname,
+               'lastname': customer.lastname,
+               'valid': True,
+               'credit_level': 0,
+               'version': 1,
+               'updated_at': now}
+    if customer.credit_level is not None:
+        mapping['valid'] = customer.valid
+        mapping['credit_level'] = customer.credit_level
+    Customer.check_lengths(mapping)
+    if record.get('id') is not None:
+        mapping['id'] = to_int('id', record['id'])
+    return mapping
+
+
+######################################################################
+#  W R I T I N G
+######################################################################
+def insert_rows(connection, mappings):
+    """ Writes rows with multi-row INSERT statements """
+    table = Customer.__table__
+    # executemany needs the same columns in every row
+    for group in split_by_id(mappings):
+        connection.execute(table.insert(), group)
+
+def copy_rows(connection, mappings):
+    """ Writes rows with COPY FROM STDIN on PostgreSQL """
+    for group in split_by_id(mappings):
+        columns = [name for name in COLUMNS if name in group[0]]
+        data = StringIO()
+        writer = csv.writer(data)
+        for mapping in group:
+            writer.writerow([copy_value(mapping[name]) for name in columns])
+        data.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert('COPY customer ({}) FROM STDIN WITH CSV'.format(', '.join(columns)),
+                           data)
+
+def load_data_rows(connection, mappings):
+    """ Writes rows with LOAD DATA LOCAL INFILE on MySQL """
+    for group in split_by_id(mappings):
+        columns = [name for name in COLUMNS if name in group[0]]
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as data:
+            for mapping in group:
+                data.write('\t'.join(load_data_value(mapping[name]) for name in columns))
+                data.write('\n')
+            data.flush()
+            connection.execute("LOAD DATA LOCAL INFILE %s INTO TABLE customer "
+                               "CHARACTER SET utf8 FIELDS TERMINATED BY '\\t' "
+                               "({})".format(', '.join(columns)), (data.name,))
+
+def split_by_id(mappings):
+    """ Returns the rows with an id and the rows without one, if any """
+    return [group for group in ([m for m in mappings if 'id' in m],
+                                [m for m in mappings if 'id' not in m]) if group]
+
+def copy_value(value):
+    """ Formats a value for a COPY CSV file, where empty is NULL """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def load_data_value(value):
+    """ Formats a value for a LOAD DATA file """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+WRITERS = {'insert': insert_rows, 'copy': copy_rows, 'load_data': load_data_rows}
+
+
+######################################################################
+#  I M P O R T E R
+######################################################################
+class Importer(object):
+    """ Validates and writes batches of records to a database
+
+    ``method`` is insert, copy (PostgreSQL), load_data (MySQL, needs
+    local_infile on the server) or auto, which picks copy on PostgreSQL
+    and insert anywhere else
+    """
+
+    def __init__(self, uri, method='auto'):
+        connect_args = {'local_infile': True} if method == 'load_data' else {}
+        self.engine = create_engine(uri, connect_args=connect_args)
+        if method == 'auto':
+            method = 'copy' if self.engine.dialect.name == 'postgresql' else 'insert'
+        self.method = method
+        self.write = WRITERS[method]
+        self.errors = (SQLAlchemyError, self.engine.dialect.dbapi.Error)
+
+    def load_batch(self, batch):
+        """ Imports a batch of (line number, raw record)
+
+        The valid records are written in one transaction. When that fails
+        they are written one by one so that only the bad ones are
+        rejected. Returns the number of rows written and the rejects.
+        """
+        now = datetime.utcnow()
+        rows = []
+        rejects = []
+        for line, raw in batch:
+            try:
+                rows.append((line, raw, to_mapping(parse_record(raw), now)))
+            except (DataValidationError, UnicodeDecodeError) as error:
+                rejects.append(reject(line, raw, error))
+        try:
+            with self.engine.begin() as connection:
+                self.write(connection, [mapping for _, _, mapping in rows])
+            return len(rows), rejects
+        except self.errors as error:
+            logger.warning('Batch from line %s failed, retrying row by row: %s',
+                           batch[0][0], error)
+        loaded = 0
+        for line, raw, mapping in rows:
+            try:
+                with self.engine.begin() as connection:
+                    insert_rows(connection, [mapping])
+                loaded += 1
+            except self.errors as error:
+                rejects.append(reject(line, raw, error))
+        return loaded, rejects
+
+    def finish(self, ids_given):
+        """ Moves the id sequence past ids given by the file on PostgreSQL """
+        if ids_given and self.engine.dialect.name == 'postgresql':
+            self.engine.execute("SELECT setval(pg_get_serial_sequence('customer', 'id'), "
+                                "(SELECT MAX(id) FROM customer))")
+        self.engine.dispose()
+
+
+def reject(line, raw, error):
+    """ Builds the reject of a record """
+    if not isinstance(raw, basestring):
+        raw = dict((key, value) for key, value in raw.items() if key is not None)
+    else:
+        raw = raw.rstrip('\n')
+    return {'line': line, 'error': str(error), 'record': raw}
+
+# The Importer of a worker process of the pool
+_importer = None
+
+def _init_worker(uri, method):
+    global _importer
+    _importer = Importer(uri, method)
+
+def _load_batch(batch):
+    return _importer.load_batch(batch)
+
+
+def import_file(path, uri, file_format=None, batch_size=10000, workers=1,
+                method='auto', reject_path=None, progress=None):
+    """ Imports the Customers of a file and returns the statistics
+
+    The file is read as a stream and at most two batches per worker are
+    in flight, so memory does not grow with the size of the file.
+    ``progress`` is called with the statistics after every batch.
+    """
+    stats = {'rows': 0, 'loaded': 0, 'rejected': 0}
+    rejects = open(reject_path, 'w') if reject_path else None
+    start = time.time()
+    ids_given = False
+
+    def collect(result):
+        loaded, batch_rejects = result
+        stats['loaded'] += loaded
+        stats['rejected'] += len(batch_rejects)
+        stats['rows'] += loaded + len(batch_rejects)
+        for item in batch_rejects:
+            if rejects:
+                rejects.write(json.dumps(item) + '\n')
+        stats['seconds'] = time.time() - start
+        stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+        if progress:
+            progress(stats)
+
+    records = read_records(path, file_format)
+    importer = Importer(uri, method)
+    try:
+        if workers > 1:
+            pool = Pool(workers, _init_worker, (uri, method))
+            pending = deque()
+            try:
+                for batch in batches(records, batch_size):
+                    ids_given = ids_given or has_ids(batch)
+                    pending.append(pool.apply_async(_load_batch, (batch,)))
+                    if len(pending) >= workers * 2:
+                        collect(pending.popleft().get())
+                while pending:
+                    collect(pending.popleft().get())
+            finally:
+                pool.terminate()
+        else:
+            for batch in batches(records, batch_size):
+                ids_given = ids_given or has_ids(batch)
+                collect(importer.load_batch(batch))
+        importer.finish(ids_given)
+    finally:
+        if rejects:
+            rejects.close()
+    stats['seconds'] = time.time() - start
+    stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+def has_ids(batch):
+    """ Tells if any record of a batch may give its own id """
+    for _, raw in batch:
+        if isinstance(raw, basestring):
+            if '"id"' in raw:
+                return True
+        elif raw.get('id'):
+            return True
+    return False
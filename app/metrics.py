@@ -0,0 +1,236 @@
+# Copyright NYU-DevOps-Alpha team-customer. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request and SQL metrics
+
+Records the latency and status of every request and the number and
+time of the SQL statements it ran, and renders them in the Prometheus
+text exposition format. The metrics are kept per process.
+"""
+import time
+import logging
+import threading
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+######################################################################
+#  M E T R I C   T Y P E S
+######################################################################
+class Metric(object):
+    """ Base of the metric types, one value per set of labels """
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, escape_label(value))
+                              for name, value in pairs) + '}'
+
+    def render(self):
+        """ Returns the metric in the Prometheus text format """
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['{}{} {}'.format(self.name, self._label_text(key), format_value(value))]
+
+
+class Counter(Metric):
+    """ A value that only goes up """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    """ A value that goes up and down """
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """ Counts observations in cumulative buckets """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, observations = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [count + (1 if value <= bound else 0)
+                      for count, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, observations + 1)
+
+    def _render_value(self, key, value):
+        counts, total, observations = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            lines.append('{}_bucket{} {}'.format(
+                self.name, self._label_text(key, [('le', format_value(bound))]), count))
+        lines.append('{}_bucket{} {}'.format(
+            self.name, self._label_text(key, [('le', '+Inf')]), observations))
+        lines.append('{}_sum{} {}'.format(self.name, self._label_text(key), format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, self._label_text(key), observations))
+        return lines
+
+
+def escape_label(value):
+    """ Escapes a label value for the text format """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    """ Formats a sample value for the text format """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+######################################################################
+#  M E T R I C S   O F   T H E   S E R V I C E
+######################################################################
+REQUEST_LATENCY = Histogram('http_request_duration_seconds',
+                            'Latency of the requests by route', ('method', 'route'))
+REQUESTS = Counter('http_requests_total',
+                   'Requests by route and status', ('method', 'route', 'status'))
+IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being served')
+SQL_STATEMENTS = Counter('sql_statements_total', 'SQL statements executed by route', ('route',))
+SQL_LATENCY = Histogram('sql_statement_duration_seconds',
+                        'Time spent in SQL statements by route', ('route',))
+COMPRESSION_TIME = Counter('http_compression_seconds_total',
+                           'Time spent compressing responses by encoding', ('encoding',))
+COMPRESSION_BYTES = Counter('http_compression_bytes_total',
+                            'Response bytes before (in) and after (out) compression',
+                            ('encoding', 'stage'))
+
+METRICS = [REQUEST_LATENCY, REQUESTS, IN_FLIGHT, SQL_STATEMENTS, SQL_LATENCY,
+           COMPRESSION_TIME, COMPRESSION_BYTES]
+
+logger = logging.getLogger(__name__)
+
+
+def render(extra=()):
+    """ Renders all the metrics in the Prometheus text format
+
+    ``extra`` is a list of (name, description, kind, value) samples
+    added at scrape time, like the cache and pool counters
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, description, kind, value in extra:
+        lines.extend(['# HELP {} {}'.format(name, description),
+                      '# TYPE {} {}'.format(name, kind),
+                      '{} {}'.format(name, format_value(value))])
+    return '\n'.join(lines) + '\n'
+
+
+def current_route():
+    """ Returns the route pattern of the current request """
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def before_request():
+    """ Starts timing a request """
+    g.metrics_start = time.time()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.sql_slowest = (0.0, None)
+    IN_FLIGHT.inc()
+
+def after_request(response):
+    """ Records the latency and status of a request """
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    IN_FLIGHT.dec()
+    duration = time.time() - start
+    route = current_route()
+    REQUEST_LATENCY.observe(duration, method=request.method, route=route)
+    REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    if duration >= current_app.config['SLOW_REQUEST_SECONDS']:
+        slowest_time, slowest_sql = g.sql_slowest
+        logger.warning('Slow request %s %s took %.3fs: %d SQL statements in %.3fs, '
+                       'slowest %.3fs: %s', request.method, route, duration, g.sql_count,
+                       g.sql_time, slowest_time, slowest_sql)
+    return response
+
+def teardown_request(error):
+    """ Stops counting a request that failed before after_request ran """
+    if g.pop('metrics_start', None) is not None:
+        IN_FLIGHT.dec()
+
+
+######################################################################
+#  S Q L   T I M I N G
+######################################################################
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['query_start'].pop()
+    route = current_route() if has_request_context() else 'none'
+    SQL_STATEMENTS.inc(route=route)
+    SQL_LATENCY.observe(duration, route=route)
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_time += duration
+        if duration > g.sql_slowest[0]:
+            g.sql_slowest = (duration, statement)
+
+
+def init_app(app):
+    """ Installs the request hooks on the app """
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
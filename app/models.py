@@ -27,6 +27,8 @@ firstname : string
 lastname: string
 valid: boolean
 credit_level: int
+version: int
+updated_at: datetime
 
 """
 
@@ -36,10 +38,20 @@ This model uses SQLAlchemy to persist itself
 
 import os
 import json
+import time
+import calendar
+import operator
 import logging
+import threading
+from functools import wraps
+from inspect import isgeneratorfunction
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from . import db
 from . import app
-from sqlalchemy.exc import DisconnectionError
+from sqlalchemy import select, inspect, func, literal_column, event, and_, or_
+from sqlalchemy.exc import DisconnectionError, SQLAlchemyError, DBAPIError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import pymysql
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
@@ -47,6 +59,284 @@ class DataValidationError(Exception):
 class DatabaseConnectionError(DisconnectionError):
     """ Used for database connection failure """
     pass
+class ConcurrentUpdateError(Exception):
+    """ Used when a Customer was changed by someone else since it was read """
+    pass
+
+
+######################################################################
+#  C U S T O M E R   C A C H E S
+######################################################################
+class LRUCache(object):
+    """ In-process least recently used cache with a time to live """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached value or None """
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return None
+            self._items[key] = item
+            self.hits += 1
+            return dict(item[1])
+
+    def set(self, key, value):
+        """ Caches a value, evicting the least recently used one when full """
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.ttl, dict(value))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """ Removes a value from the cache """
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """ Removes all values from the cache """
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        """ Returns the hit and miss counters of the cache """
+        return {'backend': 'lru', 'hits': self.hits, 'misses': self.misses,
+                'size': len(self._items)}
+
+
+class RedisCache(object):
+    """ Cache shared by all instances of the service through Redis """
+
+    def __init__(self, client, ttl=60, prefix='customer:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns the cached value or None """
+        value = self.client.get(self.prefix + str(key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        """ Caches a value until its time to live expires """
+        self.client.setex(self.prefix + str(key), self.ttl, json.dumps(value))
+
+    def delete(self, key):
+        """ Removes a value from the cache """
+        self.client.delete(self.prefix + str(key))
+
+    def clear(self):
+        """ Removes all values with our prefix from the cache """
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        """ Returns the hit and miss counters of the cache """
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses}
+
+
+class NullCache(object):
+    """ Cache that never stores anything, used to disable caching """
+    hits = 0
+    misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'none', 'hits': self.hits, 'misses': self.misses}
+
+
+def make_cache(config):
+    """ Creates the Customer cache selected by CUSTOMER_CACHE in the config """
+    backend = config['CUSTOMER_CACHE']
+    ttl = config['CUSTOMER_CACHE_TTL']
+    if backend == 'redis':
+        import redis
+        return RedisCache(redis.StrictRedis.from_url(config['REDIS_URL']), ttl)
+    if backend == 'lru':
+        return LRUCache(config['CUSTOMER_CACHE_SIZE'], ttl)
+    return NullCache()
+
+
+######################################################################
+#  C O A L E S C E D   R E A D S
+######################################################################
+class SingleFlight(object):
+    """ Shares one call between the identical calls running at once
+
+    The first caller of a key runs the call while the others wait for
+    it and get its result, or its error, instead of making the same
+    call again. The counters are kept per kind of call, the first item
+    of the key.
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.coalesced = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        """ Runs ``function(*args)`` once for the concurrent calls of a key """
+        kind = key[0]
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+                self.queries[kind] = self.queries.get(kind, 0) + 1
+            else:
+                self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            if 'result' in call:
+                return call['result']
+            # the first call was interrupted without an error to share
+            return function(*args)
+        try:
+            call['result'] = function(*args)
+        except Exception as error:
+            call['error'] = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+    def stats(self):
+        """ Returns the queries made and saved per kind of call """
+        with self._lock:
+            stats = dict((kind, {'queries': self.queries.get(kind, 0),
+                                 'coalesced': self.coalesced.get(kind, 0)})
+                         for kind in set(self.queries) | set(self.coalesced))
+            stats['in_flight'] = len(self._calls)
+        return stats
+
+
+######################################################################
+#  R E A D   Q U E R I E S
+######################################################################
+def retry_on_disconnect(function):
+    """ Retries an idempotent read when its database connection was dropped
+
+    The pool invalidates the dropped connection, so the retry runs on a
+    new one. Reads are not retried while the session holds unsaved
+    changes since the rollback would discard them.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        retries = app.config['DB_READ_RETRIES']
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except DBAPIError as error:
+                session = db.session
+                if not error.connection_invalidated or retries <= 0 or \
+                        session.new or session.dirty or session.deleted:
+                    raise
+                retries -= 1
+                logging.getLogger(__name__).warning('Retrying read on a new connection: %s', error)
+                session.rollback()
+    return wrapper
+
+
+def read_from_replica(function):
+    """ Sends the queries of a read to a read replica when there are any
+
+    The session keeps using the primary once it has written anything,
+    so a request always reads its own writes. A generator reads from the
+    replica for as long as it is iterated.
+    """
+    if isgeneratorfunction(function):
+        @wraps(function)
+        def generator(*args, **kwargs):
+            info = db.session.info
+            previous = info.get('read_replica', False)
+            info['read_replica'] = True
+            try:
+                for item in function(*args, **kwargs):
+                    yield item
+            finally:
+                info['read_replica'] = previous
+        return generator
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        info = db.session.info
+        previous = info.get('read_replica', False)
+        info['read_replica'] = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            info['read_replica'] = previous
+    return wrapper
+
+
+######################################################################
+#  Q U E R Y   S T R I N G   C O E R C I O N
+######################################################################
+def coerce_int(attr, value):
+    """ Coerces a query string value to an integer """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise DataValidationError('Invalid Query String: {} must be an integer'.format(attr))
+
+def coerce_bool(attr, value):
+    """ Coerces a query string value to a boolean """
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', '1', 'yes'):
+        return True
+    if str(value).lower() in ('false', '0', 'no'):
+        return False
+    raise DataValidationError('Invalid Query String: {} must be true or false'.format(attr))
+
+def coerce_string(attr, value):
+    """ Keeps a query string value as a string """
+    return value
+
+def escape_like(value):
+    """ Escapes the LIKE wildcards in a value """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Comparison operators that can follow a column name, e.g. credit_level__lt
+COMPARATORS = {'eq': operator.eq,
+               'ne': operator.ne,
+               'lt': operator.lt,
+               'lte': operator.le,
+               'gt': operator.gt,
+               'gte': operator.ge}
 
 
 ######################################################################
@@ -55,6 +345,18 @@ class DatabaseConnectionError(DisconnectionError):
 class Customer(db.Model):
     """A single customer"""
     logger = logging.getLogger(__name__)
+    cache = make_cache(app.config)
+    reads = SingleFlight()
+
+    # Columns that can be queried on and how their values are coerced
+    FILTERS = {'id': coerce_int,
+               'firstname': coerce_string,
+               'lastname': coerce_string,
+               'valid': coerce_bool,
+               'credit_level': coerce_int}
+
+    # Fields of the serialized Customer
+    FIELDS = ('id', 'firstname', 'lastname', 'valid', 'credit_level', 'version')
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
@@ -62,6 +364,21 @@ class Customer(db.Model):
     lastname = db.Column(db.String(63))
     valid = db.Column(db.Boolean(), default=True)
     credit_level = db.Column(db.Integer, default=0)
+    # Bumped by every UPDATE, including the bulk and the credit statements
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1',
+                        onupdate=literal_column('version + 1'))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Optimistic locking: the ORM updates and deletes a Customer only if it
+    # still has the version it was loaded with
+    __mapper_args__ = {'version_id_col': version}
+
+    __table_args__ = (
+        db.Index('ix_customer_lastname_firstname', 'lastname', 'firstname'),
+        db.Index('ix_customer_valid_credit_level', 'valid', 'credit_level'),
+        db.Index('ix_customer_credit_level', 'credit_level'),
+        db.Index('ix_customer_updated_at', 'updated_at'),
+    )
 
     def upgrade_credit_level(self):
         """ Upgrade the credit level of the customer """
@@ -75,17 +392,186 @@ class Customer(db.Model):
         if self.credit_level < 0:
             self.valid = False
 
+    @staticmethod
+    def adjust_credit(customer_id, amount):
+        """ Atomically changes the credit level of a Customer by amount
+
+        The increment and the valid flag are computed by the database in a
+        single UPDATE, so concurrent adjustments are never lost. The same
+        statement bumps the version and updated_at, and the change is
+        added to the credit history in the same transaction. Returns the
+        serialized Customer or None if there is no Customer with that id.
+        """
+        Customer.logger.info('Adjusting credit of id %s by %s', customer_id, amount)
+        table = Customer.__table__
+        stmt = Customer._credit_update(customer_id, amount)
+        try:
+            if db.engine.dialect.name == 'postgresql':
+                row = db.session.execute(stmt.returning(*table.c)).first()
+            else:
+                # No RETURNING: read the row back while this transaction
+                # still holds the row lock taken by the UPDATE
+                row = None
+                if db.session.execute(stmt).rowcount:
+                    query = select(table.c).where(table.c.id == customer_id)
+                    row = db.session.execute(query).first()
+            if row:
+                CreditEvent.record(db.session, [{'customer_id': customer_id, 'delta': amount,
+                                                 'credit_level': row.credit_level,
+                                                 'source': 'credit'}])
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        # after the commit, or a read racing with it could cache the old row
+        Customer.cache.delete(customer_id)
+        if not row:
+            return None
+        return dict((name, row[name]) for name in Customer.FIELDS)
+
+    @staticmethod
+    def apply_credit_deltas(deltas):
+        """ Changes the credit level of many Customers in one transaction
+
+        ``deltas`` maps Customer ids to the amount to add; each Customer
+        gets a single UPDATE, in id order so that concurrent flushes take
+        the row locks in the same order. The new levels are read back under
+        these locks for the credit history. Returns the ids of the Customers
+        that do not exist.
+        """
+        Customer.logger.info('Adjusting credit of %d Customers', len(deltas))
+        missing = []
+        try:
+            for customer_id in sorted(deltas):
+                stmt = Customer._credit_update(customer_id, deltas[customer_id])
+                if not db.session.execute(stmt).rowcount:
+                    missing.append(customer_id)
+            updated = [customer_id for customer_id in deltas if customer_id not in missing]
+            if updated:
+                rows = db.session.query(Customer.id, Customer.credit_level) \
+                    .filter(Customer.id.in_(updated))
+                CreditEvent.record(db.session, [{'customer_id': row.id,
+                                                 'delta': deltas[row.id],
+                                                 'credit_level': row.credit_level,
+                                                 'source': 'queue'} for row in rows])
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        for customer_id in deltas:
+            Customer.cache.delete(customer_id)
+        return missing
+
+    @staticmethod
+    def _credit_update(customer_id, amount):
+        """ Returns the UPDATE adding amount to the credit level of a Customer """
+        table = Customer.__table__
+        # a Customer updated without a credit level starts again from 0
+        credit_level = func.coalesce(table.c.credit_level, 0) + amount
+        # MySQL applies SET assignments left to right, so valid has to be
+        # computed before credit_level is overwritten
+        return table.update(preserve_parameter_order=True) \
+            .where(table.c.id == customer_id) \
+            .values([(table.c.valid, credit_level >= 0),
+                     (table.c.credit_level, credit_level)])
+
+    @staticmethod
+    def update_if_version(customer_id, data, version):
+        """ Updates a Customer only if it still has the given version
+
+        The version check and the write are a single UPDATE, so the
+        uncontended case costs one round trip. When the data holds the
+        valid status and credit_level the new Customer is known and is not
+        read back; the row is then locked first, so that a change of its
+        credit level can be added to the credit history. Raises
+        ConcurrentUpdateError if the Customer has another version and
+        returns None if there is no Customer with that id.
+        """
+        Customer.logger.info('Updating id %s if at version %s', customer_id, version)
+        customer = Customer().deserialize(data)
+        table = Customer.__table__
+        values = {'firstname': customer.firstname,
+                  'lastname': customer.lastname,
+                  'version': table.c.version + 1}
+        complete = customer.credit_level is not None
+        if complete:
+            values['valid'] = customer.valid
+            values['credit_level'] = customer.credit_level
+        stmt = table.update() \
+            .where(table.c.id == customer_id) \
+            .where(table.c.version == version) \
+            .values(**values)
+        row = None
+        try:
+            previous = None
+            if complete:
+                # take the row lock before writing: an INSERT ... SELECT of
+                # the old level would take a shared lock that the UPDATE has
+                # to upgrade, and two such updates deadlock on MySQL
+                query = select([table.c.version, table.c.credit_level]) \
+                    .where(table.c.id == customer_id).with_for_update()
+                previous = db.session.execute(query).first()
+            updated = db.session.execute(stmt).rowcount
+            if updated and previous is not None:
+                level = previous.credit_level or 0
+                if level != customer.credit_level:
+                    CreditEvent.record(db.session, [{'customer_id': customer_id,
+                                                     'delta': customer.credit_level - level,
+                                                     'credit_level': customer.credit_level,
+                                                     'source': 'update'}])
+            if not updated or not complete:
+                row = db.session.execute(select(table.c).where(table.c.id == customer_id)).first()
+            if updated:
+                db.session.commit()
+            else:
+                db.session.rollback()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        Customer.cache.delete(customer_id)
+        if not updated:
+            if row:
+                raise ConcurrentUpdateError('Customer {} is at version {}, not {}'
+                                            .format(customer_id, row.version, version))
+            return None
+        if row:
+            return dict((name, row[name]) for name in Customer.FIELDS)
+        return {'id': customer_id,
+                'firstname': customer.firstname,
+                'lastname': customer.lastname,
+                'valid': customer.valid,
+                'credit_level': customer.credit_level,
+                'version': version + 1}
+
     def save(self):
-        """ Saves an existing Customer in the database """
+        """ Saves an existing Customer in the database
+
+        Raises ConcurrentUpdateError if the Customer was changed since it
+        was loaded
+        """
         # if the id is None it hasn't been added to the database
-        if not self.id:
+        customer_id = self.id
+        if not customer_id:
             db.session.add(self)
-        db.session.commit()
+        self._commit()
+        if customer_id:
+            Customer.cache.delete(customer_id)
 
     def delete(self):
         """ Deletes a Customer from the database """
+        customer_id = self.id
         db.session.delete(self)
-        db.session.commit()
+        self._commit()
+        Customer.cache.delete(customer_id)
+
+    def _commit(self):
+        """ Commits the session, turning a failed version check into an error """
+        try:
+            db.session.commit()
+        except StaleDataError as error:
+            db.session.rollback()
+            Customer.cache.delete(self.id)
+            raise ConcurrentUpdateError(str(error))
 
     def serialize(self):
         """ Serializes a Customer into a dictionary """
@@ -93,7 +579,8 @@ class Customer(db.Model):
                 "firstname": self.firstname,
                 "lastname": self.lastname,
                 "valid": self.valid,
-                "credit_level": self.credit_level}
+                "credit_level": self.credit_level,
+                "version": self.version}
 
     def deserialize(self, data):
         """ deserializes a Customer my marshalling the data """
@@ -115,6 +602,185 @@ class Customer(db.Model):
         return self
 
 
+######################################################################
+#  B U L K   M E T H O D S
+######################################################################
+    @staticmethod
+    def bulk_save(records, chunk_size=None):
+        """ Creates, updates and deletes Customers in batches
+
+        Every record is validated with the deserialize rules and gets its
+        own result, so one bad record does not abort the whole batch.
+        A record with an ``op`` of ``delete`` removes the Customer with its
+        id, a record with an id updates that Customer and any other record
+        creates a new one. An update with a ``version`` is only applied if
+        the Customer still has that version. Each chunk of ``chunk_size``
+        records is written with multi-row statements and committed in a
+        single transaction; a chunk that fails is written again record by
+        record so that only the failing records are rejected. The results
+        of created records carry their new id.
+        """
+        if chunk_size is None:
+            chunk_size = app.config['CUSTOMER_BATCH_CHUNK_SIZE']
+        if chunk_size < 1:
+            raise DataValidationError('Invalid Query String: chunk_size must be positive')
+        Customer.logger.info('Processing batch of %s records', len(records))
+        results = []
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            results.extend(Customer._bulk_save_chunk(chunk, start))
+        return results
+
+    @staticmethod
+    def _bulk_save_chunk(records, offset):
+        """ Writes one chunk of a batch, row by row if the chunk fails """
+        results = [None] * len(records)
+        pending = {'create': [], 'update': [], 'delete': []}
+        for i, record in enumerate(records):
+            try:
+                op, mapping = Customer._bulk_mapping(record)
+                pending[op].append((i, mapping))
+            except DataValidationError as error:
+                results[i] = {'index': offset + i, 'status': 'invalid',
+                              'error': str(error)}
+
+        ids = [mapping['id'] for _, mapping in pending['update'] + pending['delete']]
+        versions = {}
+        credit_levels = {}
+        if ids:
+            rows = db.session.query(Customer.id, Customer.version, Customer.credit_level) \
+                .filter(Customer.id.in_(ids))
+            for row in rows:
+                versions[row.id] = row.version
+                credit_levels[row.id] = row.credit_level
+        for op in ('update', 'delete'):
+            found = []
+            for i, mapping in pending[op]:
+                if mapping['id'] not in versions:
+                    results[i] = {'index': offset + i, 'id': mapping['id'],
+                                  'status': 'not found'}
+                elif mapping.setdefault('version', versions[mapping['id']]) \
+                        != versions[mapping['id']]:
+                    results[i] = {'index': offset + i, 'id': mapping['id'],
+                                  'status': 'conflict'}
+                else:
+                    found.append((i, mapping))
+            pending[op] = found
+
+        try:
+            Customer._bulk_write(pending, credit_levels)
+            failures = {}
+        except SQLAlchemyError as error:
+            Customer.logger.warning('Batch chunk failed, retrying row by row: %s', error)
+            db.session.rollback()
+            failures = Customer._bulk_write_rows(pending, credit_levels)
+        outcome = {'create': 'created', 'update': 'updated', 'delete': 'deleted'}
+        for op, items in pending.items():
+            for i, mapping in items:
+                results[i] = {'index': offset + i, 'id': mapping.get('id'),
+                              'status': outcome[op]}
+                if i in failures:
+                    results[i].update(failures[i])
+        return results
+
+    @staticmethod
+    def _bulk_write(pending, credit_levels):
+        """ Writes the checked records of a chunk in a single transaction """
+        created = [dict(mapping) for _, mapping in pending['create']]
+        if created:
+            # return_defaults inserts the rows one at a time to read their ids
+            db.session.bulk_insert_mappings(Customer, created, return_defaults=True)
+        if pending['update']:
+            db.session.bulk_update_mappings(
+                Customer, [dict(mapping) for _, mapping in pending['update']])
+            # the updates only apply at the version the levels were read at
+            CreditEvent.record(db.session, [
+                {'customer_id': mapping['id'],
+                 'delta': mapping['credit_level'] - (credit_levels[mapping['id']] or 0),
+                 'credit_level': mapping['credit_level'], 'source': 'batch'}
+                for _, mapping in pending['update']
+                if mapping.get('credit_level', credit_levels[mapping['id']])
+                != credit_levels[mapping['id']]])
+        if pending['delete']:
+            delete_ids = [mapping['id'] for _, mapping in pending['delete']]
+            Customer.query.filter(Customer.id.in_(delete_ids)) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+        # only now, a chunk retried row by row must insert without the ids
+        for (_, mapping), row in zip(pending['create'], created):
+            mapping['id'] = row['id']
+        for _, mapping in pending['update'] + pending['delete']:
+            Customer.cache.delete(mapping['id'])
+
+    @staticmethod
+    def _bulk_write_rows(pending, credit_levels):
+        """ Writes the records of a failed chunk one by one
+
+        Only the records that fail again are rejected: an update that lost
+        the race with another one is a conflict, any other error fails the
+        record. Returns the status and error of those records by index.
+        """
+        failures = {}
+        for op in ('create', 'update', 'delete'):
+            for i, mapping in pending[op]:
+                single = {'create': [], 'update': [], 'delete': []}
+                single[op] = [(i, mapping)]
+                try:
+                    Customer._bulk_write(single, credit_levels)
+                except StaleDataError:
+                    db.session.rollback()
+                    failures[i] = {'status': 'conflict'}
+                except SQLAlchemyError as error:
+                    Customer.logger.error('Batch record %s failed: %s', i, error)
+                    db.session.rollback()
+                    failures[i] = {'status': 'failed', 'error': str(error)}
+        return failures
+
+    @staticmethod
+    def _bulk_mapping(record):
+        """ Validates a batch record and returns its operation and mapping """
+        if not isinstance(record, dict):
+            raise DataValidationError('Invalid Customer: record must be a JSON object')
+        op = record.get('op') or ('update' if record.get('id') else 'create')
+        if op not in ('create', 'update', 'delete'):
+            raise DataValidationError('Invalid Customer: unknown op ' + str(op))
+        mapping = {}
+        if op != 'create':
+            try:
+                mapping['id'] = int(record['id'])
+            except (KeyError, TypeError, ValueError):
+                raise DataValidationError('Invalid Customer: missing or bad id')
+            if record.get('version') is not None:
+                try:
+                    mapping['version'] = int(record['version'])
+                except (TypeError, ValueError):
+                    raise DataValidationError('Invalid Customer: bad version')
+        if op == 'delete':
+            return op, mapping
+        customer = Customer().deserialize(record)
+        mapping['firstname'] = customer.firstname
+        mapping['lastname'] = customer.lastname
+        Customer.check_lengths(mapping)
+        if customer.credit_level is not None:
+            mapping['valid'] = customer.valid
+            mapping['credit_level'] = customer.credit_level
+        elif op == 'create':
+            mapping['valid'] = True
+            mapping['credit_level'] = 0
+        return op, mapping
+
+    @staticmethod
+    def check_lengths(mapping):
+        """ Rejects names longer than their columns
+
+        Strict databases would fail the whole statement they are written in
+        """
+        for name in ('firstname', 'lastname'):
+            length = Customer.__table__.c[name].type.length
+            if mapping.get(name) is not None and len(mapping[name]) > length:
+                raise DataValidationError('Invalid Customer: {} is longer than {} '
+                                          'characters'.format(name, length))
+
 ######################################################################
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
@@ -125,12 +791,15 @@ class Customer(db.Model):
         # import pdb; pdb.set_trace()
         uri = app.config['SQLALCHEMY_DATABASE_URI']
         Customer.logger.info('Database URI {}'.format(uri))
+        Customer.cache.clear()
         try:
             Customer.logger.info("Creating database tables")
             if reset:
                 Customer.logger.info('Dropping old tables')
                 db.drop_all()
             db.create_all()
+            Customer.create_columns()
+            Customer.create_indexes()
         except Exception as error:
             Customer.logger.error('Oops, got error {}'.format(error.message))
             # Parse the URI for user, password, host
@@ -145,11 +814,41 @@ class Customer(db.Model):
                 conn.cursor().execute('create database IF NOT EXISTS {}'.format(dbname))
                 Customer.logger.info("Creating database tables")
                 db.create_all()
+                Customer.create_columns()
+                Customer.create_indexes()
             except Exception as error:
                 Customer.logger.error('reconnect database fail! got error {}'.format(error.message))
                 raise DatabaseConnectionError('Could not connect to the clients MySQL Service')
 
     @staticmethod
+    def create_columns():
+        """ Adds the Customer columns missing from an existing table """
+        table = Customer.__table__
+        dialect = db.engine.dialect
+        existing = set(column['name'] for column in inspect(db.engine).get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            Customer.logger.info('Adding column %s', column.name)
+            ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name, column.name, column.type.compile(dialect=dialect))
+            if column.server_default is not None:
+                ddl += ' DEFAULT {}'.format(column.server_default.arg)
+            db.engine.execute(ddl)
+
+    @staticmethod
+    def create_indexes():
+        """ Creates the Customer indexes missing from an existing table """
+        table = Customer.__table__
+        existing = set(index['name'] for index in inspect(db.engine).get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                Customer.logger.info('Creating index %s', index.name)
+                index.create(bind=db.engine)
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
     def all():
         """ Query that returns all Customers """
         Customer.logger.info('Processing all Customers')
@@ -161,26 +860,565 @@ class Customer(db.Model):
         Customer.logger.info('Removing all Customers')
         Customer.query.delete()
         db.session.commit()
+        Customer.cache.clear()
 
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
     @staticmethod
+    def coalesce(key, function, *args):
+        """ Shares a read with the identical ones running in this process
+
+        Concurrent callers of the same key wait for the first one and get
+        its result instead of querying the database again. A session that
+        has written reads on its own, so it always sees its own writes.
+        """
+        session = db.session
+        if not app.config['COALESCE_READS'] or session.info.get('written') or \
+                session.new or session.dirty or session.deleted:
+            return function(*args)
+        return Customer.reads.do(key, function, *args)
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
     def find(customer_id):
         """ Query that finds Customers by their id """
         Customer.logger.info('Processing lookup for id %s ...', customer_id)
         return Customer.query.get(customer_id)
 
     @staticmethod
-    def find_by_kargs(args):
-        """ Query that finds Customers by their lastname """
+    @retry_on_disconnect
+    def find_on_primary(customer_id):
+        """ Finds a Customer by its id on the primary, to be changed
+
+        Reads that come before a write must not see a replica that lags
+        behind, since the write would work on an old version of the row
+        """
+        Customer.logger.info('Processing lookup for id %s on the primary ...', customer_id)
+        return Customer.query.populate_existing().get(customer_id)
+
+    @staticmethod
+    def find_serialized(customer_id):
+        """ Returns a serialized Customer by id through the cache
+
+        Writes invalidate the cached Customer, and the cache time to live
+        bounds how long a read racing with a write can stay stale. Next to
+        the serialized fields the entry holds ``updated_at`` in seconds
+        since the epoch for the Last-Modified header.
+        """
+        data = Customer.cache.get(customer_id)
+        if data is not None:
+            return data
+        data = Customer.coalesce(('find', customer_id), Customer._load_serialized, customer_id)
+        return dict(data) if data is not None else None
+
+    @staticmethod
+    def _load_serialized(customer_id):
+        customer = Customer.find(customer_id)
+        if not customer:
+            return None
+        data = customer.serialize()
+        data['updated_at'] = Customer.timestamp(customer.updated_at)
+        Customer.cache.set(customer_id, data)
+        return data
+
+    @staticmethod
+    def find_by_kargs(args, fields=None, validators=False):
+        """ Query that finds Customers by their lastname
+
+        When ``fields`` is given only those columns (and the id) are
+        selected and light weight rows are returned instead of Customers.
+        Rows are immutable, so identical queries running at once share
+        them; Customers belong to the session of their caller and are not
+        shared. With ``validators`` the rows also carry ``_version`` and
+        ``_updated_at`` for ``rows_version``.
+        """
+        if fields is None:
+            return Customer._find_by_kargs(args, fields)
+        key = ('find_by_kargs', tuple(sorted(args.items())), tuple(fields), validators)
+        return list(Customer.coalesce(key, Customer._find_by_kargs, args, fields, validators))
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
+    def _find_by_kargs(args, fields, validators=False):
         Customer.logger.info('Processing name query for %s ...', str(args))
-        if len(args) == 0:
+        if len(args) == 0 and fields is None:
             return Customer.all()
-        q = Customer.query
-        try:
-            for attr, value in args.items():
-                q = q.filter(getattr(Customer, attr) == value)
-            return q.all()
-        except AttributeError as error:
-            raise DataValidationError('Invalid Query String:' + str(args))
+        q = Customer.query_by_kargs(args, fields)
+        if validators:
+            q = q.add_columns(Customer.version.label('_version'),
+                              Customer.updated_at.label('_updated_at'))
+        return q.all()
+
+    @staticmethod
+    def query_by_kargs(args, fields=None):
+        """ Builds the Customer query for the given query string filters
+
+        Only the columns of the Customer can be filtered on and every value
+        is coerced to the type of its column, so that it binds with the
+        right type and the indexes on the column can be used
+        """
+        if fields is None:
+            q = Customer.query
+        else:
+            q = db.session.query(*Customer.columns(fields))
+        columns = []
+        for key, value in args.items():
+            if key in ('sort', 'order'):
+                continue
+            attr, _, op = key.partition('__')
+            if attr not in Customer.FILTERS:
+                raise DataValidationError('Invalid Query String:' + str(args))
+            q = q.filter(Customer._predicate(attr, op or 'eq', value))
+            columns.append(attr)
+        Customer._check_indexed(columns)
+        if 'sort' in args or 'order' in args:
+            q = q.order_by(*Customer._sort_order(args))
+        return q
+
+    @staticmethod
+    def _predicate(attr, op, value):
+        """ Builds the SQL predicate of a single query string filter
+
+        Supports the comparisons in COMPARATORS plus ``in`` and ``between``
+        with comma separated values and ``prefix`` for string columns
+        """
+        column = getattr(Customer, attr)
+        coerce = Customer.FILTERS[attr]
+        if op in ('in', 'between'):
+            if isinstance(value, basestring):
+                value = value.split(',')
+            values = [coerce(attr, item) for item in value]
+            if op == 'in':
+                return column.in_(values)
+            if len(values) != 2:
+                raise DataValidationError('Invalid Query String: {}__between needs '
+                                          'two values'.format(attr))
+            return column.between(*values)
+        if op == 'prefix':
+            if coerce is not coerce_string:
+                raise DataValidationError('Invalid Query String: {} does not support '
+                                          'prefix'.format(attr))
+            return column.like(escape_like(value) + '%', escape='\\')
+        if op not in COMPARATORS:
+            raise DataValidationError('Invalid Query String: unknown operator ' + op)
+        return COMPARATORS[op](column, coerce(attr, value))
+
+    @staticmethod
+    def _sort_order(args):
+        """ Returns the ORDER BY clauses for the sort and order parameters """
+        attr = args.get('sort', 'id')
+        order = args.get('order', 'asc')
+        if attr not in Customer.FILTERS or order not in ('asc', 'desc'):
+            raise DataValidationError('Invalid Query String: bad sort or order')
+        column = getattr(Customer, attr)
+        clauses = [column.desc() if order == 'desc' else column.asc()]
+        if attr != 'id':
+            clauses.append(Customer.id)
+        return clauses
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
+    def count(args):
+        """ Returns the number of Customers matching the query string filters """
+        Customer.logger.info('Processing count query for %s ...', str(args))
+        q = Customer._aggregate_query(args, func.count(Customer.id))
+        return q.scalar()
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
+    def stats(args, bucket_size=10):
+        """ Computes statistics of the Customers matching the filters
+
+        Everything is aggregated by the database: the count per valid
+        status, min/max/avg of the credit_level and a histogram of the
+        credit_level in buckets of ``bucket_size``. Customers without a
+        credit_level are counted but left out of the histogram.
+        """
+        Customer.logger.info('Processing stats query for %s ...', str(args))
+        if bucket_size < 1:
+            raise DataValidationError('Invalid Query String: bucket_size must be positive')
+        level = Customer.credit_level
+        count, low, high, avg = Customer._aggregate_query(
+            args, func.count(Customer.id), func.min(level),
+            func.max(level), func.avg(level)).one()
+        by_valid = Customer._aggregate_query(args, Customer.valid, func.count(Customer.id)) \
+            .group_by(Customer.valid).all()
+        # floor to the bucket with a modulo that is non-negative on every backend
+        bucket = (level - ((level % bucket_size) + bucket_size) % bucket_size).label('bucket')
+        buckets = Customer._aggregate_query(args, bucket, func.count(Customer.id)) \
+            .filter(level.isnot(None)).group_by(bucket).order_by(bucket).all()
+        return {'count': count,
+                'valid': dict((str(valid).lower(), total) for valid, total in by_valid),
+                'credit_level': {'min': low, 'max': high,
+                                 'avg': float(avg) if avg is not None else None},
+                'bucket_size': bucket_size,
+                'histogram': [{'from': start, 'to': start + bucket_size - 1, 'count': total}
+                              for start, total in buckets]}
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
+    def collection_version(args):
+        """ Returns what changes when the Customers matching the filters change
+
+        The count catches inserts and deletes, the latest updated_at and the
+        sum of the versions catch updates. Returns (count, updated_at, versions)
+        with updated_at in seconds since the epoch.
+        """
+        count, updated_at, versions = Customer._aggregate_query(
+            args, func.count(Customer.id), func.max(Customer.updated_at),
+            func.sum(Customer.version)).one()
+        return int(count), Customer.timestamp(updated_at), int(versions or 0)
+
+    @staticmethod
+    def rows_version(rows):
+        """ Returns the collection_version of rows loaded with validators
+
+        It is the same as the database computes, from the rows a list has
+        loaded anyway
+        """
+        updated = [row._updated_at for row in rows if row._updated_at is not None]
+        return (len(rows), Customer.timestamp(max(updated)) if updated else None,
+                sum(row._version or 0 for row in rows))
+
+    @staticmethod
+    def timestamp(value):
+        """ Converts a UTC datetime to whole seconds since the epoch """
+        if value is None:
+            return None
+        return calendar.timegm(value.utctimetuple())
+
+    @staticmethod
+    def _aggregate_query(args, *entities):
+        """ Builds a query of aggregates over the filtered Customers """
+        args = dict((key, value) for key, value in args.items()
+                    if key not in ('sort', 'order'))
+        return Customer.query_by_kargs(args).with_entities(*entities)
+
+    @staticmethod
+    def columns(fields):
+        """ Returns the table columns for a list of field names
+
+        The id is always included since it identifies the Customer
+        """
+        unknown = set(fields) - set(Customer.FIELDS)
+        if unknown:
+            raise DataValidationError('Invalid fields: ' + ', '.join(sorted(unknown)))
+        return [Customer.__table__.c[name] for name in Customer.FIELDS
+                if name == 'id' or name in fields]
+
+    @staticmethod
+    def _check_indexed(columns):
+        """ Logs queries whose filters cannot use any index """
+        if not columns:
+            return
+        indexed = set(col.name for col in Customer.__table__.primary_key.columns)
+        for index in Customer.__table__.indexes:
+            indexed.add(list(index.columns)[0].name)
+        if not indexed.intersection(columns):
+            Customer.logger.warning('Slow query: no index can be used to filter on %s',
+                                    ', '.join(sorted(columns)))
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
+    def find_page(args, limit, after=None, fields=None):
+        """ Query that returns one page of Customers ordered by id
+
+        Uses keyset pagination: only Customers with an id greater
+        than ``after`` are returned, so the cost of a page does not
+        depend on how deep into the table it is
+        """
+        Customer.logger.info('Processing page query for %s after %s ...', str(args), after)
+        if 'sort' in args or 'order' in args:
+            raise DataValidationError('Invalid Query String: sort and order cannot '
+                                      'be used with paging or streaming')
+        q = Customer.query_by_kargs(args, fields)
+        if after is not None:
+            q = q.filter(Customer.id > after)
+        return q.order_by(Customer.id).limit(limit).all()
+
+    @staticmethod
+    def export(args, since=None, fields=None, chunk_size=None):
+        """ Returns a generator of the matching Customer rows ordered by id
+
+        The query is built, and the filters validated, before the first
+        row is asked for. The rows come from a server side cursor where the
+        driver has one and are fetched ``chunk_size`` at a time, so the
+        memory used does not grow with the export. ``since`` only exports
+        the Customers updated at or after that UTC datetime.
+        """
+        chunk_size = chunk_size or app.config['CUSTOMER_EXPORT_CHUNK_SIZE']
+        Customer.logger.info('Processing export of %s since %s ...', str(args), since)
+        if 'sort' in args or 'order' in args:
+            raise DataValidationError('Invalid Query String: sort and order cannot '
+                                      'be used with an export')
+        q = Customer.query_by_kargs(args, fields or Customer.FIELDS)
+        if since is not None:
+            q = q.filter(Customer.updated_at >= since)
+        q = q.order_by(Customer.id).execution_options(stream_results=True)
+        return Customer._stream(q.yield_per(chunk_size))
+
+    @staticmethod
+    @read_from_replica
+    def _stream(query):
+        """ Generator that yields the rows of a query """
+        for row in query:
+            yield row
+
+    @staticmethod
+    def iter_by_kargs(args, chunk_size=None, fields=None):
+        """ Returns a generator of all matching Customers chunk by chunk
+
+        The first chunk is loaded, and the filters validated, before the
+        generator is returned. Only ``chunk_size`` rows are held in memory
+        at any time
+        """
+        chunk_size = chunk_size or app.config['CUSTOMER_CHUNK_SIZE']
+        customers = Customer.find_page(args, chunk_size, None, fields)
+        return Customer._iter_pages(args, chunk_size, fields, customers)
+
+    @staticmethod
+    def _iter_pages(args, chunk_size, fields, customers):
+        """ Generator that yields the Customers of a page and the next ones """
+        while True:
+            for customer in customers:
+                yield customer
+            if len(customers) < chunk_size:
+                return
+            customers = Customer.find_page(args, chunk_size, customers[-1].id, fields)
+
+
+######################################################################
+#  C R E D I T   H I S T O R Y
+######################################################################
+class CreditEvent(db.Model):
+    """ A change of the credit level of a Customer
+
+    Events are only ever appended, in the transaction of the change they
+    record, and are kept when their Customer is deleted. Each one holds
+    the level the change led to, so the level at any time is the one of
+    the last event before it: a single lookup in the (customer_id, ts)
+    index, however long the history. The creation of a Customer is not
+    an event, its first level is the one before its first event.
+    """
+    logger = logging.getLogger(__name__)
+
+    __tablename__ = 'customer_credit_events'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, nullable=False)
+    ts = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    delta = db.Column(db.Integer, nullable=False)
+    credit_level = db.Column(db.Integer, nullable=False)
+    # credit (the credit actions), queue, update or batch
+    source = db.Column(db.String(16), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_customer_credit_events_customer_id_ts', 'customer_id', 'ts'),
+    )
+
+    def __repr__(self):
+        return '<CreditEvent %d of customer %d>' % (self.id, self.customer_id)
+
+    def serialize(self):
+        """ Serializes a CreditEvent into a dictionary """
+        return {'id': self.id,
+                'customer_id': self.customer_id,
+                'ts': self.ts.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'delta': self.delta,
+                'credit_level': self.credit_level,
+                'valid': self.credit_level >= 0,
+                'source': self.source}
+
+    @staticmethod
+    def record(connection, events):
+        """ Appends events, given as dicts, through a session or connection """
+        if not events:
+            return
+        now = datetime.utcnow()
+        for item in events:
+            item.setdefault('ts', now)
+        connection.execute(CreditEvent.__table__.insert(), events)
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
+    def history(customer_id, start=None, end=None, limit=100, after=None):
+        """ Returns a page of the credit events of a Customer, oldest first
+
+        ``start`` is inclusive and ``end`` exclusive. The pages are read in
+        (ts, id) order from the index; ``after`` is the id of the last
+        event of the previous page.
+        """
+        query = CreditEvent.query.filter(CreditEvent.customer_id == customer_id)
+        if start is not None:
+            query = query.filter(CreditEvent.ts >= start)
+        if end is not None:
+            query = query.filter(CreditEvent.ts < end)
+        if after is not None:
+            ts = db.session.query(CreditEvent.ts) \
+                .filter(CreditEvent.id == after, CreditEvent.customer_id == customer_id).scalar()
+            if ts is None:
+                raise DataValidationError('Invalid Query String: after is not an event '
+                                          'of this Customer')
+            query = query.filter(or_(CreditEvent.ts > ts,
+                                     and_(CreditEvent.ts == ts, CreditEvent.id > after)))
+        return query.order_by(CreditEvent.ts, CreditEvent.id).limit(limit).all()
+
+    @staticmethod
+    @retry_on_disconnect
+    @read_from_replica
+    def level_at(customer_id, at):
+        """ Returns the credit level of a Customer at a time
+
+        That is the level of its last event up to then or, before its
+        first event, the level that event started from. A Customer
+        without events since then still has its current level, None is
+        returned if there is no such Customer.
+        """
+        query = CreditEvent.query.filter(CreditEvent.customer_id == customer_id)
+        event = query.filter(CreditEvent.ts <= at) \
+            .order_by(CreditEvent.ts.desc(), CreditEvent.id.desc()).first()
+        if event:
+            return event.credit_level
+        event = query.filter(CreditEvent.ts > at) \
+            .order_by(CreditEvent.ts, CreditEvent.id).first()
+        if event:
+            return event.credit_level - event.delta
+        level = db.session.query(Customer.credit_level) \
+            .filter(Customer.id == customer_id).first()
+        if level is None:
+            return None
+        return level.credit_level or 0
+
+
+@event.listens_for(Customer, 'before_update')
+def record_credit_change(mapper, connection, target):
+    """ Records the credit level changes saved through the ORM
+
+    Runs in the flush, so the event commits or rolls back with the
+    version checked UPDATE that follows.
+    """
+    history = inspect(target).attrs.credit_level.history
+    if not history.added:
+        return
+    if history.deleted:
+        previous = history.deleted[0]
+    else:
+        table = Customer.__table__
+        previous = connection.execute(select([table.c.credit_level])
+                                      .where(table.c.id == target.id)).scalar()
+    level = target.credit_level or 0
+    if level != (previous or 0):
+        CreditEvent.record(connection, [{'customer_id': target.id,
+                                         'delta': level - (previous or 0),
+                                         'credit_level': level, 'source': 'update'}])
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y S
+######################################################################
+class IdempotencyKey(db.Model):
+    """ The first response to a request made with an Idempotency-Key
+
+    A request claims its key by inserting it with no status, so that a
+    concurrent retry finds it in progress, and stores its response when
+    it succeeds. Keys expire IDEMPOTENCY_TTL seconds after the response,
+    or IDEMPOTENCY_LOCK_SECONDS after the claim when the response never
+    comes; an expired key is free again.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Keys longer than this are refused
+    MAX_LENGTH = 128
+
+    __tablename__ = 'idempotency_key'
+    key = db.Column(db.String(MAX_LENGTH), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    # When this process last purged the expired keys
+    purged_at = 0
+
+    def __repr__(self):
+        return '<IdempotencyKey %r>' % (self.key)
+
+    def response(self):
+        """ Returns the stored data and status """
+        return json.loads(self.body), self.status
+
+    @staticmethod
+    def claim(key, fingerprint):
+        """ Claims a key for a new request
+
+        Returns None when the key was free, else the IdempotencyKey of the
+        request that holds it
+        """
+        IdempotencyKey.purge()
+        table = IdempotencyKey.__table__
+        while True:
+            now = datetime.utcnow()
+            claim = {'key': key, 'fingerprint': fingerprint, 'status': None, 'body': None,
+                     'created_at': now,
+                     'expires_at': now + timedelta(seconds=app.config['IDEMPOTENCY_LOCK_SECONDS'])}
+            # a retry finds its key with one primary key lookup
+            held = IdempotencyKey.query.get(key)
+            if held is None:
+                try:
+                    db.session.execute(table.insert().values(claim))
+                    db.session.commit()
+                    return None
+                except IntegrityError:
+                    # claimed by a concurrent request since the lookup
+                    db.session.rollback()
+                    continue
+            if held.expires_at > now:
+                return held
+            # take over an expired key, unless another request just did
+            stmt = table.update().where(table.c.key == key) \
+                .where(table.c.expires_at == held.expires_at).values(claim)
+            taken = db.session.execute(stmt).rowcount
+            db.session.commit()
+            if taken:
+                return None
+
+    @staticmethod
+    def complete(key, status, data):
+        """ Stores the status and body of the response to the request that claimed a key """
+        table = IdempotencyKey.__table__
+        expires_at = datetime.utcnow() + timedelta(seconds=app.config['IDEMPOTENCY_TTL'])
+        stmt = table.update().where(table.c.key == key) \
+            .values(status=status, body=json.dumps(data), expires_at=expires_at)
+        db.session.execute(stmt)
+        db.session.commit()
+
+    @staticmethod
+    def release(key):
+        """ Frees a key whose request failed so that a retry runs it again """
+        db.session.rollback()
+        table = IdempotencyKey.__table__
+        db.session.execute(table.delete().where(table.c.key == key)
+                           .where(table.c.status.is_(None)))
+        db.session.commit()
+
+    @staticmethod
+    def purge():
+        """ Deletes the expired keys, at most every IDEMPOTENCY_PURGE_SECONDS """
+        now = time.time()
+        if now - IdempotencyKey.purged_at < app.config['IDEMPOTENCY_PURGE_SECONDS']:
+            return
+        IdempotencyKey.purged_at = now
+        table = IdempotencyKey.__table__
+        deleted = db.session.execute(table.delete()
+                                     .where(table.c.expires_at <= datetime.utcnow())).rowcount
+        db.session.commit()
+        if deleted:
+            IdempotencyKey.logger.info('Purged %d expired idempotency keys', deleted)
@@ -0,0 +1,419 @@
+# Copyright NYU-DevOps-Alpha team-customer. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Customer name search
+
+Finds Customers by partial or misspelled names. With SEARCH_INDEX set to
+database, the default, the database searches the names: by their
+trigrams with the pg_trgm index on PostgreSQL, by the start of their
+words on the other databases.
+
+With SEARCH_INDEX set to memory every process keeps a trigram index of
+the names instead, which finds misspelled names on any database but
+takes memory in every worker. The index is loaded from the table on the
+first search and kept up to date incrementally: the ORM writes of this
+process update it once they are committed, and before each search the
+rows updated since the last look (by any process, bulk or import) are
+read back through the index on updated_at. Deletes made by other
+processes are dropped when the index is rebuilt every
+SEARCH_REBUILD_SECONDS. The table is read without holding the lock of
+the index, so searches go on during a rebuild.
+"""
+import math
+import time
+import logging
+import threading
+import unicodedata
+from array import array
+from datetime import datetime, timedelta
+from sqlalchemy import event, func, text, literal_column, select, or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, object_session
+from app import app, db
+from app.models import Customer, retry_on_disconnect, read_from_replica
+
+logger = logging.getLogger(__name__)
+
+######################################################################
+#  T R I G R A M S
+######################################################################
+def normalize(text):
+    """ Returns the lower case words of a text without accents """
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(char if char.isalnum() else u' ' for char in text
+                    if not unicodedata.combining(char))
+    return text.lower().split()
+
+def trigrams(word):
+    """ Returns the trigrams of a word padded like pg_trgm does """
+    padded = u'  ' + word + u' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def word_similarity(query_word, query_grams, word, grams):
+    """ Scores a name word against a query word between 0 and 1
+
+    The trigram Jaccard similarity, raised for a word that starts with
+    the query word so that partial names rank high
+    """
+    shared = len(query_grams & grams)
+    score = float(shared) / (len(query_grams) + len(grams) - shared)
+    if word.startswith(query_word):
+        score = max(score, 0.8 + 0.2 * len(query_word) / len(word))
+    return score
+
+
+######################################################################
+#  T R I G R A M   I N D E X
+######################################################################
+class TrigramIndex(object):
+    """ Trigram index of names, searched by similarity
+
+    The trigrams index the distinct words of the names, which are far
+    fewer than the names, and every word lists the keys whose name holds
+    it. These lists are append only: a changed or removed name leaves
+    stale keys behind, which are skipped since every key is checked
+    against its current name, and cleared by compact().
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._words = {}
+        self._keys = {}
+        self._grams = {}
+        self._stale = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, key, *names):
+        """ Indexes or re-indexes the names of a key """
+        words = [word for name in names for word in normalize(name)]
+        with self._lock:
+            # the names share the strings of the words to save memory
+            words = tuple(self._words.get(word, (word,))[0] for word in words)
+            previous = self._names.get(key)
+            if previous == words:
+                return
+            if previous is not None:
+                self._stale += 1
+            self._names[key] = words
+            for word in set(words):
+                self._add_word(word, key)
+
+    def _add_word(self, word, key):
+        keys = self._keys.get(word)
+        if keys is None:
+            keys = self._keys[word] = array('l')
+            grams = frozenset(trigrams(word))
+            self._words[word] = (word, grams)
+            for gram in grams:
+                self._grams.setdefault(gram, []).append(word)
+        keys.append(key)
+
+    def remove(self, key):
+        """ Removes a key from the index """
+        with self._lock:
+            if self._names.pop(key, None) is not None:
+                self._stale += 1
+
+    def replace(self, other):
+        """ Takes over the names of another index at once """
+        with self._lock:
+            self._names = other._names
+            self._words = other._words
+            self._keys = other._keys
+            self._grams = other._grams
+            self._stale = other._stale
+
+    def clear(self):
+        """ Empties the index """
+        with self._lock:
+            self._names = {}
+            self._words = {}
+            self._keys = {}
+            self._grams = {}
+            self._stale = 0
+
+    def compact(self):
+        """ Rebuilds the word lists without the stale keys """
+        with self._lock:
+            names = self._names
+            self.clear()
+            for key in sorted(names):
+                words = self._names[key] = names[key]
+                for word in set(words):
+                    self._add_word(word, key)
+
+    def match_words(self, query_word, threshold=0.3):
+        """ Returns the score of the indexed words similar to a query word
+
+        Only the words in the rarest trigrams of the query word are
+        scored: a word sharing fewer than threshold of its trigrams
+        cannot reach the threshold.
+        """
+        grams = trigrams(query_word)
+        needed = max(int(math.ceil(threshold * len(grams))), 1)
+        postings = sorted((self._grams.get(gram, ()) for gram in grams), key=len)
+        candidates = set()
+        for words in postings[:len(grams) - needed + 1]:
+            candidates.update(words)
+        matches = {}
+        for word in candidates:
+            score = word_similarity(query_word, grams, word, self._words[word][1])
+            if score >= threshold:
+                matches[word] = score
+        return matches
+
+    def search(self, query, limit=20, threshold=0.3):
+        """ Returns the (key, score) of the best matches of a query
+
+        A name matches when each query word is similar to one of its
+        words, and scores the mean of these similarities.
+        """
+        query_words = normalize(query)
+        if not query_words:
+            return []
+        with self._lock:
+            if self._stale > len(self._names) // 2 + 1000:
+                self.compact()
+            matches = [self.match_words(word, threshold) for word in query_words]
+            if not all(matches):
+                return []
+            if len(matches) == 1:
+                results = self._best_keys(matches[0], limit)
+            else:
+                results = self._common_keys(matches)
+        return sorted(results.items(), key=lambda result: (-result[1], result[0]))[:limit]
+
+    def _best_keys(self, matches, limit):
+        """ Scores the keys of the best matching words until limit
+
+        A key scores its best word, so it is met first in that word
+        """
+        results = {}
+        for word, _ in sorted(matches.items(), key=lambda item: (-item[1], item[0])):
+            for key in self._keys[word]:
+                words = self._names.get(key)
+                if key in results or not words or word not in words:
+                    continue
+                results[key] = max(matches.get(name_word, 0) for name_word in words)
+                if len(results) >= limit:
+                    return results
+        return results
+
+    def _common_keys(self, matches):
+        """ Scores the keys having a matching word for every query word """
+        keys = sorted((set().union(*(self._keys[word] for word in scored))
+                       for scored in matches), key=len)
+        results = {}
+        for key in keys[0].intersection(*keys[1:]):
+            words = self._names.get(key)
+            if not words:
+                continue
+            scores = [max(scored.get(name_word, 0) for name_word in words) for scored in matches]
+            if all(scores):
+                results[key] = sum(scores) / len(scores)
+        return results
+
+
+######################################################################
+#  C U S T O M E R   I N D E X
+######################################################################
+class CustomerIndex(TrigramIndex):
+    """ Trigram index of the Customer names kept in step with the table
+
+    One thread at a time reads the table, without holding the lock of the
+    index: a rebuild fills a new index that is then swapped in. The other
+    threads search what is indexed meanwhile, only the first load is
+    waited for.
+    """
+
+    def __init__(self):
+        super(CustomerIndex, self).__init__()
+        self.loaded_at = None
+        self.refreshed_at = 0
+        self.watermark = None
+        self._reading = threading.Lock()
+
+    def refresh(self):
+        """ Loads the index or catches up with the rows updated since """
+        if not self._reading.acquire(self.loaded_at is None):
+            return
+        try:
+            config = app.config
+            now = time.time()
+            if self.loaded_at is None or now - self.loaded_at >= config['SEARCH_REBUILD_SECONDS']:
+                self.load()
+            elif now - self.refreshed_at >= config['SEARCH_REFRESH_SECONDS']:
+                lag = timedelta(seconds=config['SEARCH_REFRESH_LAG'])
+                self.refreshed_at = now
+                self.watermark = self._read(self, Customer.updated_at >= self.watermark - lag,
+                                            self.watermark)
+        finally:
+            self._reading.release()
+
+    def load(self):
+        """ Builds a new index from the whole table and swaps it in """
+        start = time.time()
+        started = datetime.utcnow()
+        index = TrigramIndex()
+        watermark = self._read(index, None, None)
+        with self._lock:
+            self.replace(index)
+            # the writes committed during the load are read again by the
+            # next refresh, with the ones made before any row had updated_at
+            self.watermark = started if watermark is None else min(watermark, started)
+            self.loaded_at = self.refreshed_at = time.time()
+        logger.info('Indexed %d Customer names in %.2fs', len(index), time.time() - start)
+
+    @staticmethod
+    def _read(index, criterion, watermark):
+        """ Indexes the rows matching a criterion
+
+        Returns the watermark moved to the latest updated_at read
+        """
+        query = db.session.query(Customer.id, Customer.firstname, Customer.lastname,
+                                 Customer.updated_at)
+        if criterion is not None:
+            query = query.filter(criterion)
+        query = query.order_by(Customer.id)
+        for row in query.yield_per(app.config['CUSTOMER_EXPORT_CHUNK_SIZE']):
+            index.add(row.id, row.firstname, row.lastname)
+            if row.updated_at and (watermark is None or row.updated_at > watermark):
+                watermark = row.updated_at
+        return watermark
+
+    def reset(self):
+        """ Forgets the index, it is loaded again by the next search """
+        with self._lock:
+            self.clear()
+            self.loaded_at = None
+            self.watermark = None
+
+
+customer_index = CustomerIndex()
+
+@event.listens_for(Customer, 'after_insert')
+@event.listens_for(Customer, 'after_update')
+def index_customer(mapper, connection, target):
+    """ Indexes a Customer written by the ORM once it is committed """
+    if app.config['SEARCH_INDEX'] == 'memory':
+        pending_changes(target).append((target.id, (target.firstname, target.lastname)))
+
+@event.listens_for(Customer, 'after_delete')
+def unindex_customer(mapper, connection, target):
+    if app.config['SEARCH_INDEX'] == 'memory':
+        pending_changes(target).append((target.id, None))
+
+def pending_changes(target):
+    """ Returns the index changes waiting for the commit of a session """
+    return object_session(target).info.setdefault('search_index_changes', [])
+
+@event.listens_for(Session, 'after_commit')
+def apply_changes(session):
+    """ Applies the index changes of a committed transaction, in order """
+    changes = session.info.pop('search_index_changes', None)
+    for key, names in changes or []:
+        if names is None:
+            customer_index.remove(key)
+        elif customer_index.loaded_at is not None:
+            customer_index.add(key, *names)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    """ Forgets the index changes of a transaction that was rolled back """
+    session.info.pop('search_index_changes', None)
+
+
+######################################################################
+#  D A T A B A S E   S E A R C H
+######################################################################
+# The name searched by pg_trgm, the expression of its index
+FULL_NAME = "coalesce(firstname, '') || ' ' || coalesce(lastname, '')"
+
+def create_trigram_index():
+    """ Creates the pg_trgm index of the Customer names on PostgreSQL """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    try:
+        with db.engine.begin() as connection:
+            connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_customer_name_trgm ON customer '
+                               'USING gin (({}) gin_trgm_ops)'.format(FULL_NAME))
+    except SQLAlchemyError as error:
+        logger.error('Could not create the trigram index of the names: %s', error)
+
+def like_prefix(word):
+    """ Returns the LIKE pattern of the strings starting with a word """
+    return word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+@retry_on_disconnect
+@read_from_replica
+def search_database(query, limit, threshold):
+    """ Returns the serialized Customers best matching a query, searched by the database
+
+    PostgreSQL ranks the names by the pg_trgm word similarity of the query,
+    through the trigram index. Other databases find the names with a word
+    starting with each query word, which are ranked like the in-process
+    index does; misspelled names are not found there.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        # the threshold of the <% operator, for this transaction only
+        db.session.execute(select([func.set_config('pg_trgm.word_similarity_threshold',
+                                                   str(threshold), True)]))
+        score = func.word_similarity(query, literal_column(FULL_NAME)).label('score')
+        rows = db.session.query(Customer, score) \
+            .filter(text(':query <% ({})'.format(FULL_NAME)).bindparams(query=query)) \
+            .order_by(score.desc(), Customer.id).limit(limit)
+        return [dict(customer.serialize(), score=round(value, 3)) for customer, value in rows]
+    criteria = [or_(Customer.firstname.like(like_prefix(word), escape='\\'),
+                    Customer.lastname.like(like_prefix(word), escape='\\'))
+                for word in query.split()]
+    candidates = Customer.query.filter(*criteria).order_by(Customer.id).limit(limit * 10).all()
+    index = TrigramIndex()
+    for customer in candidates:
+        index.add(customer.id, customer.firstname, customer.lastname)
+    customers = dict((customer.id, customer) for customer in candidates)
+    return [dict(customers[key].serialize(), score=round(score, 3))
+            for key, score in index.search(query, limit, threshold)]
+
+
+def search_customers(query, limit=20):
+    """ Returns the serialized Customers best matching a query with their score
+
+    With the in-process index, the ranking comes from the index and the
+    Customers from the database
+    """
+    threshold = app.config['SEARCH_THRESHOLD']
+    if app.config['SEARCH_INDEX'] != 'memory':
+        return search_database(query, limit, threshold)
+    customer_index.refresh()
+    matches = customer_index.search(query, limit, threshold)
+    if not matches:
+        return []
+    customers = dict((customer.id, customer) for customer in
+                     Customer.query.filter(Customer.id.in_([key for key, _ in matches])))
+    results = []
+    for key, score in matches:
+        if key in customers:
+            data = customers[key].serialize()
+            data['score'] = round(score, 3)
+            results.append(data)
+    return results
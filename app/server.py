@@ -18,26 +18,66 @@ Customer Service
 Paths:
 ------
 GET /customers - Returns a list all of the customers
+GET /customers?limit={n}&after={id} - Returns one page of customers ordered by id
+GET /customers?stream=true - Streams the list of customers as a JSON array
+GET /customers?fields={name,...} - Returns only the given fields of the customers
+GET /customers?count_only=true - Returns the number of matching customers
+GET /customers/stats - Returns counts and credit_level statistics of the customers
+GET /customers/export?format={ndjson,csv}&since={time} - Streams the customers for analytics
+GET /customers/search?q={name}&limit={n} - Returns the customers best matching a name
 GET /customers/{id} - Returns the Customer with a given id number
+    (GET answers 304 Not Modified to a matching If-None-Match or If-Modified-Since)
+GET /cache/stats - Returns the hit and miss counters of the Customer cache
+    and the number of reads that shared an identical one
+GET /pool/stats - Returns the counters of the database connection pool
+GET /credit-queue/stats - Returns the depth and lag of the credit adjustment queue
+GET /livez - Tells if the process is alive
+GET /readyz - Tells if the instance can serve, probing the database
+GET /metrics - Returns the request, SQL, cache and pool metrics in Prometheus format
 POST /customers - creates a new Customer record in the database
+POST /customers/batch - creates, updates and deletes Customers in bulk
 PUT /customers/{id} - updates a Customer record in the database
+    (with If-Match only if it still has that version, in a single UPDATE)
 DELETE /customers/{id} - deletes a Customer record in the database
-PUT /customers/{id}/upgrade-credit - updates a Customer credit_level record in the database
-PUT /customers/{id}/downgrade-credit - updates a Customer credit_level record in the database
+GET /customers/{id}/credit-history?from={time}&to={time} - Returns the credit level changes of a Customer
+GET /customers/{id}/credit-level?at={time} - Returns the credit level of a Customer at a time
+PUT /customers/{id}/upgrade-credit?amount={n} - updates a Customer credit_level record in the database
+PUT /customers/{id}/downgrade-credit?amount={n} - updates a Customer credit_level record in the database
+    (with CREDIT_QUEUE both credit actions queue the amount and answer 202 Accepted)
+    (POST /customers and the credit actions replay their first response to a
+    request repeating an Idempotency-Key header)
 """
 
 import os, sys
 import re
+import csv
+import hashlib
 import logging
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from collections import OrderedDict
 from functools import wraps
 from flask import jsonify, request, json, url_for, make_response, abort
+from flask import Response, stream_with_context
 from flask_api import status    # HTTP Status Codes
-from flask_restplus import Api as  BaseApi, Resource, fields
+from flask_restplus import Api as  BaseApi, Resource, fields, marshal
+from flask_restplus.utils import unpack
 from werkzeug.exceptions import NotFound
-from werkzeug.exceptions import NotFound, UnsupportedMediaType, BadRequest
+from werkzeug.exceptions import NotFound, UnsupportedMediaType, BadRequest, PreconditionFailed
+from werkzeug.http import http_date, quote_etag
+from werkzeug.urls import url_encode
 from app.models import Customer, DataValidationError, DatabaseConnectionError
+from app.models import ConcurrentUpdateError, IdempotencyKey, CreditEvent
+from app.search import customer_index, search_customers, create_trigram_index
+from app.database import pool_stats, pool_saturation, ReadinessProbe
+from app import metrics, credits
 
-from . import app
+try:
+    import msgpack
+except ImportError:     # MessagePack responses are optional
+    msgpack = None
+
+from . import app, db
 
 # from nose.tools import set_trace
 
@@ -64,6 +104,22 @@ api = Api(app,
           doc='/doc'
          )
 
+if msgpack is not None:
+    @api.representation('application/msgpack')
+    def output_msgpack(data, code, headers=None):
+        """ Makes a response with a MessagePack encoded body """
+        response = make_response(msgpack.packb(data), code)
+        response.headers['Content-Type'] = 'application/msgpack'
+        response.headers.extend(headers or {})
+        return response
+
+    @app.after_request
+    def vary_on_accept(response):
+        """ Tells caches that the representation depends on Accept """
+        if 'ETag' in response.headers or response.mimetype in api.representations:
+            response.vary.add('Accept')
+        return response
+
 # This namespace is the start of the path i.e., /cutomers
 ns = api.namespace('customers', description='Customer operations')
 
@@ -78,7 +134,9 @@ Customer_model = api.model('Customer', {
     'valid': fields.Boolean(required=True,
                               description='The valid status of the Customer'),
     'credit_level': fields.Integer(required=True,
-                              description='The credit level of the Customer valid'    )
+                              description='The credit level of the Customer valid'    ),
+    'version': fields.Integer(readOnly=True,
+                              description='Incremented by every update of the Customer')
 })
 
 ######################################################################
@@ -91,6 +149,14 @@ def request_validation_error(error):
     app.logger.info(message)
     return {'status':400, 'error': 'Bad Request', 'message': message}, 400
 
+@api.errorhandler(ConcurrentUpdateError)
+def concurrent_update_error(error):
+    """ Handles updates of Customers that were changed since they were read """
+    message = error.message or str(error)
+    app.logger.warning(message)
+    return {'status': 409, 'error': 'Conflict',
+            'message': 'The Customer was changed by another request, retry the update'}, 409
+
 @api.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
@@ -98,6 +164,61 @@ def database_connection_error(error):
     app.logger.critical(message)
     return {'status':500, 'error': 'Server Error', 'message': message}, 500
 
+######################################################################
+# IDEMPOTENCY KEYS
+######################################################################
+def idempotent(function):
+    """ Replays the first response to requests repeating an Idempotency-Key
+
+    The first request with a key runs and the status and body of its
+    successful response are stored. A retry with the same key and request
+    gets them back with an Idempotent-Replayed header instead of running
+    again; its other headers are built again by customer_headers, for the
+    representation the retry asks for. A retry while the first request
+    still runs gets 409 Conflict, and a key reused for a different request
+    gets 422. Failed requests free their key.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return function(*args, **kwargs)
+        if not key or len(key) > IdempotencyKey.MAX_LENGTH:
+            raise DataValidationError('Invalid Idempotency-Key: must have 1 to {} '
+                                      'characters'.format(IdempotencyKey.MAX_LENGTH))
+        fingerprint = request_fingerprint()
+        held = IdempotencyKey.claim(key, fingerprint)
+        if held is not None:
+            if held.fingerprint != fingerprint:
+                abort(422, 'Idempotency-Key [{}] was used for a different request'.format(key))
+            if held.status is None:
+                abort(status.HTTP_409_CONFLICT,
+                      'A request with Idempotency-Key [{}] is in progress'.format(key))
+            app.logger.info('Replaying the response to Idempotency-Key [%s]', key)
+            data, code = held.response()
+            headers = customer_headers(data, code)
+            headers['Idempotent-Replayed'] = 'true'
+            return data, code, headers
+        try:
+            data, code, headers = unpack(function(*args, **kwargs))
+        except Exception:
+            IdempotencyKey.release(key)
+            raise
+        if 200 <= code < 300:
+            IdempotencyKey.complete(key, code, data)
+        else:
+            IdempotencyKey.release(key)
+        return data, code, headers
+    return wrapper
+
+def request_fingerprint():
+    """ Returns a digest of the method, path, query and body of the request """
+    digest = hashlib.sha256()
+    for part in (request.method, request.path, request.query_string, request.get_data()):
+        digest.update(part.encode('utf-8') if isinstance(part, unicode) else part)
+        digest.update('\0')
+    return digest.hexdigest()
+
 ######################################################################
 # GET HOME PAGE
 ######################################################################
@@ -115,13 +236,106 @@ def healthcheck():
     """ Let them know our heart is still beating """
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
+######################################################################
+# LIVENESS AND READINESS PROBES
+######################################################################
+readiness_probe = ReadinessProbe(app.config['READINESS_CACHE_SECONDS'],
+                                 app.config['READINESS_PROBE_TIMEOUT'])
+
+@app.route('/livez')
+def livez():
+    """ Tells that the process is alive without touching the database """
+    return make_response(jsonify(status=200, message='Alive'), status.HTTP_200_OK)
+
+@app.route('/readyz')
+def readyz():
+    """ Tells if the instance can serve requests
+
+    Returns 503 when the database does not answer SELECT 1 or when the
+    connection pool is saturated
+    """
+    result = readiness_probe.check(db)
+    saturation = pool_saturation(db.engine.pool)
+    result['pool'] = {'saturation': saturation}
+    ready = result['database']['ok'] and \
+        (saturation is None or saturation < app.config['READINESS_MAX_POOL_SATURATION'])
+    result['status'] = 'ready' if ready else 'unavailable'
+    code = status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    if not ready:
+        app.logger.warning('Not ready: %s', result)
+    return make_response(jsonify(result), code)
+
+######################################################################
+# GET CACHE STATISTICS
+######################################################################
+@app.route('/cache/stats')
+def cache_stats():
+    """ Returns the hit and miss counters of the Customer cache
+
+    ``coalesced`` counts the reads that shared the query of an identical
+    read running at the same time, per kind of read
+    """
+    stats = dict(Customer.cache.stats(), coalesced=Customer.reads.stats())
+    return make_response(jsonify(stats), status.HTTP_200_OK)
+
+######################################################################
+# GET CONNECTION POOL STATISTICS
+######################################################################
+@app.route('/pool/stats')
+def connection_pool_stats():
+    """ Returns the checkout and wait counters of the connection pool """
+    return make_response(jsonify(pool_stats.as_dict(db.engine.pool)), status.HTTP_200_OK)
+
+######################################################################
+# GET CREDIT QUEUE STATISTICS
+######################################################################
+@app.route('/credit-queue/stats')
+def credit_queue_stats():
+    """ Returns the depth, lag and flush counters of the credit queue """
+    if not credits.queue:
+        return make_response(jsonify(backend='none'), status.HTTP_200_OK)
+    return make_response(jsonify(credits.queue.stats()), status.HTTP_200_OK)
+
+######################################################################
+# GET PROMETHEUS METRICS
+######################################################################
+@app.route('/metrics')
+def prometheus_metrics():
+    """ Returns the metrics of this process in the Prometheus text format """
+    cache = Customer.cache.stats()
+    pool = pool_stats.as_dict(db.engine.pool)
+    extra = [('customer_cache_hits_total', 'Customer cache hits', 'counter', cache['hits']),
+             ('customer_cache_misses_total', 'Customer cache misses', 'counter', cache['misses']),
+             ('customer_reads_queries_total', 'Customer reads sent to the database',
+              'counter', sum(Customer.reads.queries.values())),
+             ('customer_reads_coalesced_total', 'Customer reads answered by an identical one',
+              'counter', sum(Customer.reads.coalesced.values())),
+             ('db_pool_checkouts_total', 'Connection pool checkouts', 'counter', pool['checkouts']),
+             ('db_pool_connects_total', 'Connections opened', 'counter', pool['connects']),
+             ('db_pool_invalidations_total', 'Connections invalidated', 'counter',
+              pool['invalidations']),
+             ('db_pool_wait_seconds_max', 'Longest wait for a connection', 'gauge',
+              pool['wait_max'])]
+    if 'checked_out' in pool:
+        extra.append(('db_pool_checked_out', 'Connections in use', 'gauge', pool['checked_out']))
+    if credits.queue:
+        queue = credits.queue.stats()
+        extra += [('credit_queue_depth', 'Credit adjustments waiting', 'gauge', queue['depth']),
+                  ('credit_queue_lag_seconds', 'Age of the oldest waiting credit adjustment',
+                   'gauge', queue['lag_seconds']),
+                  ('credit_queue_applied_total', 'Credit adjustments applied', 'counter',
+                   queue['applied'])]
+    response = make_response(metrics.render(extra), status.HTTP_200_OK)
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
 ######################################################################
 # CLEAR THE DATABASE
 ######################################################################
 @app.route('/customers/reset', methods=['DELETE'])
 def customers_reset():
     """ Removing all the customers from the database"""
-    Customer.init_db(reset = True)
+    init_db(reset=True)
     return make_response(jsonify(status=204, message='Customer resetted.'), status.HTTP_204_NO_CONTENT)
 
 
@@ -143,7 +357,8 @@ class CustomerResource(Resource):
     #------------------------------------------------------------------
     @ns.doc('get_customers')
     @ns.response(404, 'Customer not found')
-    @ns.marshal_with(Customer_model)
+    @ns.response(304, 'Customer not modified')
+    @ns.response(200, 'Success', Customer_model)
     def get(self, customer_id):
         """
         Retrieve a single Customer
@@ -151,10 +366,14 @@ class CustomerResource(Resource):
         This endpoint will return a Customer based on it's id
         """
         app.logger.info("Request to Retrieve a Customer with id [%s]", customer_id)
-        customer = Customer.find(customer_id)
+        customer = Customer.find_serialized(customer_id)
         if not customer:
             raise NotFound("Customer with id '{}' was not found.".format(customer_id))
-        return customer.serialize(), status.HTTP_200_OK
+        etag = customer_etag(customer)
+        headers = validator_headers(etag, customer.get('updated_at'))
+        if not_modified(etag, customer.get('updated_at')):
+            return not_modified_response(headers)
+        return marshal(customer, Customer_model), status.HTTP_200_OK, headers
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING Customer
@@ -162,17 +381,31 @@ class CustomerResource(Resource):
     @ns.doc('update_customer')
     @ns.response(404, 'Customer not found')
     @ns.response(400, 'The posted Customer data was not valid')
+    @ns.response(409, 'The Customer was changed by another request')
+    @ns.response(412, 'The Customer does not match If-Match')
     @ns.expect(Customer_model)
     @ns.marshal_with(Customer_model)
     def put(self, customer_id):
         """
         Update a Customer
 
-        This endpoint will update a Customer based the body that is posted
+        This endpoint will update a Customer based the body that is posted.
+        With an If-Match ETag the Customer is only updated if it still has
+        that version, otherwise a concurrent update gets a 409 Conflict.
         """
         app.logger.info('Request to Update a customer with id [%s]', customer_id)
         check_content_type('application/json')
-        customer = Customer.find(customer_id)
+        version = if_match_version(customer_id)
+        if version is not None:
+            try:
+                data = Customer.update_if_version(customer_id, api.payload, version)
+            except ConcurrentUpdateError:
+                raise PreconditionFailed("Customer with id '{}' has been modified."
+                                         .format(customer_id))
+            if not data:
+                raise NotFound("Customer with id '{}' was not found.".format(customer_id))
+            return data, status.HTTP_200_OK, validator_headers(customer_etag(data))
+        customer = Customer.find_on_primary(customer_id)
         if not customer:
             raise NotFound("Customer with id '{}' was not found.".format(customer_id))
         data = api.payload
@@ -182,7 +415,8 @@ class CustomerResource(Resource):
         customer.deserialize(data)
         customer.id = customer_id
         customer.save()
-        return customer.serialize(), status.HTTP_200_OK
+        data = customer.serialize()
+        return data, status.HTTP_200_OK, validator_headers(customer_etag(data))
 
     #------------------------------------------------------------------
     # DELETE A Customer
@@ -196,7 +430,7 @@ class CustomerResource(Resource):
         This endpoint will delete a Customer based the id specified in the path
         """
         app.logger.info('Request to Delete a Customer with id [%s]', customer_id)
-        customer = Customer.find(customer_id)
+        customer = Customer.find_on_primary(customer_id)
         if customer:
             customer.delete()
         return '', status.HTTP_204_NO_CONTENT
@@ -212,17 +446,55 @@ class CustomerCollection(Resource):
     # Query Customers
     #------------------------------------------------------------------
     @ns.doc('query_customers')
+    @ns.param('limit', 'The maximum number of Customers in the page')
+    @ns.param('after', 'Only return Customers with an id greater than this cursor')
+    @ns.param('stream', 'Stream the whole result as a JSON array when true')
+    @ns.param('fields', 'Comma separated list of the fields to return')
+    @ns.param('count_only', 'Only return the number of matching Customers when true')
     @ns.response(404, 'Customer not found')
-    @ns.marshal_list_with(Customer_model)
+    @ns.response(304, 'Customers not modified')
+    @ns.response(200, 'Success', [Customer_model])
     def get(self):
         """ Returns a Query of the Customers """
         app.logger.info('Request to query Customers...')
-        customers = Customer.find_by_kargs(request.args.to_dict())
+        args = request.args.to_dict()
+        if args.pop('count_only', 'false').lower() == 'true':
+            return {'count': Customer.count(args)}, status.HTTP_200_OK
+        stream = args.pop('stream', 'false').lower() == 'true'
+        limit = pop_int_arg(args, 'limit', minimum=1)
+        after = pop_int_arg(args, 'after')
+        fields = pop_fields_arg(args)
+        # Only the selected columns are loaded, as plain rows rather than
+        # Customer objects, and they are returned without re-marshalling
+        if stream:
+            return stream_customers(Customer.iter_by_kargs(args, fields=fields))
+        headers = {}
+        if limit is None and after is None:
+            # Only an ETag: deleting a Customer does not move the latest
+            # updated_at, so If-Modified-Since cannot validate a collection.
+            # The database computes it only to answer If-None-Match, a list
+            # that is loaded computes it from its rows
+            if request.if_none_match:
+                etag = collection_etag(args)
+                if not_modified(etag):
+                    return not_modified_response(validator_headers(etag))
+            customers = Customer.find_by_kargs(args, fields, validators=True)
+            if customers:
+                headers = validator_headers(
+                    collection_etag(args, Customer.rows_version(customers)))
+        else:
+            # pages have no ETag, validating one would scan every match
+            if limit is None:
+                limit = app.config['CUSTOMER_PAGE_LIMIT']
+            limit = min(limit, app.config['CUSTOMER_MAX_PAGE_LIMIT'])
+            customers = Customer.find_page(args, limit, after, fields)
+            if len(customers) == limit:
+                headers.update(next_page_headers(args, limit, customers[-1].id))
         if not customers:
             raise NotFound("No Customers")
-        results = [customer.serialize() for customer in customers]
+        results = [public_fields(customer) for customer in customers]
         app.logger.info('[%s] Customer returned', len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, headers
 
     #------------------------------------------------------------------
     # ADD A NEW Customer
@@ -232,6 +504,7 @@ class CustomerCollection(Resource):
     @ns.response(400, 'The posted data was not valid')
     @ns.response(201, 'Customer created successfully')
     @ns.marshal_with(Customer_model, code=201)
+    @idempotent
     def post(self):
         """
         Creates a Customer
@@ -244,8 +517,135 @@ class CustomerCollection(Resource):
         customer.deserialize(api.payload)
         customer.save()
         app.logger.info('Customer with new id [%s] saved!', customer.id)
-        location_url = api.url_for(CustomerResource, customer_id=customer.id, _external=True)
-        return customer.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        data = customer.serialize()
+        return data, status.HTTP_201_CREATED, customer_headers(data, status.HTTP_201_CREATED)
+
+
+######################################################################
+#  PATH: /customers/stats
+######################################################################
+@ns.route('/stats')
+class CustomerStats(Resource):
+    """ Statistics of the Customers """
+    @ns.doc('customer_stats')
+    @ns.param('bucket_size', 'The width of the credit_level histogram buckets')
+    @ns.response(400, 'The query was not valid')
+    def get(self):
+        """
+        Returns statistics of the Customers
+
+        This endpoint returns the count per valid status, the min, max and
+        average credit_level and a credit_level histogram of the Customers
+        matching the same filters as the Customer query.
+        """
+        app.logger.info('Request for Customer statistics')
+        args = request.args.to_dict()
+        bucket_size = pop_int_arg(args, 'bucket_size')
+        return Customer.stats(args, 10 if bucket_size is None else bucket_size), \
+            status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers/export
+######################################################################
+@ns.route('/export')
+class CustomerExport(Resource):
+    """ Export of the Customers """
+    @ns.doc('export_customers')
+    @ns.param('format', 'ndjson (default) or csv')
+    @ns.param('since', 'Only export Customers updated since this UTC time '
+                       '(ISO 8601 or seconds since the epoch)')
+    @ns.param('fields', 'Comma separated list of the fields to export')
+    @ns.response(400, 'The query was not valid')
+    def get(self):
+        """
+        Streams the Customers as newline delimited JSON or CSV
+
+        The Customers matching the same filters as the Customer query are
+        streamed from a server side cursor. The X-Export-Watermark header
+        is the since to use for the next incremental export.
+        """
+        app.logger.info('Request to export Customers')
+        args = request.args.to_dict()
+        export_format = args.pop('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            raise DataValidationError('Invalid Query String: format must be ndjson or csv')
+        since = parse_time(args.pop('since', None), 'since')
+        fields = pop_fields_arg(args)
+        watermark = datetime.utcnow() - \
+            timedelta(seconds=app.config['CUSTOMER_EXPORT_WATERMARK_LAG'])
+        rows = Customer.export(args, since, fields)
+        write, mimetype = EXPORT_FORMATS[export_format]
+        names = [column.name for column in Customer.columns(fields)]
+        headers = {'X-Export-Watermark': watermark.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'Content-Disposition': 'attachment; filename=customers.' + export_format}
+        return Response(stream_with_context(write(rows, names)),
+                        mimetype=mimetype, headers=headers)
+
+
+######################################################################
+#  PATH: /customers/search
+######################################################################
+@ns.route('/search')
+class CustomerSearch(Resource):
+    """ Name search of the Customers """
+    @ns.doc('search_customers')
+    @ns.param('q', 'The name, or part of the name, to look for')
+    @ns.param('limit', 'The maximum number of Customers to return (default 20)')
+    @ns.response(400, 'The query was not valid')
+    def get(self):
+        """
+        Returns the Customers best matching a name
+
+        The first and last names are matched by their trigrams, with pg_trgm
+        or the in-process index, so partial and misspelled names are found
+        too; on other databases by the start of their words. The Customers
+        are ranked by their score, between 0 and 1.
+        """
+        app.logger.info('Request to search Customers')
+        args = request.args.to_dict()
+        query = args.pop('q', '').strip()
+        if not query:
+            raise DataValidationError('Invalid Query String: q is required')
+        limit = pop_int_arg(args, 'limit', minimum=1)
+        limit = min(20 if limit is None else limit, app.config['CUSTOMER_MAX_PAGE_LIMIT'])
+        return search_customers(query, limit), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers/batch
+######################################################################
+@ns.route('/batch')
+class CustomerBatch(Resource):
+    """ Bulk Create, Update and Delete of Customers """
+    @ns.doc('batch_customers')
+    @ns.param('chunk_size', 'The number of records written per transaction')
+    @ns.response(400, 'The posted data was not valid')
+    @ns.response(200, 'Batch processed, see the status of each record')
+    def post(self):
+        """
+        Creates, updates and deletes Customers in bulk
+
+        The body is a JSON array or newline delimited JSON (application/x-ndjson)
+        of Customers. Records with an id update that Customer, records with
+        "op": "delete" delete it and all others are created. Each record gets
+        its own status so a bad record does not abort the batch.
+        """
+        app.logger.info('Request to process a batch of customers')
+        check_content_type('application/json', 'application/x-ndjson')
+        chunk_size = pop_int_arg(request.args.to_dict(), 'chunk_size', minimum=1)
+        if request.headers['Content-Type'] == 'application/x-ndjson':
+            records = parse_ndjson(request.get_data())
+        else:
+            records = api.payload
+            if not isinstance(records, list):
+                raise DataValidationError('Invalid batch: body must be a JSON array')
+        results = Customer.bulk_save(records, chunk_size)
+        summary = {}
+        for result in results:
+            summary[result['status']] = summary.get(result['status'], 0) + 1
+        app.logger.info('Batch processed: %s', summary)
+        return {'summary': summary, 'results': results}, status.HTTP_200_OK
 
 
 ######################################################################
@@ -256,7 +656,10 @@ class CustomerCollection(Resource):
 class UpgradeCreditResource(Resource):
     """ Upgrade Credit Action on Customer """
     @ns.doc('upgrade-credit')
+    @ns.param('amount', 'The amount to increment the credit level by (default 1)')
     @ns.response(404, 'Customer not found')
+    @ns.response(202, 'Credit adjustment queued')
+    @idempotent
     def put(self, customer_id):
         """
         Upgrade credit level of a customers
@@ -265,13 +668,14 @@ class UpgradeCreditResource(Resource):
         And if credit level becomes positive the valid status of the customer will be True.
         """
         app.logger.info('Request to upgrade credit_level of a customer')
-        customer = Customer.find(customer_id)
+        amount = get_credit_amount()
+        if credits.queue:
+            return queue_credit(customer_id, amount)
+        customer = Customer.adjust_credit(customer_id, amount)
         if not customer:
             abort(status.HTTP_404_NOT_FOUND, 'Customer with id [{}] was not found.'.format(customer_id))
-        customer.upgrade_credit_level()
-        customer.save()
-        app.logger.info('Credit level of customer with id [%s] has been upgraded!', customer.id)
-        return customer.serialize(), status.HTTP_200_OK
+        app.logger.info('Credit level of customer with id [%s] has been upgraded!', customer_id)
+        return customer, status.HTTP_200_OK, validator_headers(customer_etag(customer))
 
 
 ######################################################################
@@ -282,7 +686,10 @@ class UpgradeCreditResource(Resource):
 class DowngradeCreditResource(Resource):
     """ Downgrade Credit Action on Customer  """
     @ns.doc('downgrade-credit')
+    @ns.param('amount', 'The amount to decrease the credit level by (default 1)')
     @ns.response(404, 'Customer not found')
+    @ns.response(202, 'Credit adjustment queued')
+    @idempotent
     def put(self, customer_id):
         """
         Downgrade credit level of a customers
@@ -291,34 +698,328 @@ class DowngradeCreditResource(Resource):
         And if credit level becomes negative the valid status of the customer will be False.
         """
         app.logger.info('Request to uowngrade credit_level of a customer')
-        customer = Customer.find(customer_id)
+        amount = -get_credit_amount()
+        if credits.queue:
+            return queue_credit(customer_id, amount)
+        customer = Customer.adjust_credit(customer_id, amount)
         if not customer:
             abort(status.HTTP_404_NOT_FOUND, 'Customer with id [{}] was not found.'.format(customer_id))
-        customer.downgrade_credit_level()
-        customer.save()
-        app.logger.info('Credit level of customer with id [%s] has been downgraded!', customer.id)
-        return customer.serialize(), status.HTTP_200_OK
+        app.logger.info('Credit level of customer with id [%s] has been downgraded!', customer_id)
+        return customer, status.HTTP_200_OK, validator_headers(customer_etag(customer))
+
+
+######################################################################
+#  PATH: /customers/{id}/credit-history
+######################################################################
+@ns.route('/<int:customer_id>/credit-history')
+@ns.param('customer_id', 'The Customer identifier')
+class CreditHistoryResource(Resource):
+    """ History of the credit level of a Customer """
+    @ns.doc('credit_history')
+    @ns.param('from', 'Only the changes at or after this UTC time '
+                      '(ISO 8601 or seconds since the epoch)')
+    @ns.param('to', 'Only the changes before this UTC time')
+    @ns.param('limit', 'The maximum number of changes to return (default 100)')
+    @ns.param('after', 'The id of the last change of the previous page')
+    @ns.response(404, 'Customer not found')
+    @ns.response(400, 'The query was not valid')
+    def get(self, customer_id):
+        """
+        Returns the changes of the credit level of a Customer
+
+        The changes are returned oldest first with the level each one led
+        to. Pages are read from the (customer_id, ts) index, and the next
+        one is given in the Link and X-Next-Cursor headers.
+        """
+        app.logger.info('Request for the credit history of customer with id [%s]', customer_id)
+        args = request.args.to_dict()
+        start = parse_time(args.pop('from', None), 'from')
+        end = parse_time(args.pop('to', None), 'to')
+        limit = pop_int_arg(args, 'limit', minimum=1)
+        limit = min(100 if limit is None else limit, app.config['CUSTOMER_MAX_PAGE_LIMIT'])
+        after = pop_int_arg(args, 'after')
+        if not Customer.find_serialized(customer_id):
+            abort(status.HTTP_404_NOT_FOUND, 'Customer with id [{}] was not found.'.format(customer_id))
+        events = CreditEvent.history(customer_id, start, end, limit, after)
+        headers = {}
+        if len(events) == limit:
+            params = dict((name, request.args[name]) for name in ('from', 'to')
+                          if name in request.args)
+            headers = next_page_headers(params, limit, events[-1].id)
+        return [event.serialize() for event in events], status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /customers/{id}/credit-level
+######################################################################
+@ns.route('/<int:customer_id>/credit-level')
+@ns.param('customer_id', 'The Customer identifier')
+class CreditLevelResource(Resource):
+    """ Credit level of a Customer at a point in time """
+    @ns.doc('credit_level_at')
+    @ns.param('at', 'The UTC time (ISO 8601 or seconds since the epoch)')
+    @ns.response(404, 'Customer not found')
+    @ns.response(400, 'The query was not valid')
+    def get(self, customer_id):
+        """
+        Returns the credit level a Customer had at a point in time
+
+        The level is the one of the last credit change up to then, found
+        with a single index lookup.
+        """
+        app.logger.info('Request for the past credit level of customer with id [%s]', customer_id)
+        at = parse_time(request.args.get('at'), 'at')
+        if at is None:
+            raise DataValidationError('Invalid Query String: at is required')
+        level = CreditEvent.level_at(customer_id, at)
+        if level is None:
+            abort(status.HTTP_404_NOT_FOUND, 'Customer with id [{}] was not found.'.format(customer_id))
+        return {'id': customer_id, 'at': at.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'credit_level': level, 'valid': level >= 0}, status.HTTP_200_OK
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-@app.before_first_request
 def init_db(reset=False):
     """ Initialies the SQLAlchemy app """
     Customer.init_db(reset)
+    create_trigram_index()
+    customer_index.reset()
 
 def data_reset():
     """ Removes all Customers from the database """
     Customers.remove_all()
 
-def check_content_type(content_type):
+def pop_int_arg(args, name, minimum=0, maximum=None):
+    """ Removes an integer parameter between minimum and maximum from the query arguments """
+    value = args.pop(name, None)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise DataValidationError('Invalid Query String: {} must be an integer'.format(name))
+    if value < minimum:
+        if minimum == 0:
+            raise DataValidationError('Invalid Query String: {} must not be negative'
+                                      .format(name))
+        raise DataValidationError('Invalid Query String: {} must be at least {}'
+                                  .format(name, minimum))
+    if maximum is not None and value > maximum:
+        raise DataValidationError('Invalid Query String: {} must be at most {}'
+                                  .format(name, maximum))
+    return value
+
+def pop_fields_arg(args):
+    """ Removes the fields parameter, defaulting to all Customer fields """
+    fields = args.pop('fields', None)
+    if not fields:
+        return list(Customer.FIELDS)
+    return fields.split(',')
+
+def next_page_headers(args, limit, cursor):
+    """ Builds the Link and X-Next-Cursor headers for the next page """
+    params = dict(args, limit=limit, after=cursor)
+    next_url = '{}?{}'.format(request.base_url, url_encode(params, sort=True))
+    return {'Link': '<{}>; rel="next"'.format(next_url),
+            'X-Next-Cursor': str(cursor)}
+
+def customer_etag(customer):
+    """ Returns the entity tag of a serialized Customer """
+    return '{}-{}'.format(customer['id'], customer['version'])
+
+def customer_headers(data, code):
+    """ Builds the headers of a response with a serialized Customer
+
+    Its ETag, and its Location once created. A queued credit adjustment
+    (202 Accepted) has none.
+    """
+    if code == status.HTTP_202_ACCEPTED:
+        return {}
+    headers = validator_headers(customer_etag(data))
+    if code == status.HTTP_201_CREATED:
+        headers['Location'] = api.url_for(CustomerResource, customer_id=data['id'],
+                                          _external=True)
+    return headers
+
+def if_match_version(customer_id):
+    """ Returns the Customer version required by the If-Match header
+
+    Returns None when any version will do. Raises PreconditionFailed
+    unless exactly one of the entity tags names this Customer. Weak tags
+    are accepted since compressed responses carry weak ETags, and so are
+    the tags of either representation.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = []
+    for etag in request.if_match.as_set(include_weak=True):
+        match = re.match(r'^(\d+)-(\d+)(?:-msgpack)?$', etag)
+        if match and int(match.group(1)) == customer_id:
+            versions.append(int(match.group(2)))
+    if len(versions) != 1:
+        raise PreconditionFailed("Customer with id '{}' does not match If-Match."
+                                 .format(customer_id))
+    return versions[0]
+
+def collection_etag(args, version=None):
+    """ Returns the entity tag of the Customers matching the filters
+
+    Without the ``version`` of loaded rows it is computed by the database
+    from the count, latest updated_at and versions of the matching
+    Customers, so no Customer is loaded. The query string is part of it
+    since it selects the representation.
+    """
+    if version is None:
+        version = Customer.collection_version(args)
+    digest = hashlib.md5(request.query_string)
+    # formatted rather than repr'd: drivers return the count as int or long
+    digest.update('-'.join(str(part) for part in version))
+    return digest.hexdigest()
+
+def public_fields(row):
+    """ Returns a Customer row as a dictionary without its validators """
+    return OrderedDict((key, value) for key, value in row._asdict().items()
+                       if not key.startswith('_'))
+
+def representation_etag(etag):
+    """ Returns the entity tag of the representation the client gets
+
+    JSON and MessagePack bodies differ, so the MessagePack tag has a suffix
+    """
+    mediatype = request.accept_mimetypes.best_match(api.representations,
+                                                    default=api.default_mediatype)
+    if mediatype == 'application/msgpack':
+        return etag + '-msgpack'
+    return etag
+
+def not_modified(etag, last_modified=None):
+    """ Tells if the copy the client validates with is still current
+
+    If-None-Match takes precedence over If-Modified-Since
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(representation_etag(etag))
+    if last_modified is not None and request.if_modified_since:
+        return last_modified <= Customer.timestamp(request.if_modified_since)
+    return False
+
+def validator_headers(etag, last_modified=None):
+    """ Builds the ETag and Last-Modified headers """
+    headers = {'ETag': quote_etag(representation_etag(etag))}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+def not_modified_response(headers):
+    """ Builds an empty 304 Not Modified response """
+    response = make_response('', status.HTTP_304_NOT_MODIFIED)
+    response.headers.extend(headers)
+    return response
+
+def stream_customers(customers):
+    """ Streams Customer rows as a JSON array without building the whole list """
+    def generate():
+        yield '['
+        separator = ''
+        for customer in customers:
+            yield separator + json.dumps(customer._asdict(), separators=(',', ':'))
+            separator = ','
+        yield ']'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def parse_time(value, name):
+    """ Parses a time parameter into a UTC datetime """
+    if value is None:
+        return None
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value.rstrip('Z'), fmt)
+        except ValueError:
+            continue
+    raise DataValidationError('Invalid Query String: {} must be an ISO 8601 '
+                              'UTC time or seconds since the epoch'.format(name))
+
+# Rows are written to the response in blocks of about this many bytes
+EXPORT_BLOCK_SIZE = 64 * 1024
+
+def export_ndjson(rows, names):
+    """ Generator that writes rows as newline delimited JSON """
+    block = StringIO()
+    for row in rows:
+        block.write(json.dumps(row._asdict(), separators=(',', ':')))
+        block.write('\n')
+        if block.tell() >= EXPORT_BLOCK_SIZE:
+            yield block.getvalue()
+            block = StringIO()
+    yield block.getvalue()
+
+def export_csv(rows, names):
+    """ Generator that writes rows as CSV with a header line """
+    block = StringIO()
+    writer = csv.writer(block)
+    writer.writerow(names)
+    for row in rows:
+        writer.writerow([csv_value(value) for value in row])
+        if block.tell() >= EXPORT_BLOCK_SIZE:
+            yield block.getvalue()
+            block = StringIO()
+            writer = csv.writer(block)
+    yield block.getvalue()
+
+def csv_value(value):
+    """ Formats a column value for CSV """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+EXPORT_FORMATS = {'ndjson': (export_ndjson, 'application/x-ndjson'),
+                  'csv': (export_csv, 'text/csv')}
+
+def get_credit_amount():
+    """ Returns the amount parameter of the credit actions """
+    # an amount of 0 would only bump the version and record an empty event,
+    # and credit_level is a 32 bit INTEGER column
+    amount = pop_int_arg(request.args.to_dict(), 'amount', minimum=1, maximum=2 ** 31 - 1)
+    return 1 if amount is None else amount
+
+def queue_credit(customer_id, amount):
+    """ Queues a credit adjustment for the write-behind queue """
+    if not Customer.find_serialized(customer_id):
+        abort(status.HTTP_404_NOT_FOUND, 'Customer with id [{}] was not found.'.format(customer_id))
+    pending = credits.queue.push(customer_id, amount)
+    app.logger.info('Credit adjustment of customer with id [%s] queued', customer_id)
+    return {'id': customer_id, 'amount': amount, 'pending': pending}, status.HTTP_202_ACCEPTED
+
+def parse_ndjson(data):
+    """ Parses newline delimited JSON, keeping bad lines for validation """
+    records = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            records.append(line)
+    return records
+
+def check_content_type(*content_types):
     """ Checks that the media type is correct """
-    if request.headers['Content-Type'] == content_type:
+    if request.headers['Content-Type'] in content_types:
         return
     app.logger.error('Invalid Content-Type: %s', request.headers['Content-Type'])
-    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Content-Type must be {}'.format(content_type))
+    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+          'Content-Type must be {}'.format(' or '.join(content_types)))
 
 #@app.before_first_request
 def initialize_logging(log_level=logging.INFO):
@@ -0,0 +1,3 @@
+"""
+Load test and benchmark suite for the Customer Service
+"""
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+"""
+Customer Service Benchmarks
+
+Seeds a database with customers and drives the customer endpoints at a
+given concurrency, reporting the p50/p95/p99 latency, the requests per
+second, the response size, the CPU time per request and the peak RSS of
+each scenario. Results are written as JSON so that runs of different
+commits can be compared.
+
+Usage:
+------
+    python -m benchmarks.bench run --customers 10000 --concurrency 8 \\
+        --output results.json
+    python -m benchmarks.bench compare baseline.json results.json
+
+Pass --encoding gzip or br to request compressed responses and weigh the
+bytes saved against the CPU they cost.
+
+By default requests go through the Flask test client in this process,
+against the database in --database-uri. Pass --url to drive a running
+server (e.g. gunicorn) over HTTP instead; the RSS and CPU time are then
+the client's.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import resource
+import threading
+import subprocess
+
+SCENARIOS = ['get', 'list', 'post', 'put', 'upgrade', 'downgrade']
+LASTNAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson']
+
+######################################################################
+#  C L I E N T S
+######################################################################
+class TestClient(object):
+    """ Sends requests through the Flask test client of the app """
+
+    def __init__(self, app, encoding=None):
+        self.client = app.test_client()
+        self.headers = {'Accept-Encoding': encoding} if encoding else {}
+
+    def request(self, method, path, body=None):
+        """ Returns the status code and body size of a request """
+        data = json.dumps(body) if body is not None else None
+        resp = self.client.open(path, method=method, data=data, headers=self.headers,
+                                content_type='application/json')
+        return resp.status_code, len(resp.data)
+
+
+class HttpClient(object):
+    """ Sends requests to a running server over HTTP """
+
+    def __init__(self, url, encoding=None):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = encoding or 'identity'
+
+    def request(self, method, path, body=None):
+        """ Returns the status code and body size on the wire of a request """
+        resp = self.session.request(method, self.url + path, json=body)
+        return resp.status_code, int(resp.headers.get('Content-Length') or len(resp.content))
+
+
+######################################################################
+#  S C E N A R I O S
+######################################################################
+def make_request(scenario, max_id):
+    """ Returns the method, path and body of one request of a scenario """
+    customer_id = random.randint(1, max_id)
+    if scenario == 'get':
+        return 'GET', '/customers/{}'.format(customer_id), None
+    if scenario == 'list':
+        return 'GET', '/customers?lastname={}&limit=100'.format(random.choice(LASTNAMES)), None
+    if scenario == 'post':
+        return 'POST', '/customers', {'firstname': 'bench', 'lastname': random.choice(LASTNAMES)}
+    if scenario == 'put':
+        return 'PUT', '/customers/{}'.format(customer_id), \
+            {'firstname': 'bench', 'lastname': random.choice(LASTNAMES)}
+    if scenario == 'upgrade':
+        return 'PUT', '/customers/{}/upgrade-credit'.format(customer_id), None
+    if scenario == 'downgrade':
+        return 'PUT', '/customers/{}/downgrade-credit'.format(customer_id), None
+    raise ValueError('Unknown scenario ' + scenario)
+
+
+def run_scenario(scenario, make_client, requests, concurrency, max_id):
+    """ Runs a scenario and returns its latency and throughput """
+    latencies = []
+    errors = [0]
+    sizes = [0]
+    lock = threading.Lock()
+    per_worker = [requests // concurrency + (1 if i < requests % concurrency else 0)
+                  for i in range(concurrency)]
+
+    def worker(count):
+        client = make_client()
+        mine = []
+        failed = 0
+        received = 0
+        for _ in range(count):
+            method, path, body = make_request(scenario, max_id)
+            start = time.time()
+            code, size = client.request(method, path, body)
+            mine.append(time.time() - start)
+            received += size
+            if code >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+            sizes[0] += received
+
+    threads = [threading.Thread(target=worker, args=(count,)) for count in per_worker]
+    cpu_start = cpu_seconds()
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    cpu = cpu_seconds() - cpu_start
+    latencies.sort()
+    count = len(latencies)
+    return {'requests': count,
+            'errors': errors[0],
+            'rps': count / elapsed if elapsed else 0.0,
+            'bytes_per_response': sizes[0] / count if count else 0,
+            'cpu_ms_per_request': cpu / count * 1000 if count else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def percentile(values, percent):
+    """ Returns the nearest rank percentile of sorted values """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def cpu_seconds():
+    """ Returns the user and system CPU time used by this process """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_kb():
+    """ Returns the peak resident set size of this process in KB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+######################################################################
+#  S E E D I N G
+######################################################################
+def seed(customers, chunk_size=1000):
+    """ Resets the database and loads it with customers """
+    from app.models import Customer
+    Customer.init_db(reset=True)
+    records = []
+    for i in range(customers):
+        credit_level = random.randint(-5, 20)
+        records.append({'firstname': 'customer{}'.format(i),
+                        'lastname': random.choice(LASTNAMES),
+                        'valid': credit_level >= 0,
+                        'credit_level': credit_level})
+        if len(records) == chunk_size:
+            Customer.bulk_save(records, chunk_size)
+            records = []
+    if records:
+        Customer.bulk_save(records, chunk_size)
+
+
+def current_commit():
+    """ Returns the git commit of the working tree or None """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+def run(options):
+    """ Seeds the database and runs the scenarios """
+    if options.url:
+        make_client = lambda: HttpClient(options.url, options.encoding)
+    else:
+        from app import app
+        app.config['SQLALCHEMY_DATABASE_URI'] = options.database_uri
+        app.debug = False
+        if options.customers:
+            seed(options.customers)
+        make_client = lambda: TestClient(app, options.encoding)
+    results = {'commit': current_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'customers': options.customers,
+               'requests': options.requests,
+               'concurrency': options.concurrency,
+               'encoding': options.encoding,
+               'target': options.url or options.database_uri,
+               'scenarios': {}}
+    max_id = max(options.customers, 1)
+    for scenario in options.scenarios:
+        stats = run_scenario(scenario, make_client, options.requests,
+                             options.concurrency, max_id)
+        results['scenarios'][scenario] = stats
+        print('{:<10} {:>9.1f} req/s  p50 {:>7.2f} ms  p95 {:>7.2f} ms  '
+              'p99 {:>7.2f} ms  {:>7} B  cpu {:>6.2f} ms  errors {}'.format(
+                  scenario, stats['rps'], stats['p50_ms'], stats['p95_ms'],
+                  stats['p99_ms'], stats['bytes_per_response'],
+                  stats['cpu_ms_per_request'], stats['errors']))
+    print('peak RSS {} KB'.format(peak_rss_kb()))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return results
+
+
+def compare(baseline, results, threshold):
+    """ Returns the regressions of results against a baseline
+
+    A scenario regresses when its p95 latency grew or its requests per
+    second dropped by more than ``threshold`` (a fraction)
+    """
+    regressions = []
+    for scenario, stats in sorted(results['scenarios'].items()):
+        base = baseline['scenarios'].get(scenario)
+        if not base:
+            continue
+        if base['p95_ms'] and stats['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append('{}: p95 {:.2f} ms -> {:.2f} ms'.format(
+                scenario, base['p95_ms'], stats['p95_ms']))
+        if base['rps'] and stats['rps'] < base['rps'] * (1 - threshold):
+            regressions.append('{}: {:.1f} req/s -> {:.1f} req/s'.format(
+                scenario, base['rps'], stats['rps']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Customer Service benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='seed the database and run the scenarios')
+    run_parser.add_argument('--customers', type=int, default=10000,
+                            help='customers to seed, 0 keeps the existing data')
+    run_parser.add_argument('--requests', type=int, default=2000,
+                            help='requests per scenario')
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    run_parser.add_argument('--database-uri',
+                            default=os.getenv('DATABASE_URI', 'sqlite:////tmp/customers_bench.db'))
+    run_parser.add_argument('--url', help='drive a running server instead of the test client')
+    run_parser.add_argument('--encoding', choices=['gzip', 'br'],
+                            help='ask for responses compressed with this encoding')
+    run_parser.add_argument('--output', help='file to write the JSON results to')
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='allowed fraction of slow down (default 0.1)')
+    options = parser.parse_args(argv)
+
+    if options.command == 'run':
+        run(options)
+        return 0
+    with open(options.baseline) as baseline, open(options.results) as results:
+        regressions = compare(json.load(baseline), json.load(results), options.threshold)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
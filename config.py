@@ -4,20 +4,32 @@ import json
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# SQLAlchemy dialect and driver of the URI schemes of bound services
+DRIVERS = {'postgres': 'postgresql+psycopg2',
+           'postgresql': 'postgresql+psycopg2',
+           'mysql': 'mysql+pymysql'}
+
 def get_db_info():
     """
     Initialized MySQL database connection
     This method will work in the following conditions:
-      1) In Bluemix with Redis bound through VCAP_SERVICES
+      1) In Bluemix with PostgreSQL (elephantsql) bound through VCAP_SERVICES
       2) With MySQL running on the local server as with Travis CI
       3) With MySQL --link in a Docker container called 'mysql'
+    Without DB_HOST it falls back to an in-memory SQLite database.
+
+    The connection pool is sized by DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE and DB_POOL_PRE_PING, which can also
+    be given as credentials of the bound service
     """
+    creds = {}
     # Get the credentials from the Bluemix environment
     if 'VCAP_SERVICES' in os.environ:
         logging.info("Using VCAP_SERVICES...")
         vcap_services = os.environ['VCAP_SERVICES']
         services = json.loads(vcap_services)
-        
+        creds = services['elephantsql'][0]['credentials']
+
         # cleardb
         # creds = services['cleardb'][0]['credentials']
         # username = creds["username"]
@@ -34,6 +46,9 @@ def get_db_info():
         port = uri.split('@')[1].split(':')[1]
         username = uri.split('@')[0].split(':')[0]
         password = uri.split('@')[0].split(':')[1]
+        # keep the database of the service, only name the driver to use
+        scheme, rest = full_uri.split('://', 1)
+        uri = DRIVERS.get(scheme, scheme) + '://' + rest
 
     else:
         logging.info("Using localhost database...")
@@ -43,15 +58,106 @@ def get_db_info():
         hostname = os.getenv('DB_HOST')
         port = os.getenv('DB_PORT')
         name = os.getenv('DB_DBNAME')
+        if hostname:
+            connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
+            uri = connect_string.format(username, password, hostname, port, name)
+        else:
+            logging.info("No DB_HOST, using an in-memory SQLite database...")
+            uri = 'sqlite://'
 
     logging.info("Conecting to database on host %s port %s", hostname, port)
-    connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
-    uri = connect_string.format(username, password, hostname, port, name)
-    
-    return username, password, hostname, port, name, uri
 
-DB_USERNAME, DB_PASSWORD, DB_HOSTNAME, DB_PORT, DB_NAME, SQLALCHEMY_TRACK_MODIFICATIONS = get_db_info()
+    def setting(key, default):
+        return creds.get(key.lower(), os.getenv(key, default))
+
+    pool = {'pool_size': int(setting('DB_POOL_SIZE', '5')),
+            'max_overflow': int(setting('DB_MAX_OVERFLOW', '10')),
+            'pool_timeout': int(setting('DB_POOL_TIMEOUT', '10')),
+            # recycle before MySQL's wait_timeout drops idle connections
+            'pool_recycle': int(setting('DB_POOL_RECYCLE', '3600')),
+            'pre_ping': str(setting('DB_POOL_PRE_PING', 'True')) == 'True'}
+
+    return username, password, hostname, port, name, uri, pool
+
+DB_USERNAME, DB_PASSWORD, DB_HOSTNAME, DB_PORT, DB_NAME, SQLALCHEMY_DATABASE_URI, DB_POOL = get_db_info()
+
+SQLALCHEMY_POOL_SIZE = DB_POOL['pool_size']
+SQLALCHEMY_MAX_OVERFLOW = DB_POOL['max_overflow']
+SQLALCHEMY_POOL_TIMEOUT = DB_POOL['pool_timeout']
+SQLALCHEMY_POOL_RECYCLE = DB_POOL['pool_recycle']
+SQLALCHEMY_POOL_PRE_PING = DB_POOL['pre_ping']
+# Comma separated URIs of read replicas and how to pick one of them:
+# round_robin or least_connections
+DB_READ_REPLICA_URIS = [uri for uri in os.getenv('DB_READ_REPLICA_URIS', '').split(',') if uri]
+DB_READ_REPLICA_STRATEGY = os.getenv('DB_READ_REPLICA_STRATEGY', 'round_robin')
+# Times a read is retried when its connection was dropped
+DB_READ_RETRIES = int(os.getenv('DB_READ_RETRIES', '1'))
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SECRET_KEY = 'secret-for-dev-only'
 LOGGING_LEVEL = logging.INFO
+# Seconds the database probe of /readyz is cached for, the fraction of the
+# connection pool in use at which the instance stops taking traffic and the
+# seconds the probe waits to connect
+READINESS_CACHE_SECONDS = float(os.getenv('READINESS_CACHE_SECONDS', '5'))
+READINESS_MAX_POOL_SATURATION = float(os.getenv('READINESS_MAX_POOL_SATURATION', '1.0'))
+READINESS_PROBE_TIMEOUT = float(os.getenv('READINESS_PROBE_TIMEOUT', '2'))
+
+# Requests slower than this are logged with the SQL that dominated them
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '1.0'))
+
+# Responses of at least COMPRESSION_MIN_SIZE bytes are compressed with the
+# gzip level (1-9) or brotli quality (0-11) given here
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+# Compact JSON, the restplus default indents in debug mode
+RESTPLUS_JSON = {'separators': (',', ':')}
+
+# Paging of the customer collection
+CUSTOMER_PAGE_LIMIT = int(os.getenv('CUSTOMER_PAGE_LIMIT', '100'))
+CUSTOMER_MAX_PAGE_LIMIT = int(os.getenv('CUSTOMER_MAX_PAGE_LIMIT', '1000'))
+CUSTOMER_CHUNK_SIZE = int(os.getenv('CUSTOMER_CHUNK_SIZE', '500'))
+
+# Rows fetched per round trip by the export, and how far behind the export
+# start its watermark is, so rows committed late are picked up by the next one
+CUSTOMER_EXPORT_CHUNK_SIZE = int(os.getenv('CUSTOMER_EXPORT_CHUNK_SIZE', '1000'))
+CUSTOMER_EXPORT_WATERMARK_LAG = int(os.getenv('CUSTOMER_EXPORT_WATERMARK_LAG', '5'))
+
+# Name search: database (pg_trgm on PostgreSQL) or memory for an in-process
+# index in every worker, the minimum similarity of a match, how often the
+# in-process index catches up with the rows updated by other processes, how
+# far back it looks for rows committed late and how often it is rebuilt to
+# drop deleted Customers
+SEARCH_INDEX = os.getenv('SEARCH_INDEX', 'database')
+SEARCH_THRESHOLD = float(os.getenv('SEARCH_THRESHOLD', '0.3'))
+SEARCH_REFRESH_SECONDS = float(os.getenv('SEARCH_REFRESH_SECONDS', '1'))
+SEARCH_REFRESH_LAG = int(os.getenv('SEARCH_REFRESH_LAG', '5'))
+SEARCH_REBUILD_SECONDS = int(os.getenv('SEARCH_REBUILD_SECONDS', '3600'))
+
+# Read-through cache of single Customers: lru, redis or none
+CUSTOMER_CACHE = os.getenv('CUSTOMER_CACHE', 'lru')
+CUSTOMER_CACHE_SIZE = int(os.getenv('CUSTOMER_CACHE_SIZE', '10000'))
+CUSTOMER_CACHE_TTL = int(os.getenv('CUSTOMER_CACHE_TTL', '60'))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# Identical Customer reads running at once in a process (GET by id on a cache
+# miss and list queries) share one database query
+COALESCE_READS = os.getenv('COALESCE_READS', 'True') == 'True'
+
+# Idempotency-Key of POST /customers and the credit actions: how long the first
+# response is replayed, how long a request in progress holds its key and how
+# often the expired keys are deleted
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '60'))
+IDEMPOTENCY_PURGE_SECONDS = int(os.getenv('IDEMPOTENCY_PURGE_SECONDS', '300'))
+
+# Write-behind queue of the credit actions: none (applied at once), memory or
+# redis. Queued amounts are applied every CREDIT_QUEUE_FLUSH_SECONDS, or
+# sooner once CREDIT_QUEUE_MAX_PENDING adjustments are waiting
+CREDIT_QUEUE = os.getenv('CREDIT_QUEUE', 'none')
+CREDIT_QUEUE_FLUSH_SECONDS = float(os.getenv('CREDIT_QUEUE_FLUSH_SECONDS', '0.5'))
+CREDIT_QUEUE_MAX_PENDING = int(os.getenv('CREDIT_QUEUE_MAX_PENDING', '10000'))
+
+# Number of records written per transaction by the batch endpoint
+CUSTOMER_BATCH_CHUNK_SIZE = int(os.getenv('CUSTOMER_BATCH_CHUNK_SIZE', '1000'))
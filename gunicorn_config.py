@@ -0,0 +1,73 @@
+"""
+Gunicorn configuration for the Customer Service
+
+Serves the app with pre-forked workers in production:
+
+    gunicorn -c gunicorn_config.py wsgi:app
+
+Environment Variables:
+----------------------
+    - PORT : port to listen on (default 5000)
+    - WORKERS : number of worker processes (default 2)
+    - THREADS : threads per worker, more than 1 uses gthread workers (default 4)
+    - WORKER_CLASS : overrides the worker class, gevent serves many slow
+      clients per worker with greenlets instead of threads
+    - WORKER_CONNECTIONS : clients per gevent worker (default 1000)
+    - MAX_REQUESTS : requests served before a worker is recycled (default 1000)
+    - TIMEOUT : seconds before a silent worker is killed (default 30)
+    - GRACEFUL_TIMEOUT : seconds workers get to finish on shutdown (default 30)
+"""
+import os
+import logging
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+workers = int(os.getenv('WORKERS', '2'))
+threads = int(os.getenv('THREADS', '4'))
+worker_class = os.getenv('WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+
+if worker_class == 'gevent':
+    # Patch before the app is preloaded so that PyMySQL sockets, the
+    # connection pool and its locks all yield to other greenlets while
+    # they wait. Concurrent queries per worker are then bounded by
+    # DB_POOL_SIZE + DB_MAX_OVERFLOW rather than by threads.
+    from gevent import monkey
+    monkey.patch_all()
+
+# Recycle workers to bound memory growth, with jitter so they don't all
+# restart at the same time
+max_requests = int(os.getenv('MAX_REQUESTS', '1000'))
+max_requests_jitter = max_requests // 10
+timeout = int(os.getenv('TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+
+# Load the app once in the master so workers fork with it already imported
+preload_app = True
+accesslog = '-'
+
+######################################################################
+#  S E R V E R   H O O K S
+######################################################################
+def on_starting(arbiter):
+    """ Initializes logging and the database once in the master """
+    from app import db, server
+    server.initialize_logging(logging.INFO)
+    server.init_db()
+    # Don't hand the connections opened by the master to the workers
+    db.engine.dispose()
+    db.dispose_replicas()
+
+def post_fork(arbiter, worker):
+    """ Gives every worker its own connection pool """
+    from app import db
+    db.engine.dispose()
+    db.dispose_replicas()
+
+def worker_exit(arbiter, worker):
+    """ Flushes the credit queue and closes the connections of a worker """
+    from app import db, credits
+    if credits.queue:
+        credits.queue.stop()
+    db.session.remove()
+    db.engine.dispose()
+    db.dispose_replicas()
@@ -0,0 +1,49 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the benchmark suite """
+import unittest
+from benchmarks.bench import percentile, compare, make_request, SCENARIOS
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBenchmarks(unittest.TestCase):
+    """ Benchmark Suite Tests """
+
+    def test_percentile(self):
+        """ Compute nearest rank percentiles """
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_compare(self):
+        """ Report scenarios that got slower """
+        baseline = {'scenarios': {'get': {'p95_ms': 10.0, 'rps': 100.0},
+                                  'put': {'p95_ms': 20.0, 'rps': 50.0}}}
+        results = {'scenarios': {'get': {'p95_ms': 10.5, 'rps': 98.0},
+                                 'put': {'p95_ms': 30.0, 'rps': 40.0},
+                                 'post': {'p95_ms': 5.0, 'rps': 10.0}}}
+        regressions = compare(baseline, results, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(r.startswith('put') for r in regressions))
+        self.assertEqual(compare(baseline, baseline, 0.1), [])
+
+    def test_make_request(self):
+        """ Build a request for every scenario """
+        for scenario in SCENARIOS:
+            method, path, body = make_request(scenario, 10)
+            self.assertIn(method, ('GET', 'POST', 'PUT'))
+            self.assertTrue(path.startswith('/customers'))
+        self.assertRaises(ValueError, make_request, 'patch', 10)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
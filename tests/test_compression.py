@@ -0,0 +1,95 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the response compression """
+import zlib
+import unittest
+import brotli
+from flask import Flask, Response
+from werkzeug.datastructures import Accept
+from app import compression
+
+BODY = '[' + ','.join('{"id":%d,"lastname":"dog"}' % i for i in range(100)) + ']'
+
+def make_app():
+    """ Builds an app with the compression hook and a few routes """
+    app = Flask(__name__)
+    app.config.update(COMPRESSION_MIN_SIZE=1024, COMPRESSION_GZIP_LEVEL=6,
+                      COMPRESSION_BROTLI_QUALITY=4)
+    compression.init_app(app)
+
+    @app.route('/big')
+    def big():
+        response = Response(BODY, mimetype='application/json')
+        response.set_etag('1-1')
+        return response
+
+    @app.route('/small')
+    def small():
+        return Response('{"id":1}', mimetype='application/json')
+
+    @app.route('/stream')
+    def stream():
+        return Response((chunk for chunk in ['[', '{"id":1}', ',', '{"id":2}', ']']),
+                        mimetype='application/json')
+
+    @app.route('/image')
+    def image():
+        return Response(BODY, mimetype='image/png')
+
+    return app
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCompression(unittest.TestCase):
+    """ Compression Tests """
+
+    def setUp(self):
+        self.client = make_app().test_client()
+
+    def test_gzip(self):
+        """ Compress a large response with gzip """
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp.headers['ETag'], 'W/"1-1"')
+        self.assertEqual(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), BODY)
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+
+    def test_brotli(self):
+        """ Prefer brotli when the client accepts both """
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.data), BODY)
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_not_compressed(self):
+        """ Send small, binary and unnegotiated responses as they are """
+        resp = self.client.get('/big')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, BODY)
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/image', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_stream(self):
+        """ Compress a streamed response chunk by chunk """
+        resp = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), '[{"id":1},{"id":2}]')
+
+    def test_choose_encoding_without_brotli(self):
+        """ Fall back to gzip when brotli is not installed """
+        accept = Accept([('br', 1), ('gzip', 0.5)])
+        self.assertEqual(compression.choose_encoding(accept), 'br')
+        saved, compression.brotli = compression.brotli, None
+        try:
+            self.assertEqual(compression.choose_encoding(accept), 'gzip')
+        finally:
+            compression.brotli = saved
@@ -0,0 +1,156 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the write-behind queue of credit adjustments """
+import os
+import time
+import unittest
+from mock import MagicMock, patch
+from sqlalchemy.exc import OperationalError, IntegrityError
+from app import app, db
+from app.models import Customer
+from app.credits import CreditQueue, MemoryQueue, RedisQueue
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQueueBackends(unittest.TestCase):
+    """ Queue Backend Tests """
+
+    def test_memory_queue(self):
+        """ Sum the amounts per Customer in memory """
+        queue = MemoryQueue()
+        self.assertEqual(queue.push(1, 2), 1)
+        self.assertEqual(queue.push(1, -5), 2)
+        self.assertEqual(queue.push(2, 1), 3)
+        self.assertEqual(queue.depth()[:2], (3, 2))
+        amounts, events, oldest = queue.drain()
+        self.assertEqual(amounts, {1: -3, 2: 1})
+        self.assertEqual(events, 3)
+        self.assertTrue(oldest <= time.time())
+        self.assertEqual(queue.depth(), (0, 0, None))
+        queue.push(1, 1)
+        queue.restore(amounts, events, oldest)
+        self.assertEqual(queue.drain(), ({1: -2, 2: 1}, 4, oldest))
+
+    def test_redis_queue(self):
+        """ Sum the amounts per Customer in Redis """
+        client = MagicMock()
+        pipe = client.pipeline.return_value
+        queue = RedisQueue(client)
+        pipe.execute.return_value = [2, 5, True]
+        self.assertEqual(queue.push(1, 2), 5)
+        pipe.hincrby.assert_called_with('credit:amounts', 1, 2)
+        pipe.execute.return_value = [{'1': '-3', '2': '1'}, '3', '1500000000.5', 3]
+        self.assertEqual(queue.drain(), ({1: -3, 2: 1}, 3, 1500000000.5))
+        pipe.delete.assert_called_with('credit:amounts', 'credit:events', 'credit:oldest')
+        queue.restore({1: -3}, 3, 1500000000.5)
+        pipe.hincrby.assert_called_with('credit:amounts', 1, -3)
+        pipe.incrby.assert_called_with('credit:events', 3)
+        pipe.execute.return_value = [None, 0, None]
+        self.assertEqual(queue.depth(), (0, 0, None))
+
+
+class TestCreditQueue(unittest.TestCase):
+    """ Credit Queue Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        app.debug = False
+        if DATABASE_URI:
+            app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        Customer.init_db(reset=True)
+        self.fido = Customer(firstname='fido', lastname='dog')
+        self.fido.save()
+        self.kitty = Customer(firstname='kitty', lastname='cat')
+        self.kitty.save()
+        self.fido_id, self.kitty_id = self.fido.id, self.kitty.id
+        self.queue = CreditQueue(MemoryQueue(), flush_seconds=60)
+
+    def tearDown(self):
+        self.queue.stop()
+        db.session.remove()
+
+    def credit_level(self, customer_id):
+        db.session.remove()
+        return Customer.find(customer_id).credit_level
+
+    def test_flush_coalesces(self):
+        """ Apply the amounts queued for a Customer with one UPDATE """
+        self.queue.backend.push(self.fido_id, 3)
+        self.queue.backend.push(self.fido_id, -5)
+        self.queue.backend.push(self.kitty_id, 2)
+        self.queue.backend.push(self.kitty_id, -2)
+        self.queue.backend.push(999, 1)
+        with patch.object(Customer, 'apply_credit_deltas',
+                          wraps=Customer.apply_credit_deltas) as apply_deltas:
+            self.assertEqual(self.queue.flush(), 5)
+        apply_deltas.assert_called_once_with({self.fido_id: -2, 999: 1})
+        self.assertEqual(self.credit_level(self.fido_id), -2)
+        self.assertEqual(Customer.find(self.fido_id).valid, False)
+        self.assertEqual(self.credit_level(self.kitty_id), 0)
+        stats = self.queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['applied'], 5)
+        self.assertEqual(stats['updates'], 1)
+        self.assertEqual(stats['missing'], 1)
+        self.assertEqual(self.queue.flush(), 0)
+
+    def test_failed_flush_stays_queued(self):
+        """ Put the amounts of a failed flush back in the queue """
+        self.queue.backend.push(self.fido_id, 3)
+        error = OperationalError('UPDATE', {}, Exception('gone away'))
+        with patch.object(Customer, 'apply_credit_deltas', side_effect=error):
+            self.assertRaises(OperationalError, self.queue.flush)
+        self.assertEqual(self.queue.stats()['failures'], 1)
+        self.assertEqual(self.queue.stats()['depth'], 1)
+        self.queue.flush()
+        self.assertEqual(self.credit_level(self.fido_id), 3)
+
+    def test_rejected_adjustment_is_dropped(self):
+        """ Drop the amount the database rejects and apply the others """
+        self.queue.backend.push(self.fido_id, 3)
+        self.queue.backend.push(self.kitty_id, 7)
+        apply_credit_deltas = Customer.apply_credit_deltas
+        def apply_deltas(deltas):
+            if self.fido_id in deltas:
+                raise IntegrityError('INSERT', {}, Exception('NOT NULL constraint failed'))
+            return apply_credit_deltas(deltas)
+        with patch.object(Customer, 'apply_credit_deltas', side_effect=apply_deltas):
+            self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(self.credit_level(self.fido_id), 0)
+        self.assertEqual(self.credit_level(self.kitty_id), 7)
+        stats = self.queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(stats['updates'], 1)
+
+    def test_stop_flushes(self):
+        """ Apply what is still queued when the queue stops """
+        self.queue.push(self.fido_id, 4)
+        self.assertTrue(self.queue._thread.is_alive())
+        self.queue.stop()
+        self.assertIs(self.queue._thread, None)
+        self.assertEqual(self.credit_level(self.fido_id), 4)
+
+    def test_flush_when_full(self):
+        """ Flush before the interval once max_pending are waiting """
+        self.queue.max_pending = 2
+        self.queue.push(self.fido_id, 1)
+        self.queue.push(self.fido_id, 1)
+        deadline = time.time() + 5
+        while self.queue.stats()['applied'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.credit_level(self.fido_id), 2)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the database engine configuration """
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from mock import MagicMock, patch
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+import config
+from app import app
+from app.database import SQLAlchemy, InstrumentedQueuePool, PoolStats, \
+    ReplicaSet, ReadinessProbe, pool_stats, pool_saturation, ping_connection, \
+    probe_engine
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestDatabase(unittest.TestCase):
+    """ Database Engine Tests """
+
+    def setUp(self):
+        pool_stats.reset()
+
+    def test_database_uri_of_bound_service(self):
+        """ Build the URI from the scheme of the bound service """
+        services = {'elephantsql': [{'credentials': {
+            'uri': 'postgres://user:pw@host.elephantsql.com:5432/db', 'db_pool_size': '3'}}]}
+        with patch.dict('os.environ', {'VCAP_SERVICES': json.dumps(services)}):
+            info = config.get_db_info()
+        self.assertEqual(info[5], 'postgresql+psycopg2://user:pw@host.elephantsql.com:5432/db')
+        self.assertEqual(info[:5], ('user', 'pw', 'host.elephantsql.com', '5432', 'db'))
+        self.assertEqual(info[6]['pool_size'], 3)
+
+    def test_database_uri_local(self):
+        """ Use the local MySQL server, or SQLite without one """
+        env = {'DB_HOST': 'localhost', 'DB_PORT': '3306', 'DB_USERNAME': 'root',
+               'DB_PASSWORD': 'pw', 'DB_DBNAME': 'development'}
+        with patch.dict('os.environ', env):
+            self.assertEqual(config.get_db_info()[5],
+                             'mysql+pymysql://root:pw@localhost:3306/development')
+        with patch.dict('os.environ', {'DB_HOST': ''}):
+            self.assertEqual(config.get_db_info()[5], 'sqlite://')
+
+    def test_pool_options_for_mysql(self):
+        """ Use the instrumented pool with the configured options for MySQL """
+        options = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 10}
+        info = make_url('mysql+pymysql://user:pw@localhost:3306/db')
+        SQLAlchemy().apply_driver_hacks(app, info, options)
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['max_overflow'], 10)
+
+    def test_pool_options_for_sqlite(self):
+        """ Drop the queue options that SQLite pools don't accept """
+        options = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 10}
+        info = make_url('sqlite:////tmp/test.db')
+        SQLAlchemy().apply_driver_hacks(app, info, options)
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('max_overflow', options)
+        self.assertNotIn('pool_timeout', options)
+
+    def test_instrumented_pool(self):
+        """ Count checkouts and record how long they waited """
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0)
+        engine.execute('select 1')
+        engine.execute('select 1')
+        data = pool_stats.as_dict(engine.pool)
+        self.assertEqual(data['checkouts'], 2)
+        self.assertEqual(data['checkins'], 2)
+        self.assertEqual(data['connects'], 1)
+        self.assertEqual(data['size'], 1)
+        self.assertEqual(data['checked_out'], 0)
+        self.assertTrue(data['wait_max'] >= data['wait_avg'] >= 0)
+
+    def test_ping_connection(self):
+        """ Ping a connection before it is used """
+        connection = MagicMock(should_close_with_result=True)
+        ping_connection(connection, False)
+        self.assertEqual(connection.scalar.call_count, 1)
+        self.assertTrue(connection.should_close_with_result)
+        ping_connection(connection, True)
+        self.assertEqual(connection.scalar.call_count, 1)
+
+    def test_pool_stats(self):
+        """ Keep the pool counters """
+        stats = PoolStats()
+        stats.incr('invalidations')
+        stats.record_wait(0.5)
+        stats.record_wait(1.5)
+        data = stats.as_dict()
+        self.assertEqual(data['invalidations'], 1)
+        self.assertEqual(data['wait_avg'], 1.0)
+        self.assertEqual(data['wait_max'], 1.5)
+        self.assertNotIn('size', data)
+
+    def test_replica_round_robin(self):
+        """ Pick the replicas in turn """
+        engines = [MagicMock(), MagicMock()]
+        replicas = ReplicaSet(['a', 'b'], engines)
+        self.assertEqual([replicas.choose() for _ in range(3)],
+                         [engines[0], engines[1], engines[0]])
+
+    def test_replica_least_connections(self):
+        """ Pick the replica with the fewest connections in use """
+        busy = create_engine('sqlite://', poolclass=InstrumentedQueuePool)
+        idle = create_engine('sqlite://', poolclass=InstrumentedQueuePool)
+        connection = busy.connect()
+        replicas = ReplicaSet(['busy', 'idle'], [busy, idle], 'least_connections')
+        self.assertIs(replicas.choose(), idle)
+        connection.close()
+        self.assertRaises(ValueError, ReplicaSet, [], [], 'random')
+
+    def test_pool_saturation(self):
+        """ Compute the fraction of the pool in use """
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=1)
+        self.assertEqual(pool_saturation(engine.pool), 0.0)
+        connection = engine.connect()
+        self.assertEqual(pool_saturation(engine.pool), 0.5)
+        connection.close()
+        self.assertIs(pool_saturation(create_engine('sqlite://').pool), None)
+
+    def test_readiness_probe(self):
+        """ Probe the primary and the replicas and cache the result """
+        db = MagicMock()
+        db.engine = create_engine('sqlite://')
+        db.replica_engines.return_value = [create_engine('sqlite://')]
+        probe = ReadinessProbe(ttl=60)
+        result = probe.check(db)
+        self.assertTrue(result['database']['ok'])
+        self.assertFalse(result['cached'])
+        self.assertEqual(len(result['replicas']), 1)
+        self.assertTrue(result['replicas'][0]['ok'])
+        self.assertIs(result['replicas'][0]['lag_seconds'], None)
+        self.assertTrue(probe.check(db)['cached'])
+        self.assertEqual(db.replica_engines.call_count, 1)
+
+    def test_readiness_probe_with_exhausted_pool(self):
+        """ Probe the database without waiting for a pooled connection """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'probe.db'),
+                               poolclass=QueuePool, pool_size=1, max_overflow=0,
+                               pool_timeout=30)
+        connection = engine.connect()
+        self.addCleanup(connection.close)
+        start = time.time()
+        self.assertTrue(probe_engine(engine, timeout=1)['ok'])
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(pool_saturation(engine.pool), 1.0)
+        result = probe_engine(create_engine('sqlite:///' + os.path.join(directory, 'no', 'db')))
+        self.assertFalse(result['ok'])
+        self.assertIn('unable to open', result['error'])
+
+    def test_readiness_probe_answers_while_probing(self):
+        """ Answer with the previous result while another thread probes """
+        db = MagicMock()
+        db.engine = create_engine('sqlite://')
+        db.replica_engines.return_value = []
+        probe = ReadinessProbe(ttl=0)
+        probe.check(db)
+        started = threading.Event()
+        release = threading.Event()
+        def slow_probe(engine, timeout=None):
+            started.set()
+            release.wait(5)
+            return {'ok': True, 'latency_ms': 1.0}
+        with patch('app.database.probe_engine', side_effect=slow_probe):
+            results = []
+            thread = threading.Thread(target=lambda: results.append(probe.check(db)))
+            thread.start()
+            started.wait(5)
+            self.assertTrue(probe.check(db)['cached'])
+            release.set()
+            thread.join()
+        self.assertFalse(results[0]['cached'])
+        self.assertEqual(results[0]['database']['latency_ms'], 1.0)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
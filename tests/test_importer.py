@@ -0,0 +1,132 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the bulk import of Customers """
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from sqlalchemy.engine.url import make_url
+from app import app, db
+from app.models import Customer, DataValidationError
+from app.importer import import_file, parse_record, to_mapping, load_data_value
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestImporter(unittest.TestCase):
+    """ Bulk Import Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        app.debug = False
+        if DATABASE_URI:
+            app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        db.session.remove()
+        self.directory = tempfile.mkdtemp()
+        self.app_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        url = make_url(self.app_uri)
+        if url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:'):
+            # the importer opens its own engine, which cannot see an in-memory database
+            app.config['SQLALCHEMY_DATABASE_URI'] = \
+                'sqlite:///' + os.path.join(self.directory, 'customers.db')
+        self.uri = app.config['SQLALCHEMY_DATABASE_URI']
+        Customer.init_db(reset=True)
+
+    def tearDown(self):
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.app_uri
+        shutil.rmtree(self.directory)
+
+    def write(self, name, lines):
+        """ Writes a file to import and returns its path """
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as data:
+            data.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_parse_record(self):
+        """ Parse CSV rows and NDJSON lines """
+        record = parse_record({'firstname': 'fido', 'lastname': 'dog', 'valid': 'false',
+                               'credit_level': '-2', 'id': '', None: ['extra']})
+        self.assertEqual(record, {'firstname': 'fido', 'lastname': 'dog', 'valid': False,
+                                  'credit_level': -2})
+        self.assertEqual(parse_record('{"firstname": "fido"}\n'), {'firstname': 'fido'})
+        self.assertRaises(DataValidationError, parse_record, '{fido')
+        self.assertRaises(DataValidationError, parse_record, '[1]')
+        self.assertRaises(DataValidationError, parse_record, {'valid': 'maybe'})
+        self.assertRaises(DataValidationError, parse_record, {'credit_level': 'high'})
+
+    def test_to_mapping(self):
+        """ Validate records with the Customer rules """
+        now = datetime.utcnow()
+        mapping = to_mapping({'firstname': 'fido', 'lastname': 'dog'}, now)
+        self.assertEqual(mapping, {'firstname': 'fido', 'lastname': 'dog', 'valid': True,
+                                   'credit_level': 0, 'version': 1, 'updated_at': now})
+        mapping = to_mapping({'id': 7, 'firstname': 'fido', 'lastname': 'dog',
+                              'valid': False, 'credit_level': -1}, now)
+        self.assertEqual(mapping['id'], 7)
+        self.assertEqual(mapping['credit_level'], -1)
+        self.assertRaises(DataValidationError, to_mapping, {'firstname': 'fido'}, now)
+        self.assertRaises(DataValidationError, to_mapping,
+                          {'firstname': 'f' * 64, 'lastname': 'dog'}, now)
+        self.assertRaises(DataValidationError, to_mapping,
+                          {'firstname': 'fido', 'lastname': 'dog',
+                           'valid': True, 'credit_level': -1}, now)
+
+    def test_import_csv(self):
+        """ Import a CSV file and reject the bad rows """
+        path = self.write('customers.csv', ['firstname,lastname,valid,credit_level',
+                                            'fido,dog,true,3',
+                                            'kitty,cat,false,-1',
+                                            'bad,cat,maybe,0',
+                                            'sammy,snake,,'])
+        rejects = os.path.join(self.directory, 'rejects')
+        stats = import_file(path, self.uri, batch_size=2, reject_path=rejects)
+        self.assertEqual(stats['rows'], 4)
+        self.assertEqual(stats['loaded'], 3)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(sorted(c.firstname for c in Customer.all()), ['fido', 'kitty', 'sammy'])
+        self.assertEqual(Customer.find_by_kargs({'firstname': 'kitty'})[0].valid, False)
+        with open(rejects) as data:
+            reject = json.loads(data.readline())
+        self.assertEqual(reject['line'], 4)
+        self.assertEqual(reject['record']['firstname'], 'bad')
+
+    def test_import_ndjson_with_workers(self):
+        """ Import an NDJSON file with a pool of processes """
+        lines = [json.dumps({'firstname': 'c{}'.format(i), 'lastname': 'dog'}) for i in range(50)]
+        path = self.write('customers.ndjson', lines + ['', '{bad'])
+        stats = import_file(path, self.uri, batch_size=10, workers=2)
+        self.assertEqual(stats['loaded'], 50)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(Customer.count({}), 50)
+
+    def test_import_failed_batch(self):
+        """ Retry a failed batch row by row to only reject the bad rows """
+        Customer(firstname='fido', lastname='dog').save()
+        path = self.write('customers.ndjson', [
+            json.dumps({'id': 2, 'firstname': 'kitty', 'lastname': 'cat'}),
+            json.dumps({'id': 1, 'firstname': 'copy', 'lastname': 'dog'}),
+            json.dumps({'firstname': 'sammy', 'lastname': 'snake'})])
+        rejects = os.path.join(self.directory, 'rejects')
+        stats = import_file(path, self.uri, reject_path=rejects)
+        self.assertEqual(stats['loaded'], 2)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(Customer.find(1).firstname, 'fido')
+        with open(rejects) as data:
+            self.assertEqual(json.loads(data.readline())['line'], 2)
+
+    def test_load_data_value(self):
+        """ Escape values for LOAD DATA files """
+        self.assertEqual(load_data_value(None), '\\N')
+        self.assertEqual(load_data_value(True), '1')
+        self.assertEqual(load_data_value(u'a\tb\\'), 'a\\tb\\\\')
+        self.assertEqual(load_data_value(datetime(2017, 1, 2, 3, 4, 5)), '2017-01-02 03:04:05')
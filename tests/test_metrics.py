@@ -0,0 +1,57 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the request and SQL metrics """
+import unittest
+from app.metrics import Counter, Gauge, Histogram, escape_label
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Metric Tests """
+
+    def test_counter(self):
+        """ Render a counter with labels """
+        counter = Counter('requests_total', 'Requests', ('route', 'status'))
+        counter.inc(route='/customers', status=200)
+        counter.inc(2, route='/customers', status=200)
+        lines = counter.render()
+        self.assertEqual(lines[0], '# HELP requests_total Requests')
+        self.assertEqual(lines[1], '# TYPE requests_total counter')
+        self.assertEqual(lines[2], 'requests_total{route="/customers",status="200"} 3')
+
+    def test_gauge(self):
+        """ Render a gauge without labels """
+        gauge = Gauge('in_flight', 'Requests in flight')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.render()[2], 'in_flight 1')
+        gauge.set(7)
+        self.assertEqual(gauge.render()[2], 'in_flight 7')
+
+    def test_histogram(self):
+        """ Render cumulative histogram buckets """
+        histogram = Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, route='/a')
+        histogram.observe(0.5, route='/a')
+        histogram.observe(5.0, route='/a')
+        lines = histogram.render()
+        self.assertIn('latency_seconds_bucket{route="/a",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{route="/a",le="1.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{route="/a",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_sum{route="/a"} 5.55', lines)
+        self.assertIn('latency_seconds_count{route="/a"} 3', lines)
+
+    def test_escape_label(self):
+        """ Escape quotes, backslashes and newlines in labels """
+        self.assertEqual(escape_label('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the Customer name search """
+import os
+import threading
+import unittest
+from mock import patch
+from app import app, db
+from app.models import Customer
+from app.search import TrigramIndex, CustomerIndex, customer_index, normalize, trigrams, \
+    search_customers, like_prefix
+
+DATABASE_URI = os.getenv('DATABASE_URI', None)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTrigramIndex(unittest.TestCase):
+    """ Trigram Index Tests """
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        self.index.add(1, 'John', 'Smith')
+        self.index.add(2, 'Jonathan', 'Smithers')
+        self.index.add(3, 'Mary', 'Johnson')
+        self.index.add(4, u'Zo\xeb', "O'Brien")
+
+    def keys(self, query, **kargs):
+        return [key for key, _ in self.index.search(query, **kargs)]
+
+    def test_normalize(self):
+        """ Normalize names to words without accents """
+        self.assertEqual(normalize(u'Zo\xeb  O\'Brien'), [u'zoe', u'o', u'brien'])
+        self.assertEqual(normalize('Jos\xc3\xa9'), [u'jose'])
+        self.assertEqual(normalize(None), [])
+
+    def test_trigrams(self):
+        """ Pad trigrams like pg_trgm """
+        self.assertEqual(trigrams(u'jon'), set([u'  j', u' jo', u'jon', u'on ']))
+
+    def test_search_exact(self):
+        """ Rank an exact name first """
+        results = self.index.search('john smith')
+        self.assertEqual(results[0], (1, 1.0))
+        self.assertEqual(self.keys('zoe'), [4])
+        self.assertEqual(self.keys(u'Zo\xeb'), [4])
+
+    def test_search_misspelled(self):
+        """ Find misspelled names """
+        self.assertEqual(self.keys('smiht')[0], 1)
+        self.assertEqual(self.keys('jonson'), [3])
+
+    def test_search_prefix(self):
+        """ Find names by their start """
+        self.assertEqual(self.keys('jo'), [1, 3, 2])
+        self.assertEqual(self.keys('smith'), [1, 2])
+
+    def test_search_every_word(self):
+        """ Match every word of the query """
+        self.assertEqual(self.keys('mary smith'), [])
+        self.assertEqual(self.keys('jo smith'), [1, 2])
+
+    def test_search_limit_and_threshold(self):
+        """ Limit the results and drop the weak matches """
+        self.assertEqual(self.keys('jo', limit=2), [1, 3])
+        self.assertEqual(self.keys('xyz'), [])
+        self.assertEqual(self.keys(''), [])
+        self.assertEqual(self.keys('smiht', threshold=0.9), [])
+
+    def test_update_and_remove(self):
+        """ Re-index and remove names """
+        self.index.add(1, 'Jane', 'Doe')
+        self.assertEqual(self.keys('smith'), [2])
+        self.assertEqual(self.keys('doe'), [1])
+        self.index.remove(3)
+        self.assertEqual(self.keys('johnson'), [])
+        self.assertEqual(len(self.index), 3)
+
+    def test_compact(self):
+        """ Compact drops the stale keys """
+        self.index.add(1, 'Jane', 'Doe')
+        self.index.remove(2)
+        self.index.compact()
+        self.assertNotIn('smith', self.index._keys)
+        self.assertEqual(list(self.index._keys['doe']), [1])
+        self.assertEqual(self.keys('doe'), [1])
+
+
+class TestCustomerSearch(unittest.TestCase):
+    """ In-process Customer Search Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        app.debug = False
+        if DATABASE_URI:
+            app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        Customer.init_db(reset=True)
+        customer_index.reset()
+        self.search_index = app.config['SEARCH_INDEX']
+        self.refresh_seconds = app.config['SEARCH_REFRESH_SECONDS']
+        self.rebuild_seconds = app.config['SEARCH_REBUILD_SECONDS']
+        app.config['SEARCH_INDEX'] = 'memory'
+        Customer(firstname='fido', lastname='dog').save()
+        Customer(firstname='kitty', lastname='cat').save()
+
+    def tearDown(self):
+        app.config['SEARCH_INDEX'] = self.search_index
+        app.config['SEARCH_REFRESH_SECONDS'] = self.refresh_seconds
+        app.config['SEARCH_REBUILD_SECONDS'] = self.rebuild_seconds
+        customer_index.reset()
+        db.session.remove()
+
+    def test_search_customers(self):
+        """ Search the Customers by name """
+        results = search_customers('fid')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['firstname'], 'fido')
+        self.assertTrue(0 < results[0]['score'] < 1)
+        self.assertEqual(search_customers('nobody'), [])
+
+    def test_index_orm_writes(self):
+        """ Index the ORM writes of this process at once """
+        search_customers('fido')
+        customer = Customer(firstname='rex', lastname='dog')
+        customer.save()
+        self.assertEqual([c['firstname'] for c in search_customers('dog')], ['fido', 'rex'])
+        customer.lastname = 'wolf'
+        customer.save()
+        self.assertEqual([c['firstname'] for c in search_customers('wolf')], ['rex'])
+        customer.delete()
+        self.assertEqual(search_customers('wolf'), [])
+
+    def test_rolled_back_writes(self):
+        """ Only index the ORM writes that are committed """
+        search_customers('fido')
+        customer = Customer.find(1)
+        customer.lastname = 'wolf'
+        db.session.flush()
+        self.assertEqual(search_customers('wolf'), [])
+        db.session.rollback()
+        self.assertEqual(search_customers('wolf'), [])
+        self.assertEqual([c['firstname'] for c in search_customers('dog')], ['fido'])
+
+    def test_refresh_other_writes(self):
+        """ Catch up with the rows written outside of the ORM """
+        search_customers('fido')
+        app.config['SEARCH_REFRESH_SECONDS'] = 0
+        table = Customer.__table__
+        db.session.execute(table.insert(), {'firstname': 'rex', 'lastname': 'wolf',
+                                            'valid': True, 'credit_level': 0})
+        db.session.execute(table.update().where(table.c.firstname == 'kitty')
+                           .values(lastname='tiger'))
+        db.session.commit()
+        self.assertEqual([c['firstname'] for c in search_customers('wolf')], ['rex'])
+        self.assertEqual([c['firstname'] for c in search_customers('tiger')], ['kitty'])
+
+    def test_deleted_customers(self):
+        """ Drop the Customers deleted by other processes from the results """
+        search_customers('fido')
+        db.session.execute(Customer.__table__.delete().where(Customer.firstname == 'fido'))
+        db.session.commit()
+        self.assertEqual(search_customers('fido'), [])
+
+    def test_rebuild_does_not_block_searches(self):
+        """ Search the current index while a rebuild reads the table """
+        search_customers('fido')
+        app.config['SEARCH_REBUILD_SECONDS'] = 0
+        started = threading.Event()
+        release = threading.Event()
+        read = CustomerIndex._read
+        def slow_read(index, criterion, watermark):
+            started.set()
+            release.wait(5)
+            return read(index, criterion, watermark)
+        def rebuild():
+            with app.app_context():
+                customer_index.refresh()
+        with patch.object(CustomerIndex, '_read', side_effect=slow_read):
+            thread = threading.Thread(target=rebuild)
+            thread.start()
+            started.wait(5)
+            self.assertEqual([c['firstname'] for c in search_customers('kitty')], ['kitty'])
+            self.assertTrue(thread.is_alive())
+            release.set()
+            thread.join()
+        self.assertEqual(len(customer_index), 2)
+
+
+class TestDatabaseSearch(unittest.TestCase):
+    """ Database Customer Search Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        app.debug = False
+        if DATABASE_URI:
+            app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        Customer.init_db(reset=True)
+        self.search_index = app.config['SEARCH_INDEX']
+        app.config['SEARCH_INDEX'] = 'database'
+        Customer(firstname='fido', lastname='dog').save()
+        Customer(firstname='kitty', lastname='cat').save()
+        Customer(firstname='kitten', lastname='cat').save()
+
+    def tearDown(self):
+        app.config['SEARCH_INDEX'] = self.search_index
+        db.session.remove()
+
+    def test_search_by_prefix(self):
+        """ Search the Customers by the start of their names in the database """
+        results = search_customers('kit')
+        self.assertEqual([c['firstname'] for c in results], ['kitty', 'kitten'])
+        self.assertTrue(results[0]['score'] > results[1]['score'])
+        self.assertEqual([c['firstname'] for c in search_customers('kit cat', 1)], ['kitty'])
+        self.assertEqual(search_customers('kit dog'), [])
+        self.assertEqual(len(customer_index), 0)
+
+    def test_like_prefix(self):
+        """ Escape the LIKE wildcards of a query word """
+        self.assertEqual(like_prefix('50%_off'), '50\\%\\_off%')
+        self.assertEqual(search_customers('%'), [])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
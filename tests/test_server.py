@@ -7,9 +7,11 @@ import os
 import logging
 import unittest
 import json
+import zlib
+import msgpack
 from mock import MagicMock, patch
 from flask_api import status    # HTTP Status Codes
-from app.models import Customer
+from app.models import Customer, ConcurrentUpdateError
 
 from app import server, db
 import app.server as server
@@ -181,6 +183,127 @@ class TestCustomerServer(unittest.TestCase):
         resp = self.app.get('/customers?firstname=fido', content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_customer_page(self):
+        """ Get a page of Customers with a keyset cursor """
+        resp = self.app.get('/customers?limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['firstname'], 'fido')
+        self.assertEqual(resp.headers.get('X-Next-Cursor'), str(data[0]['id']))
+        self.assertIn('rel="next"', resp.headers.get('Link'))
+        resp = self.app.get('/customers?limit=1&after={}'.format(data[0]['id']))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['firstname'], 'kitty')
+        resp = self.app.get('/customers?limit=1&after={}'.format(data[0]['id']))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_customer_page_of_non_ascii_names(self):
+        """ Get a page of Customers filtered on a name that is not ASCII """
+        server.Customer(firstname = 'hans', lastname = u'M\xfcller').save()
+        server.Customer(firstname = 'greta', lastname = u'M\xfcller').save()
+        resp = self.app.get('/customers?lastname=M%C3%BCller&limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)[0]['firstname'], 'hans')
+        self.assertIn('lastname=M%C3%BCller', resp.headers.get('Link'))
+
+    def test_get_customer_last_page_has_no_link(self):
+        """ Get the last page of Customers without a next link """
+        resp = self.app.get('/customers?limit=5&lastname=dog')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 1)
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_get_customer_page_with_bad_limit(self):
+        """ Get a page of Customers with an invalid limit """
+        resp = self.app.get('/customers?limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers?limit=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers?after=-1')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_customer_list(self):
+        """ Stream the list of Customers """
+        resp = self.app.get('/customers?stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[1]['firstname'], 'kitty')
+        resp = self.app.get('/customers?stream=true&lastname=bird')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_stream_customer_list_bad_query(self):
+        """ Reject a bad streaming query before the response starts """
+        resp = self.app.get('/customers?stream=true&gender=male')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers?stream=true&sort=lastname')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_customer_list_by_valid(self):
+        """ Query Customers by their valid status """
+        resp = self.app.get('/customers?valid=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        resp = self.app.get('/customers?valid=false')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/customers?valid=maybe')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_customer_list_with_operators(self):
+        """ Query Customers with operators and sorting """
+        resp = self.app.get('/customers?lastname__prefix=d')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([c['firstname'] for c in data], ['fido'])
+        resp = self.app.get('/customers?id__in=1,2&sort=firstname&order=desc')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([c['firstname'] for c in data], ['kitty', 'fido'])
+        resp = self.app.get('/customers?credit_level__lt=0')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/customers?credit_level__lt=zero')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_customer_list_with_fields(self):
+        """ Query Customers returning only some fields """
+        resp = self.app.get('/customers?fields=firstname&lastname=cat')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data, [{'id': 2, 'firstname': 'kitty'}])
+        resp = self.app.get('/customers?fields=lastname&stream=true')
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], {'id': 1, 'lastname': 'dog'})
+        resp = self.app.get('/customers?fields=gender')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_count_customers(self):
+        """ Count the Customers matching a query """
+        resp = self.app.get('/customers?count_only=true&lastname=dog')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'count': 1})
+        resp = self.app.get('/customers?count_only=true&lastname=bird')
+        self.assertEqual(json.loads(resp.data), {'count': 0})
+
+    def test_customer_stats(self):
+        """ Get the statistics of the Customers """
+        self.app.put('/customers/2/downgrade-credit')
+        resp = self.app.get('/customers/stats?bucket_size=5')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['valid'], {'true': 1, 'false': 1})
+        self.assertEqual(data['histogram'], [{'from': -5, 'to': -1, 'count': 1},
+                                             {'from': 0, 'to': 4, 'count': 1}])
+        resp = self.app.get('/customers/stats?gender=male')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers/stats?bucket_size=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_query_customer_list_by_unsupported_field(self):
         """ Query Customers by None Parameter"""
         resp = self.app.get('/customers?gender=male', content_type='application/json')
@@ -211,6 +334,52 @@ class TestCustomerServer(unittest.TestCase):
         resp = self.app.put('/customers/2', data= data, content_type='string')
         self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_batch_customers(self):
+        """ Create, update and delete Customers in one batch """
+        batch = [{'firstname': 'sammy', 'lastname': 'snake'},
+                 {'id': 2, 'firstname': 'kitty', 'lastname': 'tabby'},
+                 {'id': 1, 'op': 'delete'},
+                 {'lastname': 'nofirstname'},
+                 {'id': 9, 'firstname': 'ghost', 'lastname': 'cat'}]
+        resp = self.app.post('/customers/batch', data=json.dumps(batch),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        statuses = [result['status'] for result in data['results']]
+        self.assertEqual(statuses, ['created', 'updated', 'deleted', 'invalid', 'not found'])
+        self.assertEqual(data['summary']['created'], 1)
+        resp = self.app.get('/customers/2')
+        self.assertEqual(json.loads(resp.data)['lastname'], 'tabby')
+        resp = self.app.get('/customers/1')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/customers/{}'.format(data['results'][0]['id']))
+        self.assertEqual(json.loads(resp.data)['firstname'], 'sammy')
+
+    def test_batch_customers_bad_chunk_size(self):
+        """ Post a batch with a chunk size of 0 """
+        resp = self.app.post('/customers/batch?chunk_size=0', data='[]',
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_customers_ndjson(self):
+        """ Create Customers from a newline delimited JSON batch """
+        body = '{"firstname": "sammy", "lastname": "snake"}\nnot json\n' \
+               '{"firstname": "tom", "lastname": "cat"}\n'
+        resp = self.app.post('/customers/batch?chunk_size=1', data=body,
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['summary'], {'created': 2, 'invalid': 1})
+        self.assertEqual(self.get_customer_count(), 4)
+
+    def test_batch_customers_not_a_list(self):
+        """ Post a batch that is not a list """
+        resp = self.app.post('/customers/batch', data=json.dumps({'firstname': 'a'}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/customers/batch', data='[]', content_type='text/plain')
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_upgrade_credit_of_a_Customer(self):
         """ Upgrade the credit of a customer"""
         resp = self.app.put('/customers/2/upgrade-credit', content_type='application/json')
@@ -219,6 +388,347 @@ class TestCustomerServer(unittest.TestCase):
         self.assertEqual(new_json['credit_level'], 1)
         self.assertEqual(new_json['valid'], True)
 
+    def test_upgrade_credit_after_clearing_it(self):
+        """ Upgrade the credit of a customer updated without a credit level """
+        data = json.dumps({'firstname': 'kitty', 'lastname': 'cat',
+                           'valid': False, 'credit_level': None})
+        resp = self.app.put('/customers/2', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put('/customers/2/upgrade-credit')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['credit_level'], 1)
+
+    def test_change_credit_of_a_Customer_by_amount(self):
+        """ Upgrade and downgrade the credit of a customer by an amount """
+        resp = self.app.put('/customers/2/downgrade-credit?amount=3')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json['credit_level'], -3)
+        self.assertEqual(new_json['valid'], False)
+        self.assertEqual(new_json['firstname'], 'kitty')
+        resp = self.app.put('/customers/2/upgrade-credit?amount=5')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json['credit_level'], 2)
+        self.assertEqual(new_json['valid'], True)
+        resp = self.app.put('/customers/2/upgrade-credit?amount=-1')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put('/customers/2/downgrade-credit?amount=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put('/customers/2/upgrade-credit?amount=99999999999999999999')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('at most', json.loads(resp.data)['message'])
+        self.assertEqual(server.Customer.find(2).credit_level, 2)
+
+    def test_get_customer_list_msgpack(self):
+        """ Get the Customers as MessagePack """
+        resp = self.app.get('/customers', headers={'Accept': 'application/msgpack'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, 'application/msgpack')
+        data = msgpack.unpackb(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]['firstname'], 'fido')
+        resp = self.app.get('/customers/1', headers={'Accept': 'application/msgpack'})
+        self.assertEqual(msgpack.unpackb(resp.data)['lastname'], 'dog')
+
+    def test_representations_have_their_own_etag(self):
+        """ Tell the JSON and MessagePack representations apart """
+        resp = self.app.get('/customers/1')
+        json_etag = resp.headers['ETag']
+        self.assertIn('Accept', resp.headers['Vary'])
+        headers = {'Accept': 'application/msgpack'}
+        resp = self.app.get('/customers/1', headers=headers)
+        msgpack_etag = resp.headers['ETag']
+        self.assertEqual(msgpack_etag, json_etag[:-1] + '-msgpack"')
+        self.assertIn('Accept', resp.headers['Vary'])
+        resp = self.app.get('/customers/1', headers=dict(headers, **{'If-None-Match': json_etag}))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/customers/1', headers=dict(headers, **{'If-None-Match': msgpack_etag}))
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIn('Accept', resp.headers['Vary'])
+        resp = self.app.get('/customers/1', headers={'If-None-Match': msgpack_etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/customers?lastname=dog', headers=headers)
+        self.assertTrue(resp.headers['ETag'].endswith('-msgpack"'))
+        # the version in either tag can be required by an update
+        resp = self.app.put('/customers/1', data=json.dumps({'firstname': 'rex', 'lastname': 'dog',
+                                                            'valid': True, 'credit_level': 0}),
+                            content_type='application/json', headers={'If-Match': msgpack_etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_customer_list_compressed(self):
+        """ Get a large list of Customers compressed """
+        Customer.bulk_save([{'firstname': 'cat{}'.format(i), 'lastname': 'cat'}
+                            for i in range(100)])
+        resp = self.app.get('/customers', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        data = json.loads(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS))
+        self.assertEqual(len(data), 102)
+
+    def test_export_customers(self):
+        """ Export the Customers as NDJSON and CSV """
+        resp = self.app.get('/customers/export')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        self.assertIn('X-Export-Watermark', resp.headers)
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([row['firstname'] for row in rows], ['fido', 'kitty'])
+        resp = self.app.get('/customers/export?format=csv&lastname=cat&fields=firstname,valid')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        self.assertEqual(resp.data.splitlines(), ['id,firstname,valid', '2,kitty,true'])
+
+    def test_export_customers_since(self):
+        """ Export the Customers updated since a watermark """
+        resp = self.app.get('/customers/export?since=2999-01-01T00:00:00Z')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data, '')
+        resp = self.app.get('/customers/export?since=0')
+        self.assertEqual(len(resp.data.splitlines()), 2)
+        resp = self.app.get('/customers/export?since=yesterday')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers/export?format=xml')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_customers(self):
+        """ Search the Customers by a misspelled name """
+        self.addCleanup(server.app.config.__setitem__, 'SEARCH_INDEX',
+                        server.app.config['SEARCH_INDEX'])
+        server.app.config['SEARCH_INDEX'] = 'memory'
+        server.Customer(firstname='kitten', lastname='cat').save()
+        resp = self.app.get('/customers/search?q=kity')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([customer['firstname'] for customer in data], ['kitty', 'kitten'])
+        self.assertTrue(data[0]['score'] > data[1]['score'])
+        resp = self.app.get('/customers/search?q=kity&limit=1')
+        self.assertEqual(len(json.loads(resp.data)), 1)
+        resp = self.app.get('/customers/search?q=')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers/search?q=kity&limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_not_modified(self):
+        """ Answer a conditional GET of an unchanged Customer with 304 """
+        resp = self.app.get('/customers/2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(json.loads(resp.data)['version'], 1)
+        resp = self.app.get('/customers/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        resp = self.app.get('/customers/2', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.put('/customers/2/upgrade-credit')
+        resp = self.app.get('/customers/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_get_customer_list_not_modified(self):
+        """ Answer a conditional GET of an unchanged collection with 304 """
+        resp = self.app.get('/customers?lastname=cat')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/customers?lastname=cat', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get('/customers?lastname=dog', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        server.Customer(firstname='tom', lastname='cat').save()
+        resp = self.app.get('/customers?lastname=cat', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_get_customer_list_etag_from_rows(self):
+        """ Only ask the database for the ETag of a conditional GET """
+        with patch.object(server.Customer, 'collection_version',
+                          wraps=server.Customer.collection_version) as version:
+            resp = self.app.get('/customers?lastname=cat&fields=firstname')
+            self.assertFalse(version.called)
+            self.assertEqual(json.loads(resp.data), [{'id': 2, 'firstname': 'kitty'}])
+            etag = resp.headers['ETag']
+            resp = self.app.get('/customers?lastname=cat&fields=firstname',
+                                headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(version.call_count, 1)
+            # pages are not validated
+            resp = self.app.get('/customers?limit=1&after=1', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotIn('ETag', resp.headers)
+            self.assertEqual(version.call_count, 1)
+
+    def test_get_customer_list_etag_with_long_count(self):
+        """ Match the ETag from rows with the one of a driver counting in longs """
+        etag = self.app.get('/customers?lastname=cat').headers['ETag']
+        version = server.Customer.collection_version({'lastname': 'cat'})
+        with patch.object(server.Customer, 'collection_version',
+                          return_value=tuple(long(part) for part in version)):
+            resp = self.app.get('/customers?lastname=cat', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_update_customer_if_match(self):
+        """ Update a Customer only if it matches the If-Match ETag """
+        etag = self.app.get('/customers/2').headers['ETag']
+        data = json.dumps({'firstname': 'tom', 'lastname': 'cat'})
+        resp = self.app.put('/customers/2', data=data, content_type='application/json',
+                            headers={'If-Match': '"2-0"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put('/customers/2', data=data, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['version'], 2)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.put('/customers/2', data=data, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put('/customers/2', data=data, content_type='application/json',
+                            headers={'If-Match': '"1-1"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put('/customers/9', data=data, content_type='application/json',
+                            headers={'If-Match': '"9-1"'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_customer_if_match_weak(self):
+        """ Accept the weak ETag of a compressed response in If-Match """
+        data = json.dumps({'firstname': 'tom', 'lastname': 'cat'})
+        resp = self.app.put('/customers/2', data=data, content_type='application/json',
+                            headers={'If-Match': 'W/"2-1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    @patch('app.server.Customer.save')
+    def test_update_customer_conflict(self, save_mock):
+        """ Answer an update that lost the race with another one with 409 """
+        save_mock.side_effect = ConcurrentUpdateError('stale')
+        data = json.dumps({'firstname': 'tom', 'lastname': 'cat'})
+        resp = self.app.put('/customers/2', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_queue_credit_of_a_Customer(self):
+        """ Queue credit adjustments with the write-behind queue """
+        queue = server.credits.CreditQueue(server.credits.MemoryQueue(), flush_seconds=60)
+        with patch.object(server.credits, 'queue', queue):
+            resp = self.app.put('/customers/2/upgrade-credit?amount=5')
+            self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(json.loads(resp.data), {'id': 2, 'amount': 5, 'pending': 1})
+            resp = self.app.put('/customers/2/downgrade-credit?amount=2')
+            self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+            resp = self.app.put('/customers/5/downgrade-credit')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+            resp = self.app.get('/credit-queue/stats')
+            data = json.loads(resp.data)
+            self.assertEqual(data['backend'], 'memory')
+            self.assertEqual(data['depth'], 2)
+            self.assertEqual(data['customers'], 1)
+            self.assertIn('credit_queue_depth 2', self.app.get('/metrics').data)
+            queue.stop()
+        resp = self.app.get('/customers/2')
+        self.assertEqual(json.loads(resp.data)['credit_level'], 3)
+        resp = self.app.get('/credit-queue/stats')
+        self.assertEqual(json.loads(resp.data), {'backend': 'none'})
+
+    def test_create_customer_idempotent(self):
+        """ Replay the first response to a POST repeating an Idempotency-Key """
+        data = json.dumps({'firstname': 'sammy', 'lastname': 'snake'})
+        headers = {'Idempotency-Key': 'create-sammy'}
+        resp = self.app.post('/customers', data=data, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', resp.headers)
+        first = json.loads(resp.data)
+        resp = self.app.post('/customers', data=data, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(resp.headers['Location'], 'http://localhost/customers/3')
+        self.assertEqual(json.loads(resp.data), first)
+        self.assertEqual(self.get_customer_count(), 3)
+        # the replay negotiates its own representation
+        resp = self.app.post('/customers', data=data, content_type='application/json',
+                             headers=dict(headers, Accept='application/msgpack'))
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(resp.content_type, 'application/msgpack')
+        self.assertTrue(resp.headers['ETag'].endswith('-msgpack"'))
+        self.assertEqual(msgpack.unpackb(resp.data), first)
+        other = json.dumps({'firstname': 'sally', 'lastname': 'snake'})
+        resp = self.app.post('/customers', data=other, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, 422)
+        resp = self.app.post('/customers', data=data, content_type='application/json',
+                             headers={'Idempotency-Key': 'k' * 129})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_credit_idempotent(self):
+        """ Apply a credit action repeating an Idempotency-Key once """
+        headers = {'Idempotency-Key': 'upgrade-kitty'}
+        for _ in range(3):
+            resp = self.app.put('/customers/2/upgrade-credit?amount=2', headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(resp.data)['credit_level'], 2)
+        self.assertEqual(Customer.find(2).credit_level, 2)
+        # a failed request frees its key
+        headers = {'Idempotency-Key': 'downgrade-nobody'}
+        resp = self.app.put('/customers/5/downgrade-credit', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        server.Customer(firstname='sammy', lastname='snake').save()
+        server.Customer(firstname='sally', lastname='snake').save()
+        server.Customer(firstname='rex', lastname='dog').save()
+        resp = self.app.put('/customers/5/downgrade-credit', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_idempotency_key_in_progress(self):
+        """ Refuse a retry while the first request is still running """
+        with server.app.test_request_context('/customers/2/upgrade-credit', method='PUT'):
+            fingerprint = server.request_fingerprint()
+        self.assertIs(server.IdempotencyKey.claim('busy', fingerprint), None)
+        resp = self.app.put('/customers/2/upgrade-credit', headers={'Idempotency-Key': 'busy'})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        server.IdempotencyKey.release('busy')
+        resp = self.app.put('/customers/2/upgrade-credit', headers={'Idempotency-Key': 'busy'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_credit_history(self):
+        """ Page through the credit history of a Customer """
+        for amount in (3, 4, 5):
+            self.app.put('/customers/2/upgrade-credit?amount={}'.format(amount))
+        self.app.put('/customers/2/downgrade-credit?amount=20')
+        resp = self.app.get('/customers/2/credit-history?limit=3&from=0')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([event['credit_level'] for event in data], [3, 7, 12])
+        self.assertEqual(data[0]['delta'], 3)
+        self.assertEqual(data[0]['source'], 'credit')
+        self.assertTrue(data[0]['ts'].endswith('Z'))
+        self.assertEqual(resp.headers['X-Next-Cursor'], str(data[-1]['id']))
+        self.assertIn('from=0', resp.headers['Link'])
+        resp = self.app.get('/customers/2/credit-history?limit=3&from=0&after={}'
+                            .format(data[-1]['id']))
+        data = json.loads(resp.data)
+        self.assertEqual([(event['credit_level'], event['valid']) for event in data], [(-8, False)])
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+        resp = self.app.get('/customers/2/credit-history?to=2000-01-01')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/customers/2/credit-history?from=last-week')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers/2/credit-history?limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers/5/credit-history')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_credit_level_at(self):
+        """ Get the credit level of a Customer at a point in time """
+        self.app.put('/customers/2/downgrade-credit?amount=2')
+        resp = self.app.get('/customers/2/credit-level?at=2000-01-01T00:00:00Z')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'id': 2, 'at': '2000-01-01T00:00:00.000000Z',
+                                                 'credit_level': 0, 'valid': True})
+        resp = self.app.get('/customers/2/credit-level?at=4102444800')
+        self.assertEqual(json.loads(resp.data)['credit_level'], -2)
+        resp = self.app.get('/customers/2/credit-level')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers/5/credit-level?at=0')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_upgrade_credit_of_a_Customer_not_avaliable(self):
         """ Upgrade the credit of a customer not avaliable"""
         resp = self.app.put('/customers/4/upgrade-credit', content_type='application/json')
@@ -260,6 +770,78 @@ class TestCustomerServer(unittest.TestCase):
         self.assertEqual(new_json['credit_level'], 0)
         self.assertEqual(new_json['valid'], True)
 
+    def test_cache_stats(self):
+        """ Get the counters of the Customer cache """
+        self.app.get('/customers/2')
+        self.app.get('/customers/2')
+        resp = self.app.get('/cache/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertIn('hits', data)
+        self.assertIn('misses', data)
+        self.assertEqual(data['coalesced']['in_flight'], 0)
+
+    def test_pool_stats(self):
+        """ Get the counters of the connection pool """
+        resp = self.app.get('/pool/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertIn('checkouts', data)
+        self.assertIn('wait_max', data)
+
+    def test_metrics(self):
+        """ Get the Prometheus metrics """
+        self.app.get('/customers/2')
+        self.app.get('/customers/0')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('http_requests_total{method="GET",route="/customers/<int:customer_id>",'
+                      'status="404"}', resp.data)
+        self.assertIn('http_request_duration_seconds_bucket', resp.data)
+        self.assertIn('sql_statements_total{route="/customers/<int:customer_id>"}', resp.data)
+        self.assertIn('http_requests_in_flight 1', resp.data)
+        self.assertIn('customer_cache_hits_total', resp.data)
+        self.assertIn('customer_reads_coalesced_total', resp.data)
+
+    def test_slow_request_is_logged(self):
+        """ Log a slow request with its slowest SQL statement """
+        server.app.config['SLOW_REQUEST_SECONDS'] = 0
+        self.addCleanup(server.app.config.__setitem__, 'SLOW_REQUEST_SECONDS', 1.0)
+        with patch('app.metrics.logger.warning') as warning_mock:
+            self.app.get('/customers?lastname=dog')
+            self.assertTrue(warning_mock.called)
+            args = warning_mock.call_args[0]
+            self.assertIn('/customers/', args)
+            self.assertTrue(args[-1].startswith('SELECT'))
+
+    def test_livez(self):
+        """ Test the liveness probe """
+        resp = self.app.get('/livez')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_readyz(self):
+        """ Test the readiness probe and its cache """
+        server.readiness_probe.reset()
+        resp = self.app.get('/readyz')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['status'], 'ready')
+        self.assertTrue(data['database']['ok'])
+        self.assertFalse(data['cached'])
+        resp = self.app.get('/readyz')
+        self.assertTrue(json.loads(resp.data)['cached'])
+
+    @patch('app.database.probe_engine')
+    def test_readyz_database_down(self, probe_mock):
+        """ Test the readiness probe when the database is down """
+        probe_mock.return_value = {'ok': False, 'error': 'gone away'}
+        server.readiness_probe.reset()
+        resp = self.app.get('/readyz')
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(json.loads(resp.data)['status'], 'unavailable')
+        server.readiness_probe.reset()
+
     def test_health_check(self):
         """ Test the healthcheck url"""
         resp = self.app.get('/healthcheck')
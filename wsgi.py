@@ -0,0 +1,6 @@
+"""
+Customer Service WSGI entry point
+
+Used by gunicorn in production, see gunicorn_config.py
+"""
+from app import app, server